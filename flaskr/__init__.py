@@ -1,14 +1,62 @@
-import datetime
+import os
 from flask import Flask, request, jsonify, abort
 from flask_cors import CORS
-from .auth.auth import requires_auth, AuthError
-from .database.models import setup_db, Actor, Movie, setup_migrations
+from sqlalchemy.orm import selectinload
+from .auth import auth
+from .auth.auth import requires_auth, check_permissions, AuthError
+from .database.models import db, setup_db, Actor, Movie, ImportJob, setup_migrations
+from .database.queries import paginate, get_row, related_rows
+from .database.search import search
+from .database.stats import movie_stats, actor_stats
+from .database.changes import change_feed
+from .database.pool import statement_timeout, pool_status, READ_STATEMENT_TIMEOUT_MS
+from .database.replicas import setup_replica_routing, replica_set
+from .database.validation import validate
+from .database.writes import (
+    insert_row,
+    update_row,
+    delete_row,
+    if_match_versions,
+    version_etag,
+    invalid_payload_response,
+)
+from .database.bulk import (
+    bulk_create_response,
+    bulk_update_response,
+    bulk_delete_response,
+)
+from .export import export_response
+from .imports import create_import_response, format_job
+from .cache import respond, list_key, detail_key
+from .serialization import json_response
+from .metrics import setup_metrics, metrics_response
+from .compression import setup_compression
+
+# warm the app up at import, for gunicorn --preload (see warm_up)
+PRELOAD_APP = os.getenv("PRELOAD_APP", "false").lower() == "true"
 
 
 def create_app(test_config=None):
+    """
+    Builds the app without touching the database or the identity provider:
+    the engine is created and the signing keys are fetched on first use.
+    The migration commands are only registered for the flask CLI, as they
+    pull in alembic. test_config overrides the config, its
+    SQLALCHEMY_DATABASE_URI replaces DATABASE_URI.
+    """
     app = Flask(__name__)
-    setup_db(app)
-    setup_migrations(app)
+    if test_config is None:
+        setup_db(app)
+    else:
+        setup_db(app, test_config["SQLALCHEMY_DATABASE_URI"])
+        app.config.update(test_config)
+    if os.getenv("FLASK_RUN_FROM_CLI"):
+        setup_migrations(app)
+    setup_metrics(app)
+    # registered after setup_metrics so the response sizes recorded are the
+    # compressed ones
+    setup_compression(app)
+    setup_replica_routing(app)
     CORS(app)
 
     @app.after_request
@@ -29,29 +77,165 @@ def create_app(test_config=None):
             {"success": True, "message": "Welcome to the best Capstone project!"}
         )
 
+    @app.route("/health/db")
+    def database_health():
+        return jsonify(
+            {
+                "success": True,
+                "pool": pool_status(db.engine),
+                "replicas": replica_set.status(),
+            }
+        )
+
+    @app.route("/metrics")
+    def metrics():
+        return metrics_response()
+
+    @app.route("/search")
+    @requires_auth("view:actors")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
+    def search_all(jwt):
+        has_movies = check_permissions("view:movies", jwt)
+
+        def search_results():
+            args = request.args.copy()
+            args.pop("fields", None)
+            actors, next_actors_offset = search(Actor, args)
+            results = {
+                "success": True,
+                "actors": actors,
+                "next_actors_offset": next_actors_offset,
+            }
+            if has_movies:
+                movies, next_movies_offset = search(Movie, args)
+                results["movies"] = movies
+                results["next_movies_offset"] = next_movies_offset
+            return results
+
+        try:
+            # the movies are only in the results of tokens with view:movies,
+            # which therefore get pages of their own
+            key = list_key("actors", "movies") + ":movies.{}".format(int(has_movies))
+            return respond(key, search_results)
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/stats/movies")
+    @requires_auth("view:movies")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
+    def get_movie_stats(jwt):
+        def movie_stats_page():
+            return dict(movie_stats(), success=True)
+
+        try:
+            return respond(list_key("movies"), movie_stats_page)
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/stats/actors")
+    @requires_auth("view:actors")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
+    def get_actor_stats(jwt):
+        def actor_stats_page():
+            return dict(actor_stats(), success=True)
+
+        try:
+            return respond(list_key("actors"), actor_stats_page)
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/changes")
+    @requires_auth("view:actors")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
+    def get_changes(jwt):
+        try:
+            allowed = ["actors"]
+            if check_permissions("view:movies", jwt):
+                allowed.append("movies")
+            changes, next_cursor, has_more = change_feed(request.args, allowed)
+            return json_response(
+                {
+                    "success": True,
+                    "changes": changes,
+                    "next_cursor": next_cursor,
+                    "has_more": has_more,
+                }
+            )
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
     @app.route("/actors")
     @requires_auth("view:actors")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
     def get_actors(jwt):
-        try:
-            actors = Actor.query.all()
+        def actors_page():
+            if request.args.get("q"):
+                actors, next_offset = search(Actor, request.args)
+                return {"success": True, "actors": actors, "next_offset": next_offset}
+            actors, next_cursor = paginate(Actor, request.args)
             if len(actors) == 0:
                 abort(404)
-            actors = [actor.get_formatted_json() for actor in actors]
-            return jsonify({"success": True, "actors": actors})
+            return {"success": True, "actors": actors, "next_cursor": next_cursor}
+
+        try:
+            # pages with ?include=cast also go stale when a movie changes
+            if request.args.get("include"):
+                # and embed movies, which /actors/<id>/movies requires view:movies for
+                if not check_permissions("view:movies", jwt):
+                    abort(403)
+                return respond(list_key("actors", "movies"), actors_page)
+            return respond(list_key("actors"), actors_page)
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/actors/<int:actor_id>")
+    @requires_auth("view:actors")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
+    def get_actor(jwt, actor_id):
+        def actor_detail():
+            row = get_row(Actor, actor_id)
+            if row is None:
+                abort(404)
+            actor, version = row
+            return {"success": True, "actor": actor}, version_etag(version)
+
+        try:
+            return respond(detail_key("actors", actor_id), actor_detail)
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/actors/<int:actor_id>/movies")
+    @requires_auth("view:movies")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
+    def get_actor_movies(jwt, actor_id):
+        try:
+            movies = related_rows(Actor, actor_id)
+            if movies is None:
+                abort(404)
+            return json_response({"success": True, "movies": movies})
         except Exception as e:
             x = str(e)[:3]
             abort(int(x))
 
+    @app.route("/actors/export")
+    @requires_auth("view:actors")
+    def export_actors(jwt):
+        return export_response(Actor)
+
     @app.route("/actors", methods=["POST"])
     @requires_auth("add:actors")
     def create_actor(jwt):
         try:
-            data = request.get_json()
-            if "name" not in data or "age" not in data or "gender" not in data:
-                abort(400)
-            actor = Actor(name=data["name"], age=data["age"], gender=data["gender"])
-            actor.insert()
-            return jsonify({"success": True, "actor_id": actor.id})
+            values, errors = validate(Actor, request.get_json())
+            if errors:
+                return invalid_payload_response(errors)
+            return jsonify({"success": True, "actor_id": insert_row(Actor, values)})
         except Exception as e:
             x = str(e)[:3]
             abort(int(x))
@@ -60,20 +244,13 @@ def create_app(test_config=None):
     @requires_auth("patch:actors")
     def modify_actor(jwt, actor_id):
         try:
-            data = request.get_json()
-            if data is None:
-                abort(400)
-            actor = Actor.query.get(actor_id)
-            if actor is None:
-                abort(404)
-            if "name" in data:
-                actor.name = data["name"]
-            if "gender" in data:
-                actor.gender = data["gender"]
-            if "age" in data:
-                actor.age = data["age"]
-            actor.update()
-            return jsonify({"success": True, "actor": actor.get_formatted_json()})
+            values, errors = validate(Actor, request.get_json(), partial=True)
+            if errors:
+                return invalid_payload_response(errors)
+            actor, version = update_row(Actor, actor_id, values, if_match_versions())
+            response = json_response({"success": True, "actor": actor})
+            response.set_etag(version_etag(version))
+            return response
         except Exception as e:
             x = str(e)[:3]
             abort(int(x))
@@ -82,64 +259,150 @@ def create_app(test_config=None):
     @requires_auth("delete:actors")
     def delete_actor(jwt, actor_id):
         try:
-            actor = Actor.query.get(actor_id)
-            if actor is None:
-                abort(404)
-            actor.delete()
-            return jsonify({"success": True, "deleted": actor.id})
+            delete_row(Actor, actor_id, if_match_versions())
+            return jsonify({"success": True, "deleted": actor_id})
         except Exception as e:
             x = str(e)[:3]
             abort(int(x))
 
+    @app.route("/actors/bulk", methods=["POST"])
+    @requires_auth("add:actors")
+    def create_actors_bulk(jwt):
+        return bulk_create_response(Actor, request.get_json(), "actors")
+
+    @app.route("/actors/bulk", methods=["PATCH"])
+    @requires_auth("patch:actors")
+    def modify_actors_bulk(jwt):
+        return bulk_update_response(Actor, request.get_json(), "actors")
+
+    @app.route("/actors/bulk", methods=["DELETE"])
+    @requires_auth("delete:actors")
+    def delete_actors_bulk(jwt):
+        return bulk_delete_response(Actor, request.get_json())
+
     @app.route("/movies")
     @requires_auth("view:movies")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
     def get_movies(jwt):
-        try:
-            movies = Movie.query.all()
+        def movies_page():
+            if request.args.get("q"):
+                movies, next_offset = search(Movie, request.args)
+                return {"success": True, "movies": movies, "next_offset": next_offset}
+            movies, next_cursor = paginate(Movie, request.args)
             if len(movies) == 0:
                 abort(404)
-            movies = [movie.get_formatted_json() for movie in movies]
-            return jsonify({"success": True, "movies": movies})
+            return {"success": True, "movies": movies, "next_cursor": next_cursor}
+
+        try:
+            if request.args.get("include"):
+                if not check_permissions("view:actors", jwt):
+                    abort(403)
+                return respond(list_key("movies", "actors"), movies_page)
+            return respond(list_key("movies"), movies_page)
         except Exception as e:
             x = str(e)[:3]
             abort(int(x))
 
-    @app.route("/movies", methods=["POST"])
-    @requires_auth("add:movies")
-    def create_movie(jwt):
+    @app.route("/movies/<int:movie_id>")
+    @requires_auth("view:movies")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
+    def get_movie(jwt, movie_id):
+        def movie_detail():
+            row = get_row(Movie, movie_id)
+            if row is None:
+                abort(404)
+            movie, version = row
+            return {"success": True, "movie": movie}, version_etag(version)
+
+        try:
+            return respond(detail_key("movies", movie_id), movie_detail)
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/movies/<int:movie_id>/actors")
+    @requires_auth("view:actors")
+    @statement_timeout(READ_STATEMENT_TIMEOUT_MS)
+    def get_movie_actors(jwt, movie_id):
+        try:
+            actors = related_rows(Movie, movie_id)
+            if actors is None:
+                abort(404)
+            return json_response({"success": True, "actors": actors})
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/movies/<int:movie_id>/actors", methods=["POST"])
+    @requires_auth("patch:movies")
+    def cast_actors(jwt, movie_id):
         try:
             data = request.get_json()
-            if "title" not in data or "release_date" not in data or "genre" not in data:
+            if data is None or not isinstance(data.get("actor_ids"), list):
+                abort(400)
+            actor_ids = set(data["actor_ids"])
+            if not all(type(actor_id) is int for actor_id in actor_ids):
                 abort(400)
-            movie = Movie(
-                title=data["title"],
-                release_date=datetime.date.fromisoformat(data["release_date"]),
-                genre=data["genre"],
+            movie = (
+                Movie.query.options(selectinload(Movie.actors))
+                .filter(Movie.id == movie_id)
+                .first()
+            )
+            if movie is None:
+                abort(404)
+            actors = Actor.query.filter(Actor.id.in_(actor_ids)).all()
+            if len(actors) != len(actor_ids):
+                abort(404)
+            movie.cast(actors)
+            return jsonify(
+                {"success": True, "movie_id": movie_id, "cast": sorted(actor_ids)}
             )
-            movie.insert()
-            return jsonify({"success": True, "movie_id": movie.id})
         except Exception as e:
             x = str(e)[:3]
             abort(int(x))
 
-    @app.route("/movies/<int:movie_id>", methods=["PATCH"])
+    @app.route("/movies/<int:movie_id>/actors/<int:actor_id>", methods=["DELETE"])
     @requires_auth("patch:movies")
-    def modify_movie(jwt, movie_id):
+    def uncast_actor(jwt, movie_id, actor_id):
         try:
-            data = request.get_json()
-            if data is None:
-                abort(400)
             movie = Movie.query.get(movie_id)
-            if movie is None:
+            actor = Actor.query.get(actor_id)
+            if movie is None or actor is None:
                 abort(404)
-            if "title" in data:
-                movie.title = data["title"]
-            if "release_date" in data:
-                movie.release_date = data["release_date"]
-            if "genre" in data:
-                movie.genre = data["genre"]
-            movie.update()
-            return jsonify({"success": True, "movie": movie.get_formatted_json()})
+            movie.uncast(actor)
+            return jsonify({"success": True, "movie_id": movie_id, "deleted": actor_id})
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/movies/export")
+    @requires_auth("view:movies")
+    def export_movies(jwt):
+        return export_response(Movie)
+
+    @app.route("/movies", methods=["POST"])
+    @requires_auth("add:movies")
+    def create_movie(jwt):
+        try:
+            values, errors = validate(Movie, request.get_json())
+            if errors:
+                return invalid_payload_response(errors)
+            return jsonify({"success": True, "movie_id": insert_row(Movie, values)})
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/movies/<int:movie_id>", methods=["PATCH"])
+    @requires_auth("patch:movies")
+    def modify_movie(jwt, movie_id):
+        try:
+            values, errors = validate(Movie, request.get_json(), partial=True)
+            if errors:
+                return invalid_payload_response(errors)
+            movie, version = update_row(Movie, movie_id, values, if_match_versions())
+            response = json_response({"success": True, "movie": movie})
+            response.set_etag(version_etag(version))
+            return response
         except Exception as e:
             x = str(e)[:3]
             abort(int(x))
@@ -148,11 +411,48 @@ def create_app(test_config=None):
     @requires_auth("delete:movies")
     def delete_movie(jwt, movie_id):
         try:
-            movie = Movie.query.get(movie_id)
-            if movie is None:
+            delete_row(Movie, movie_id, if_match_versions())
+            return jsonify({"success": True, "deleted": movie_id})
+        except Exception as e:
+            x = str(e)[:3]
+            abort(int(x))
+
+    @app.route("/movies/bulk", methods=["POST"])
+    @requires_auth("add:movies")
+    def create_movies_bulk(jwt):
+        return bulk_create_response(Movie, request.get_json(), "movies")
+
+    @app.route("/movies/bulk", methods=["PATCH"])
+    @requires_auth("patch:movies")
+    def modify_movies_bulk(jwt):
+        return bulk_update_response(Movie, request.get_json(), "movies")
+
+    @app.route("/movies/bulk", methods=["DELETE"])
+    @requires_auth("delete:movies")
+    def delete_movies_bulk(jwt):
+        return bulk_delete_response(Movie, request.get_json())
+
+    @app.route("/imports/actors", methods=["POST"])
+    @requires_auth("add:actors")
+    def import_actors(jwt):
+        return create_import_response(app, "actors", jwt)
+
+    @app.route("/imports/movies", methods=["POST"])
+    @requires_auth("add:movies")
+    def import_movies(jwt):
+        return create_import_response(app, "movies", jwt)
+
+    @app.route("/imports/<int:import_id>")
+    @requires_auth()
+    def get_import(jwt, import_id):
+        try:
+            job = ImportJob.query.get(import_id)
+            if job is None:
                 abort(404)
-            movie.delete()
-            return jsonify({"success": True, "deleted": movie.id})
+            # progress and row errors are for those allowed to add the rows
+            if not check_permissions("add:{}".format(job.resource), jwt):
+                abort(403)
+            return json_response({"success": True, "import": format_job(job)})
         except Exception as e:
             x = str(e)[:3]
             abort(int(x))
@@ -206,6 +506,15 @@ def create_app(test_config=None):
             422,
         )
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify(
+            {"success": False, "error": 429, "message": "Too many requests"}
+        )
+        if error.retry_after:
+            response.headers["Retry-After"] = str(error.retry_after)
+        return response, 429
+
     @app.errorhandler(500)
     def server_error(error):
         return (
@@ -227,7 +536,29 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
+def warm_up(app):
+    """
+    Does the work every worker would otherwise repeat on its first requests:
+    the deferred imports, the JWKS fetch and the engine creation. Run once
+    in the gunicorn master with --preload, the forked workers inherit it;
+    connections are not opened, they could not be shared across the fork.
+    """
+    auth.warm_up()
+    with app.app_context():
+        db.get_engine()
+
+
+def __getattr__(name):
+    # "gunicorn flaskr:app" and "flask run" build the app on first access,
+    # importing the package (tests, scripts) does not
+    global app
+    if name == "app":
+        app = create_app()
+        if PRELOAD_APP:
+            warm_up(app)
+        return app
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    create_app().run(host="0.0.0.0", port=8080, debug=True)
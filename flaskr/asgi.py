@@ -0,0 +1,93 @@
+import os
+import threading
+from uvicorn.middleware.wsgi import WSGIMiddleware, WSGIResponder
+from . import app as flask_app
+from .database.pool import DB_POOL_SIZE, DB_MAX_OVERFLOW
+
+# requests of one worker running at the same time; by default as many as the
+# pool has connections, more threads would only wait for one
+ASGI_THREADS = int(os.getenv("ASGI_THREADS", DB_POOL_SIZE + DB_MAX_OVERFLOW))
+# chunks of a streamed response produced ahead of what the client has taken
+QUEUED_CHUNKS = 8
+
+
+class StreamingResponder(WSGIResponder):
+    """
+    uvicorn's responder with two changes for the streamed exports: the WSGI
+    iterable is closed once sent, which is when Flask tears down the app
+    context of a streamed response and returns its database connection, and
+    the handler runs at most QUEUED_CHUNKS chunks ahead of the client instead
+    of queueing the whole body in memory.
+
+    It overrides internals of the WSGIResponder of uvicorn 0.13.4, the version
+    pinned in requirements.txt: the send_queue, send_event and loop attributes,
+    and __call__ running wsgi in the executor and sender on the loop.
+    ASGITestCase.test_uvicorn_responder_internals fails when an upgrade
+    changes them.
+    """
+
+    def __init__(self, app, executor, scope):
+        super().__init__(app, executor, scope)
+        self.room = threading.Semaphore(QUEUED_CHUNKS)
+
+    async def sender(self, send):
+        try:
+            while True:
+                if self.send_queue:
+                    message = self.send_queue.pop(0)
+                    if message is None:
+                        return
+                    await send(message)
+                    if message.get("more_body"):
+                        self.room.release()
+                else:
+                    await self.send_event.wait()
+                    self.send_event.clear()
+        finally:
+            # never leave the handler waiting for room
+            self.room.release(QUEUED_CHUNKS)
+
+    def wsgi(self, environ, start_response):
+        chunks = self.app(environ, start_response)
+        try:
+            for chunk in chunks:
+                self.room.acquire()
+                self.send_queue.append(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+                self.loop.call_soon_threadsafe(self.send_event.set)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        self.send_queue.append({"type": "http.response.body", "body": b""})
+        self.loop.call_soon_threadsafe(self.send_event.set)
+
+
+class ASGIApp(WSGIMiddleware):
+    """
+    uvicorn's WSGI adapter, serving the Flask app to an ASGI server. It is
+    only an adapter: the event loop holds the open connections and does the
+    socket I/O, but each request still runs the synchronous Flask handler,
+    token verification and database calls included, on one of max_workers
+    threads from start to end.
+    """
+
+    def __init__(self, wsgi_app, max_workers=ASGI_THREADS):
+        def app(environ, start_response):
+            # WSGI wants the port as a string, uvicorn passes the int of the scope
+            environ["SERVER_PORT"] = str(environ["SERVER_PORT"])
+            # the body is read in full, so its length is known even for
+            # chunked requests, which Werkzeug would otherwise read as empty
+            environ["CONTENT_LENGTH"] = str(environ["wsgi.input"].getbuffer().nbytes)
+            return wsgi_app(environ, start_response)
+
+        super().__init__(app, workers=max_workers)
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        await StreamingResponder(self.app, self.executor, scope)(receive, send)
+
+
+# ASGI entry point next to the WSGI flaskr:app, e.g.
+# gunicorn -k uvicorn.workers.UvicornWorker flaskr.asgi:app
+app = ASGIApp(flask_app)
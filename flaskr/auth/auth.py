@@ -1,9 +1,12 @@
-import json
 import os
-from urllib.request import urlopen
+import time
 from functools import wraps
-from jose import jwt
 from flask import request, abort
+from .jwks import JWKSKeyStore, url_fetcher
+from .token_cache import TokenCache
+from .policy import PermissionPolicy
+from .rate_limit import MemoryBuckets, RateLimiter
+from ..metrics import timed
 
 
 ASSISTANT_TOKEN = os.getenv('ASSISTANT_TOKEN')
@@ -14,6 +17,14 @@ AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = os.getenv('ALGORITHMS')
 API_AUDIENCE = os.getenv('API_AUDIENCE')
 
+jwks_store = JWKSKeyStore(url_fetcher(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'))
+token_cache = TokenCache()
+rate_limiter = RateLimiter(MemoryBuckets())
+policy = PermissionPolicy()
+
+# longer bearer tokens are rejected without being decoded
+MAX_TOKEN_LENGTH = int(os.getenv('MAX_TOKEN_LENGTH', 8192))
+
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
@@ -22,40 +33,88 @@ class AuthError(Exception):
     def __repr__(self):
         return 'class'+str(self.error)+" code "+str(self.status_code)+' what'
 
+# the errors raised on every request are built once
+MISSING_HEADER = {
+    'code': 'invalid_header',
+    'description': 'Authorization header not present'
+}
+HEADER_LENGTH = {
+    'code': 'invalid_header',
+    'description': 'Error with authorization header length.'
+}
+NOT_BEARER = {
+    'code': 'invalid_header',
+    'description': 'Authorization header doesnt start with bearer!'
+}
+NOT_PERMITTED = {
+    'code': 'invalid_header',
+    'description': 'The user doesnt have permissions to perform this step'
+}
+
 '''
  check_permissions(permission, payload) method
     @INPUTS
         permission: permission string (for example 'view:actors')
         payload: jwt payload /decoded/
-    return AuthError if permissions is not in the payload array; otherwise returns true
+    aborts with 400 if the payload has no permissions claim; otherwise returns whether policy grants
+    the permission, through its roles or a wildcard like 'view:*' too
 '''
 
-def check_permissions(permissions, payload):
+def check_permissions(permission, payload):
     if 'permissions' not in payload:
         abort(400)
-    if permissions not in payload['permissions']:
-        return False
-    return True
+    return policy.allows(payload, permission)
 
 def get_token_auth_header():
     auth_header = request.headers.get('Authorization', None)
     if auth_header is None:
+        raise AuthError(MISSING_HEADER, 401)
+    scheme, separator, auth_token = auth_header.partition(' ')
+    if not separator or ' ' in auth_token:
+        raise AuthError(HEADER_LENGTH, 401)
+    if scheme.lower() != 'bearer':
+        raise AuthError(NOT_BEARER, 401)
+    return auth_token
+
+'''
+check_unverified_token(token) method
+    @INPUTS
+        token: JWT auth token (string)
+
+    returns the unverified header of the token after the checks which need no key nor signature:
+    size, structure, kid present and exp not passed; otherwise returns AuthError
+    runs before the JWKS lookup and the RSA verification, so malformed or expired tokens cost neither
+'''
+
+def check_unverified_token(auth_token):
+    # jose takes longer to import than the rest of the package, so it is imported on the
+    # first token rather than with the app (see warm_up)
+    from jose import jwt
+    if len(auth_token) > MAX_TOKEN_LENGTH or auth_token.count('.') != 2:
         raise AuthError({
             'code': 'invalid_header',
-            'description': 'Authorization header not present'
+            'description': 'Authorization malformed.'
         }, 401)
-    auth_header = auth_header.split(' ')
-    if len(auth_header) != 2:
+    try:
+        unverified_header = jwt.get_unverified_header(auth_token)
+        unverified_claims = jwt.get_unverified_claims(auth_token)
+    except Exception:
         raise AuthError({
             'code': 'invalid_header',
-            'description': 'Error with authorization header length.'
+            'description': 'Authorization malformed.'
         }, 401)
-    if auth_header[0].lower() != 'bearer':
+    if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
-            'description': 'Authorization header doesnt start with bearer!'
+            'description': 'Authorization malformed.'
+        }, 401)
+    exp = unverified_claims.get('exp')
+    if isinstance(exp, (int, float)) and exp <= time.time():
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'The auth token is expired.'
         }, 401)
-    return auth_header[1]
+    return unverified_header
 
 '''
 verify_decode_jwt(token) method
@@ -67,34 +126,21 @@ verify_decode_jwt(token) method
 '''
 
 def verify_decode_jwt(auth_token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    unverified_header = jwt.get_unverified_header(auth_token)
-    rsa_key = {}
-    jwks = json.loads(jsonurl.read())
-    if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
+    from jose import jwt
+    unverified_header = check_unverified_token(auth_token)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    with timed('jwks'):
+        rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
-            payload = jwt.decode(
-                auth_token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with timed('jwt_decode'):
+                payload = jwt.decode(
+                    auth_token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer=f'https://{AUTH0_DOMAIN}/'
+                )
 
             return payload
 
@@ -120,25 +166,83 @@ def verify_decode_jwt(auth_token):
     }, 401)
     return unverified_header
 
+'''
+warm_up() method
+    imports jose and loads the signing keys now instead of on the first request, e.g. once in the
+    gunicorn master before it forks the workers; a provider down at that point is retried on demand
+'''
+
+def warm_up():
+    from jose import jwt
+    try:
+        jwks_store.load()
+    except Exception:
+        pass
+
+'''
+configure_jwks(fetcher, ttl, min_refresh_interval) method
+    @INPUTS
+        fetcher: callable returning the JWKS document (see auth/jwks.py for url and file fetchers)
+        ttl: seconds the fetched keys are trusted before being reloaded
+        min_refresh_interval: minimum seconds between refetches caused by an unknown kid
+
+    replaces the process wide key store, e.g. to point the tests at a local JWKS file
+'''
+
+def configure_jwks(fetcher, **kwargs):
+    global jwks_store
+    jwks_store = JWKSKeyStore(fetcher, **kwargs)
+    return jwks_store
+
+'''
+configure_rate_limiter(backend, ip_limit, limits, proxies) method
+    @INPUTS
+        backend: MemoryBuckets or SharedBuckets (see auth/rate_limit.py)
+        ip_limit: (rate, burst) of every client address, None for unlimited
+        limits: {action: (rate, burst)} of every token subject, per permission action
+        proxies: number of proxies appending to X-Forwarded-For in front of the app
+
+    replaces the process wide rate limiter, e.g. to share the buckets of all workers
+'''
+
+def configure_rate_limiter(backend, **kwargs):
+    global rate_limiter
+    rate_limiter = RateLimiter(backend, **kwargs)
+    return rate_limiter
+
 '''
 @requires_auth(permission) decorator method
     @INPUTS
-        permission: permission string (i.e. 'view:actors')
+        permission: permission string (i.e. 'view:actors'), None to only authenticate
+            the token, for routes whose permission depends on the row (they call check_permissions)
     returns the decorator which passes the decoded payload to the decorated method after getting, verifying and checking permissions
+    verified tokens are kept in token_cache until shortly before they expire, so a repeated token skips the signature check
+    rate_limiter is checked for the client address first, and for the token subject and permission once verified
+    the permission is numbered by policy when the route is registered, so checking it against the bitset
+    compiled once per cached token costs the same for any number of permissions
+    the time spent is reported to /metrics as the auth phase, split into auth_header, jwks and jwt_decode
+    without a permission the request counts as a 'view' for the rate limiter, as the routes doing so only read
 '''
 
-def requires_auth(permission=''):
+def requires_auth(permission=None):
     def requires_auth_decorator(f):
+        required = None if permission is None else policy.require(permission)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
-            auth_token = get_token_auth_header()
-            payload = verify_decode_jwt(auth_token)
-            if not check_permissions(permission, payload):
-                raise AuthError({
-                    'code': 'invalid_header',
-                    'description': 'The user doesnt have permissions to perform this step'
-                }, 401)
-            return f(payload, *args, **kwargs)
+            with timed('auth'):
+                rate_limiter.check_address()
+                with timed('auth_header'):
+                    auth_token = get_token_auth_header()
+                verified = token_cache.get(auth_token)
+                if verified is None:
+                    verified = token_cache.put(auth_token, verify_decode_jwt(auth_token))
+                if 'permissions' not in verified.payload:
+                    abort(400)
+                if required is not None and not verified.has_permission(required, policy):
+                    raise AuthError(NOT_PERMITTED, 401)
+                rate_limiter.check_subject(verified.payload, permission or 'view')
+            return f(verified.payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
 
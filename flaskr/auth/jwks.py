@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+
+JWKS_TTL = int(os.getenv('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', 30))
+
+'''
+ url_fetcher(url) / file_fetcher(path) methods
+    @INPUTS
+        url / path: location of the JWKS document
+    return a callable with no arguments which loads and returns the parsed JWKS document
+'''
+
+def url_fetcher(url, timeout=5):
+    def fetch():
+        with urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read())
+    return fetch
+
+
+def file_fetcher(path):
+    def fetch():
+        with open(path) as jwks_file:
+            return json.load(jwks_file)
+    return fetch
+
+
+class JWKSKeyStore:
+    '''
+    In-process store of the signing keys published by the identity provider, keyed by kid.
+    The document is fetched once and kept for `ttl` seconds. A token signed with an
+    unknown kid triggers a refetch, but at most once per `min_refresh_interval` seconds,
+    so a flood of forged kids cannot be turned into a flood of requests to the provider.
+    '''
+
+    def __init__(self, fetcher, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, clock=time.monotonic):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+        self._keys = {}
+        self._loaded_at = None
+        self._last_fetch_at = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.fetch_errors = 0
+
+    def _is_fresh(self, now):
+        return self._loaded_at is not None and now - self._loaded_at < self.ttl
+
+    def _can_refetch(self, now):
+        return self._last_fetch_at is None or \
+            now - self._last_fetch_at >= self.min_refresh_interval
+
+    def _fetch(self, now):
+        self._last_fetch_at = now
+        self.fetches += 1
+        try:
+            jwks = self.fetcher()
+        except Exception:
+            self.fetch_errors += 1
+            # keep serving the keys we already have if the provider is unavailable
+            if self._keys:
+                return
+            raise
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        self._keys = keys
+        self._loaded_at = now
+
+    def get_key(self, kid):
+        with self._lock:
+            now = self.clock()
+            if self._is_fresh(now) and kid in self._keys:
+                self.hits += 1
+                return self._keys[kid]
+            self.misses += 1
+            if self._can_refetch(now):
+                self._fetch(now)
+            return self._keys.get(kid)
+
+    def load(self):
+        '''Fetches the keys now instead of on the first lookup'''
+        with self._lock:
+            self._fetch(self.clock())
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._loaded_at = None
+            self._last_fetch_at = None
+
+    def stats(self):
+        return {
+            'keys': len(self._keys),
+            'hits': self.hits,
+            'misses': self.misses,
+            'fetches': self.fetches,
+            'fetch_errors': self.fetch_errors
+        }
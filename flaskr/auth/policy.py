@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+
+
+# claim listing the roles of a token, next to the permissions claim; Auth0 only adds
+# custom claims whose name is a namespace URL
+ROLES_CLAIM = os.getenv('ROLES_CLAIM', 'https://casting-agency/roles')
+POLICY_CACHE_SIZE = int(os.getenv('POLICY_CACHE_SIZE', 1024))
+
+ASSISTANT = ('view:actors', 'view:movies')
+DIRECTOR = ASSISTANT + ('add:actors', 'delete:actors', 'patch:actors', 'patch:movies')
+PRODUCER = DIRECTOR + ('add:movies', 'delete:movies')
+DEFAULT_ROLES = {
+    'assistant': ASSISTANT,
+    'director': DIRECTOR,
+    'producer': PRODUCER
+}
+
+
+def parse_roles(value):
+    '''
+    {role: permissions} from PERMISSION_ROLES, a JSON object of permission lists, e.g.
+    {"assistant": ["view:actors", "view:movies"]}; DEFAULT_ROLES when empty
+    '''
+    if not value:
+        return DEFAULT_ROLES
+    return {role: tuple(permissions) for role, permissions in json.loads(value).items()}
+
+
+ROLES = parse_roles(os.getenv('PERMISSION_ROLES'))
+
+
+def covering(permission):
+    '''
+    The granted permissions which cover permission: '*', the permission itself, and for
+    each of its parents both the parent and its wildcard, e.g. 'view', 'view:*',
+    'view:movies' and 'view:movies:*' for 'view:movies:drama'.
+    '''
+    parts = permission.split(':')
+    permissions = {'*', permission}
+    for end in range(1, len(parts)):
+        parent = ':'.join(parts[:end])
+        permissions.update((parent, parent + ':*'))
+    return frozenset(permissions)
+
+
+class PermissionPolicy:
+    '''
+    Numbers the permissions in the order they are first required (requires_auth does it
+    when a route is registered), so the permissions granted to a token compile to an int
+    bitset and checking one is a single AND, however many permissions the token holds.
+
+    Compiled bitsets are cached by the permissions and roles claims they come from, so
+    all the tokens of a role share one. A newly required permission bumps version and
+    empties the cache, as the earlier bitsets lack its bit.
+    '''
+
+    def __init__(self, roles=ROLES, roles_claim=ROLES_CLAIM, maxsize=POLICY_CACHE_SIZE):
+        self.roles = {role: tuple(permissions) for role, permissions in roles.items()}
+        self.roles_claim = roles_claim
+        self.maxsize = maxsize
+        self.version = 0
+        self._bits = {}
+        self._covering = {}
+        self._compiled = {}
+        self._lock = threading.Lock()
+        self.compilations = 0
+
+    def require(self, permission):
+        '''bit of permission, numbering it if it was never required before'''
+        bit = self._bits.get(permission)
+        if bit is not None:
+            return bit
+        with self._lock:
+            bit = self._bits.get(permission)
+            if bit is None:
+                bit = 1 << len(self._bits)
+                self._covering[permission] = covering(permission)
+                self._bits[permission] = bit
+                self._compiled = {}
+                self.version += 1
+        return bit
+
+    def granted(self, payload):
+        '''permissions of the token: its permissions claim plus those of its roles'''
+        granted = set(payload.get('permissions') or ())
+        for role in payload.get(self.roles_claim) or ():
+            granted.update(self.roles.get(role, ()))
+        return granted
+
+    def compile(self, payload):
+        '''bitset of the required permissions which the token of payload is granted'''
+        key = (tuple(payload.get('permissions') or ()), tuple(payload.get(self.roles_claim) or ()))
+        compiled = self._compiled
+        bits = compiled.get(key)
+        if bits is not None:
+            return bits
+        granted = self.granted(payload)
+        bits = 0
+        for permission, bit in list(self._bits.items()):
+            if not granted.isdisjoint(self._covering[permission]):
+                bits |= bit
+        with self._lock:
+            self.compilations += 1
+            # a permission required meanwhile replaced the cache, this bitset may lack it
+            if compiled is self._compiled:
+                if len(compiled) >= self.maxsize:
+                    compiled.clear()
+                compiled[key] = bits
+        return bits
+
+    def allows(self, payload, permission):
+        bit = self.require(permission)
+        return self.compile(payload) & bit == bit
+
+    def stats(self):
+        return {
+            'permissions': len(self._bits),
+            'size': len(self._compiled),
+            'maxsize': self.maxsize,
+            'compilations': self.compilations
+        }
@@ -0,0 +1,162 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+
+
+def parse_limit(value):
+    '''
+    "rate:burst" to (rate, burst): a bucket refilled with rate tokens per second holding
+    at most burst tokens. Empty means unlimited (None).
+    '''
+    if not value.strip():
+        return None
+    rate, _, burst = value.partition(':')
+    rate = float(rate)
+    return rate, float(burst or rate)
+
+
+def parse_limits(value):
+    '''"view=20:40,delete=1:5" to {'view': (20.0, 40.0), 'delete': (1.0, 5.0)}'''
+    limits = {}
+    for item in value.split(','):
+        if item.strip():
+            action, _, limit = item.partition('=')
+            limits[action.strip()] = parse_limit(limit)
+    return limits
+
+
+# every request of a client address, checked before its token is even looked at
+RATE_LIMIT_IP = parse_limit(os.getenv('RATE_LIMIT_IP', ''))
+# requests of one token subject per permission action (view, add, patch, delete, * for
+# the others), checked once the token is verified
+RATE_LIMITS = parse_limits(os.getenv('RATE_LIMITS', ''))
+# proxies in front of the app appending to X-Forwarded-For (1 on Heroku), 0 uses the
+# peer address
+RATE_LIMIT_PROXIES = int(os.getenv('RATE_LIMIT_PROXIES', 0))
+RATE_LIMIT_KEYS = int(os.getenv('RATE_LIMIT_KEYS', 100000))
+
+
+class MemoryBuckets:
+    '''
+    Token buckets of this worker only, so every gunicorn worker grants the full limit.
+    At most maxsize buckets are kept, the least recently used are dropped first; a
+    dropped bucket comes back full, which a bucket idle for burst / rate seconds is anyway.
+    '''
+
+    def __init__(self, maxsize=RATE_LIMIT_KEYS, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''Takes a token from bucket key; returns 0, or the seconds until a token is available'''
+        with self._lock:
+            now = self.clock()
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+'''
+same arithmetic as MemoryBuckets.take, run atomically by redis; the bucket expires once
+it would be full again
+'''
+TAKE_SCRIPT = '''
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+class SharedBuckets:
+    '''
+    Token buckets shared by all workers. client only needs the redis-py method
+    eval(script, numkeys, *keys_and_args), so a redis.Redis instance can be passed as is.
+    One round trip per bucket; the workers' clocks are assumed to agree.
+    '''
+
+    def __init__(self, client, prefix='casting-agency:rate-limit:', clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+
+    def take(self, key, rate, burst):
+        return float(self.client.eval(TAKE_SCRIPT, 1, self.prefix + key, rate, burst, self.clock()))
+
+    def clear(self):
+        pass
+
+
+class RateLimiter:
+    '''
+    Per client address and per (token subject, permission action) token buckets. Raises
+    TooManyRequests, answered with 429 and Retry-After, when the bucket is empty. Every
+    check is one bucket lookup, whatever the number of clients.
+    '''
+
+    def __init__(self, backend, ip_limit=RATE_LIMIT_IP, limits=RATE_LIMITS,
+                 proxies=RATE_LIMIT_PROXIES):
+        self.backend = backend
+        self.ip_limit = ip_limit
+        self.limits = limits
+        self.proxies = proxies
+        self.allowed = 0
+        self.limited = 0
+
+    def client_address(self):
+        route = request.access_route if self.proxies else [request.remote_addr]
+        if len(route) >= self.proxies:
+            return route[-self.proxies or -1]
+        return route[0]
+
+    def check(self, key, limit):
+        if limit is None:
+            return
+        wait = self.backend.take(key, *limit)
+        if wait:
+            self.limited += 1
+            raise TooManyRequests(retry_after=math.ceil(wait))
+        self.allowed += 1
+
+    def check_address(self):
+        self.check('ip:{}'.format(self.client_address()), self.ip_limit)
+
+    def check_subject(self, payload, permission):
+        action = permission.split(':')[0]
+        limit = self.limits.get(action, self.limits.get('*'))
+        self.check('sub:{}:{}'.format(payload.get('sub'), action), limit)
+
+    def stats(self):
+        return {
+            'allowed': self.allowed,
+            'limited': self.limited
+        }
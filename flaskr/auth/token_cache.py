@@ -0,0 +1,100 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_MARGIN = int(os.getenv('TOKEN_CACHE_MARGIN', 30))
+
+
+class VerifiedToken:
+    '''
+    Decoded payload of a token whose signature and claims were already verified,
+    together with the bitset of its permissions compiled by the policy.
+    '''
+
+    def __init__(self, payload, expires_at):
+        self.payload = payload
+        self.expires_at = expires_at
+        self.grants = 0
+        self.version = None
+
+    def has_permission(self, bit, policy):
+        # compiled on the first check, again only if the policy numbered new permissions since
+        if self.version != policy.version:
+            version = policy.version
+            self.grants = policy.compile(self.payload)
+            self.version = version
+        return self.grants & bit == bit
+
+
+class TokenCache:
+    '''
+    Bounded LRU of verified tokens keyed by the sha256 digest of the raw token, so the
+    bearer tokens themselves are never kept in memory. Entries are dropped `margin`
+    seconds before the token's exp claim; tokens without exp are never cached.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, margin=TOKEN_CACHE_MARGIN, clock=time.time):
+        self.maxsize = maxsize
+        self.margin = margin
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def digest(auth_token):
+        return hashlib.sha256(auth_token.encode()).digest()
+
+    def get(self, auth_token):
+        key = self.digest(auth_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at <= self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, auth_token, payload):
+        entry = VerifiedToken(payload, None)
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or self.maxsize <= 0:
+            return entry
+        entry.expires_at = exp - self.margin
+        if entry.expires_at <= self.clock():
+            return entry
+        key = self.digest(auth_token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
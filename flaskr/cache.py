@@ -0,0 +1,265 @@
+import datetime
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+from flask import Response, g, request
+from .database.replicas import REPLICA_STICKY_SECONDS
+from .serialization import dumps
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))
+# seconds clients may reuse a response without asking; 0 makes them revalidate
+# with If-None-Match / If-Modified-Since every time, which is cheap
+RESPONSE_MAX_AGE = int(os.getenv("RESPONSE_MAX_AGE", 0))
+
+
+class LRUBackend:
+    """
+    In-process backend. Each gunicorn worker keeps its own copy, so a write
+    handled by one worker only invalidates that worker's entries; the others
+    serve their copy for at most RESPONSE_CACHE_TTL seconds. Use SharedBackend
+    when that is not acceptable.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries = OrderedDict()
+        # counters are kept apart so evicting entries never resets a generation
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        expires_at = self.clock() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+
+
+class SharedBackend:
+    """
+    Backend over a store shared by all workers. client only needs the redis-py
+    methods get, set(key, value, ex=ttl), delete(*keys) and incr(key), so a
+    redis.Redis instance can be passed as is.
+    """
+
+    def __init__(self, client, prefix="casting-agency:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+
+class ResponseCache:
+    """
+    Caches serialized JSON responses of the read endpoints. List pages are
+    keyed by a per-resource generation which every write bumps, so a write to
+    movies drops all movie list pages but no actor ones; detail entries are
+    deleted by id. Entries carry an ETag, so a matching If-None-Match is
+    answered with 304 straight from the cache.
+
+    Writes also record when each resource last changed, sent as Last-Modified;
+    a matching If-Modified-Since is answered with 304 before the entry is even
+    looked up. The time of a write is rounded up to the second and only sent
+    once that second is over, so a later write always moves it forward.
+    """
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL, max_age=RESPONSE_MAX_AGE):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+
+    def generation(self, resource):
+        return self.backend.get("generation:" + resource) or 0
+
+    def list_key(self, *resources):
+        """Key of the current request's page, built from the generations of resources"""
+        g.cache_resources = resources
+        generations = ",".join(
+            "{}.{}".format(resource, self.generation(resource))
+            for resource in resources
+        )
+        query = urlencode(sorted(request.args.items(multi=True)))
+        return "{}:list:{}:{}".format(request.path, generations, query)
+
+    def detail_key(self, resource, id):
+        g.cache_resources = (resource,)
+        return self._detail_key(resource, id)
+
+    @staticmethod
+    def _detail_key(resource, id):
+        return "{}:detail:{}".format(resource, id)
+
+    def last_modified(self, resources):
+        """
+        Time of the last write to resources, as a timestamp in whole seconds.
+        Unknown times (the LRUBackend of another worker, an expired key) count
+        as now, which at worst costs a full response.
+        """
+        latest = 0
+        for resource in resources:
+            modified = self.backend.get("modified:" + resource)
+            if modified is None:
+                modified = math.ceil(time.time())
+                self.backend.set("modified:" + resource, modified, self.ttl)
+            latest = max(latest, modified)
+        return latest
+
+    def cache_headers(self, response, modified):
+        if self.max_age:
+            response.cache_control.max_age = self.max_age
+        else:
+            response.cache_control.no_cache = True
+        # the responses depend on the token's permissions
+        response.cache_control.private = True
+        if modified is not None:
+            response.last_modified = datetime.datetime.utcfromtimestamp(modified)
+        return response
+
+    def not_modified_since(self, modified):
+        """If-Modified-Since covers modified; If-None-Match takes precedence"""
+        since = request.if_modified_since
+        if since is None or request.if_none_match:
+            return False
+        return modified <= since.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def respond(self, key, build):
+        """
+        Returns the cached response stored under key, or calls build for the
+        payload dict, serializes it with serialization.dumps and caches the result.
+        build may return (payload, etag) to set the ETag instead of a body hash.
+        """
+        modified = None
+        resources = g.get("cache_resources")
+        if resources:
+            modified = self.last_modified(resources)
+            if modified > time.time():
+                modified = None
+            elif self.not_modified_since(modified):
+                self.not_modified += 1
+                return self.cache_headers(Response(status=304), modified)
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            payload = build()
+            etag = None
+            if isinstance(payload, tuple):
+                payload, etag = payload
+            body = dumps(payload).decode()
+            entry = {
+                "body": body,
+                "etag": etag or hashlib.sha1(body.encode()).hexdigest(),
+            }
+            ttl = self.ttl
+            # a replica may not have the write which bumped the generation
+            # yet, so its answer is only kept for about the replication lag
+            if g.get("db_replica") is not None:
+                ttl = min(ttl, REPLICA_STICKY_SECONDS)
+            self.backend.set(key, entry, ttl)
+            cache_status = "MISS"
+        else:
+            self.hits += 1
+            cache_status = "HIT"
+        # a replica may not have the last write yet, its answer is not
+        # necessarily as recent as Last-Modified would say
+        if g.get("db_replica") is not None:
+            modified = None
+        response = Response(entry["body"], mimetype="application/json")
+        response.set_etag(entry["etag"])
+        response.headers["X-Cache"] = cache_status
+        return self.cache_headers(response, modified).make_conditional(request)
+
+    def invalidate(self, resource, ids=()):
+        self.invalidations += 1
+        self.backend.incr("generation:" + resource)
+        self.backend.set("modified:" + resource, math.ceil(time.time()), self.ttl)
+        self.backend.delete(*[self._detail_key(resource, id) for id in ids])
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+        }
+
+
+response_cache = ResponseCache(LRUBackend())
+
+
+def configure_response_cache(backend, **kwargs):
+    global response_cache
+    response_cache = ResponseCache(backend, **kwargs)
+    return response_cache
+
+
+def respond(key, build):
+    return response_cache.respond(key, build)
+
+
+def list_key(*resources):
+    return response_cache.list_key(*resources)
+
+
+def detail_key(resource, id):
+    return response_cache.detail_key(resource, id)
+
+
+def invalidate(resource, ids=()):
+    response_cache.invalidate(resource, ids)
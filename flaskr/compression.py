@@ -0,0 +1,114 @@
+import os
+import zlib
+from flask import request
+from .metrics import timed
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+# smaller bodies are sent as they are, compressing them saves less than it costs
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+# 4 is about as fast as gzip level 6 and compresses JSON better
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 4))
+
+COMPRESSIBLE = {"application/json", "application/x-ndjson", "text/csv", "text/plain"}
+
+
+def accepted_encoding():
+    """br or gzip, whichever the client prefers (br on a tie), None for neither"""
+    accepted = request.accept_encodings
+    gzip_quality = accepted["gzip"]
+    if brotli is not None and accepted["br"] and accepted["br"] >= gzip_quality:
+        return "br"
+    return "gzip" if gzip_quality else None
+
+
+class Compressor:
+    """Incremental gzip or brotli compression of a body written in chunks"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(
+                GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """What is buffered so far, decodable by the client on its own"""
+        if self.encoding == "br":
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(data, encoding):
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compresses a streamed body chunk by chunk, flushing after each one so
+    the client gets every chunk when it is produced, not when the compressor
+    buffer fills up. Costs a few bytes per chunk, the export chunks hold
+    EXPORT_BATCH_SIZE rows.
+    """
+    compressor = Compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def setup_compression(app):
+    """
+    Compresses the JSON and NDJSON responses of app with the encoding the
+    client accepts: whole bodies from COMPRESS_MIN_SIZE bytes on, streamed
+    ones chunk by chunk. A compressed body has other bytes than the one its
+    ETag was computed on, so the ETag becomes weak, the If-None-Match
+    comparison is weak anyway.
+    """
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.mimetype not in COMPRESSIBLE
+            or response.status_code != 200
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = accepted_encoding()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = compress_chunks(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            body = response.get_data()
+            if len(body) < COMPRESS_MIN_SIZE:
+                return response
+            with timed("compress"):
+                response.set_data(compress(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,179 @@
+import os
+from flask import abort, jsonify
+from sqlalchemy import bindparam
+from ..cache import invalidate
+from .models import db
+from .validation import validate
+
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 1000))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", 50000))
+
+
+def chunked(items, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield start, items[start : start + size]
+
+
+def validate_batch(model, items, partial=False):
+    """
+    Validates every item before anything is written. Returns (rows, errors):
+    rows are the converted values, errors a list of {"index", "errors"} for the
+    items that failed. For partial (PATCH) batches every item needs an int id.
+    """
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        values, item_errors = validate(model, item, partial)
+        if partial and isinstance(item, dict):
+            if not isinstance(item.get("id"), int) or isinstance(item.get("id"), bool):
+                item_errors["id"] = "must be an integer"
+            elif not values:
+                item_errors["_schema"] = "nothing to update"
+            values["id"] = item.get("id")
+        if item_errors:
+            errors.append({"index": index, "errors": item_errors})
+        rows.append(values)
+    return rows, errors
+
+
+def _existing_ids(model, ids):
+    return {
+        row.id for row in db.session.query(model.id).filter(model.id.in_(ids)).all()
+    }
+
+
+def _run_chunk(model, results, start, chunk, write):
+    """Writes one chunk in its own transaction; a failure only fails its items"""
+    try:
+        chunk_results = write(chunk)
+        db.session.commit()
+        invalidate(
+            model.__tablename__,
+            [result["id"] for result in chunk_results if result["success"]],
+        )
+    except Exception:
+        db.session.rollback()
+        chunk_results = [
+            {"success": False, "error": 422, "message": "Request cant be processed"}
+            for _ in chunk
+        ]
+    for offset, result in enumerate(chunk_results):
+        result["index"] = start + offset
+        results.append(result)
+
+
+def bulk_insert(model, rows, chunk_size=BULK_CHUNK_SIZE):
+    def write(chunk):
+        # return_defaults fetches the new ids; dialects supporting executemany
+        # with RETURNING (psycopg2) still send one statement per chunk
+        db.session.bulk_insert_mappings(model, chunk, return_defaults=True)
+        return [{"success": True, "id": row["id"]} for row in chunk]
+
+    results = []
+    for start, chunk in chunked(rows, chunk_size):
+        _run_chunk(model, results, start, chunk, write)
+    return results
+
+
+def bulk_update(model, rows, chunk_size=BULK_CHUNK_SIZE):
+    def write(chunk):
+        existing = _existing_ids(model, [row["id"] for row in chunk])
+        # one executemany per set of updated columns, each bumping the version
+        table = model.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == bindparam("_id"))
+            .values(version=table.c.version + 1)
+        )
+        groups = {}
+        for row in chunk:
+            if row["id"] in existing:
+                params = {key: value for key, value in row.items() if key != "id"}
+                params["_id"] = row["id"]
+                groups.setdefault(tuple(sorted(params)), []).append(params)
+        for params in groups.values():
+            db.session.execute(statement, params)
+        return [
+            (
+                {"success": True, "id": row["id"]}
+                if row["id"] in existing
+                else {"success": False, "id": row["id"], "error": 404}
+            )
+            for row in chunk
+        ]
+
+    results = []
+    for start, chunk in chunked(rows, chunk_size):
+        _run_chunk(model, results, start, chunk, write)
+    return results
+
+
+def bulk_delete(model, ids, chunk_size=BULK_CHUNK_SIZE):
+    def write(chunk):
+        existing = _existing_ids(model, chunk)
+        if existing:
+            model.query.filter(model.id.in_(existing)).delete(synchronize_session=False)
+        return [
+            (
+                {"success": True, "id": id}
+                if id in existing
+                else {"success": False, "id": id, "error": 404}
+            )
+            for id in chunk
+        ]
+
+    results = []
+    for start, chunk in chunked(ids, chunk_size):
+        _run_chunk(model, results, start, chunk, write)
+    return results
+
+
+def read_batch(data, key):
+    if not isinstance(data, dict) or not isinstance(data.get(key), list):
+        abort(400)
+    if len(data[key]) == 0:
+        abort(400)
+    if len(data[key]) > BULK_MAX_ITEMS:
+        abort(422)
+    return data[key]
+
+
+def batch_response(results):
+    return jsonify(
+        {"success": all(result["success"] for result in results), "results": results}
+    )
+
+
+def invalid_batch_response(errors):
+    return (
+        jsonify(
+            {"success": False, "error": 400, "message": "Bad request", "errors": errors}
+        ),
+        400,
+    )
+
+
+def bulk_create_response(model, data, key):
+    rows, errors = validate_batch(model, read_batch(data, key))
+    if errors:
+        return invalid_batch_response(errors)
+    return batch_response(bulk_insert(model, rows))
+
+
+def bulk_update_response(model, data, key):
+    rows, errors = validate_batch(model, read_batch(data, key), partial=True)
+    if errors:
+        return invalid_batch_response(errors)
+    return batch_response(bulk_update(model, rows))
+
+
+def bulk_delete_response(model, data):
+    ids = read_batch(data, "ids")
+    errors = [
+        {"index": index, "errors": {"id": "must be an integer"}}
+        for index, id in enumerate(ids)
+        if not isinstance(id, int) or isinstance(id, bool)
+    ]
+    if errors:
+        return invalid_batch_response(errors)
+    return batch_response(bulk_delete(model, ids))
@@ -0,0 +1,115 @@
+from flask import abort
+from sqlalchemy import tuple_
+from .models import db, Actor, Movie, changes
+from .queries import (
+    DEFAULT_PAGE_SIZE,
+    LIST_FIELDS,
+    MAX_PAGE_SIZE,
+    format_row,
+    parse_int,
+)
+
+RESOURCES = {"actors": Actor, "movies": Movie}
+
+
+def parse_cursor(value):
+    """?since=<tx>.<id>, the next_cursor of an earlier page; missing is the start"""
+    if not value:
+        return 0, 0
+    tx, _, id = value.partition(".")
+    try:
+        cursor = int(tx), int(id)
+    except ValueError:
+        abort(400)
+    if min(cursor) < 0:
+        abort(400)
+    return cursor
+
+
+def format_cursor(tx, id):
+    return "{}.{}".format(tx, id)
+
+
+def parse_resources(args, allowed):
+    """?resource=actors|movies, else every resource in allowed"""
+    value = args.get("resource")
+    if not value:
+        return allowed
+    if value not in RESOURCES:
+        abort(400)
+    if value not in allowed:
+        abort(403)
+    return [value]
+
+
+def attach_rows(events):
+    """Current fields of the rows of a page, one IN query per resource"""
+    for resource, model in RESOURCES.items():
+        by_id = {
+            event["id"]: event
+            for event in events
+            if event["resource"] == resource and not event["deleted"]
+        }
+        if not by_id:
+            continue
+        fields = LIST_FIELDS[model]
+        rows = (
+            db.session.query(*[getattr(model, field) for field in fields])
+            .filter(model.id.in_(by_id))
+            .all()
+        )
+        for row in rows:
+            by_id[row.id]["data"] = format_row(fields, row)
+    return events
+
+
+def change_feed(args, allowed):
+    """
+    One page of the actors and movies written since the cursor in args, in
+    write order, through the (tx, id) index: the work depends on the number of
+    changed rows, not on the catalog size. Returns the events, the cursor of
+    the next page (the same one when nothing changed) and whether more
+    changes are waiting.
+
+    On Postgres an entry gets its id when written, not when committed, so a
+    smaller id can become visible after a larger one. Entries are read in
+    (writing transaction, id) order, up to the oldest transaction still
+    running: every later commit then sorts after the returned cursor.
+    """
+    since = parse_cursor(args.get("since"))
+    limit = min(parse_int(args, "limit", DEFAULT_PAGE_SIZE, minimum=1), MAX_PAGE_SIZE)
+    resources = parse_resources(args, allowed)
+
+    query = db.session.query(
+        changes.c.tx,
+        changes.c.id,
+        changes.c.resource,
+        changes.c.row_id,
+        changes.c.deleted,
+        changes.c.changed_at,
+    ).filter(tuple_(changes.c.tx, changes.c.id) > since)
+    if len(resources) < len(RESOURCES):
+        query = query.filter(changes.c.resource.in_(resources))
+    if db.engine.dialect.name == "postgresql":
+        query = query.filter(
+            changes.c.tx < db.func.txid_snapshot_xmin(db.func.txid_current_snapshot())
+        )
+    entries = query.order_by(changes.c.tx, changes.c.id).limit(limit + 1).all()
+
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    events = [
+        {
+            "resource": entry.resource,
+            "id": entry.row_id,
+            "deleted": entry.deleted,
+            "changed_at": entry.changed_at,
+            # null for deleted rows
+            "data": None,
+        }
+        for entry in entries
+    ]
+    attach_rows(events)
+    if entries:
+        since = entries[-1].tx, entries[-1].id
+    return events, format_cursor(*since), has_more
@@ -1,46 +1,200 @@
+import datetime
 import os
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, Computed, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import deferred
+from sqlalchemy.sql.functions import FunctionElement
+from ..cache import invalidate
+from .pool import engine_options
+from .replicas import RoutingSQLAlchemy, DATABASE_REPLICA_URIS, replica_binds
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 DATABASE_URI = os.getenv("DATABASE_URI")
 
 
-def setup_db(app, database_path=DATABASE_URI):
+def setup_db(app, database_path=DATABASE_URI, replica_paths=DATABASE_REPLICA_URIS):
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = replica_binds(replica_paths)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
 
     db.app = app
     db.init_app(app)
 
 
+# the trigram indexes need pg_trgm; other databases get plain indexes instead.
+# create_all also visits the replica binds, which get no tables and are read only
+event.listen(
+    db.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(
+        dialect="postgresql",
+        callable_=lambda ddl, target, bind, tables=None, **kw: bool(tables),
+    ),
+)
+
+
 def create_and_drop_all():
     # db.drop_all()
     db.create_all()
 
 
 def setup_migrations(app):
+    # alembic, mako and pygments behind it take longer to import than the
+    # rest of the app, and only the flask db commands need them
+    from flask_migrate import Migrate
+
     migrate = Migrate(app, db)
 
 
+class search_document(FunctionElement):
+    """
+    Text searched by /search: a tsvector on Postgres, lowercased text elsewhere
+    (the SQLite fallback the tests run on). Used as a generated column, so the
+    database keeps it current on every insert and update, bulk writes included.
+    """
+
+    inherit_cache = True
+    name = "search_document"
+
+
+@compiles(search_document)
+def compile_search_document(element, compiler, **kw):
+    columns = [compiler.process(column, **kw) for column in element.clauses]
+    return "lower({})".format(" || ' ' || ".join(columns))
+
+
+@compiles(search_document, "postgresql")
+def compile_search_document_postgresql(element, compiler, **kw):
+    columns = [
+        "coalesce({}, '')".format(compiler.process(column, **kw))
+        for column in element.clauses
+    ]
+    return "to_tsvector('simple', {})".format(" || ' ' || ".join(columns))
+
+
+def search_vector_column(*columns):
+    return deferred(
+        db.Column(
+            db.Text().with_variant(TSVECTOR(), "postgresql"),
+            Computed(search_document(*[db.column(column) for column in columns])),
+        )
+    )
+
+
+class utc_now(FunctionElement):
+    """
+    Current UTC time as a naive timestamp, like datetime.utcnow: now() on
+    Postgres is in the server's time zone, CURRENT_TIMESTAMP on SQLite is UTC.
+    """
+
+    inherit_cache = True
+    name = "utc_now"
+    type = db.DateTime()
+
+
+@compiles(utc_now)
+def compile_utc_now(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utc_now, "postgresql")
+def compile_utc_now_postgresql(element, compiler, **kw):
+    return "timezone('utc', now())"
+
+
+def timestamp_column(**kwargs):
+    # UTC, set by SQLAlchemy on ORM, Core and bulk writes alike; the server
+    # default only fills rows written outside of it
+    return db.Column(
+        db.DateTime(),
+        nullable=False,
+        default=datetime.datetime.utcnow,
+        server_default=utc_now(),
+        **kwargs,
+    )
+
+
+castings = db.Table(
+    "castings",
+    db.Column(
+        "movie_id",
+        db.Integer(),
+        db.ForeignKey("movies.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    db.Column(
+        "actor_id",
+        db.Integer(),
+        db.ForeignKey("actors.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    db.Index("ix_castings_actor_id", "actor_id"),
+)
+
+
 class Movie(db.Model):
     __tablename__ = "movies"
+    __table_args__ = (
+        db.Index("ix_movies_genre_id", "genre", "id"),
+        db.Index("ix_movies_release_date", "release_date"),
+        db.Index("ix_movies_search_vector", "search_vector", postgresql_using="gin"),
+        db.Index(
+            "ix_movies_title_trgm",
+            "title",
+            postgresql_using="gin",
+            postgresql_ops={"title": "gin_trgm_ops"},
+        ),
+    )
     id = db.Column(db.Integer(), primary_key=True)
     title = db.Column(db.String(), nullable=False)
     release_date = db.Column(db.Date(), nullable=False)
     genre = db.Column(db.String(), nullable=False, default="")
+    # bumped by every write, sent as the ETag matched by If-Match
+    version = db.Column(db.Integer(), nullable=False, default=1, server_default="1")
+    created_at = timestamp_column()
+    updated_at = timestamp_column(onupdate=datetime.datetime.utcnow)
+    search_vector = search_vector_column("title", "genre")
+    actors = db.relationship(
+        "Actor", secondary=castings, back_populates="movies", order_by="Actor.id"
+    )
 
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        invalidate(self.__tablename__)
 
     def update(self):
+        id = self.id
         db.session.commit()
+        invalidate(self.__tablename__, [id])
 
     def delete(self):
+        id = self.id
         db.session.delete(self)
         db.session.commit()
+        invalidate(self.__tablename__, [id])
+
+    def cast(self, actors):
+        id = self.id
+        actor_ids = [actor.id for actor in actors]
+        for actor in actors:
+            if actor not in self.actors:
+                self.actors.append(actor)
+        db.session.commit()
+        invalidate(self.__tablename__, [id])
+        invalidate(Actor.__tablename__, actor_ids)
+
+    def uncast(self, actor):
+        id = self.id
+        actor_id = actor.id
+        if actor in self.actors:
+            self.actors.remove(actor)
+        db.session.commit()
+        invalidate(self.__tablename__, [id])
+        invalidate(Actor.__tablename__, [actor_id])
 
     def get_formatted_json(self):
         return {
@@ -56,21 +210,44 @@ class Movie(db.Model):
 
 class Actor(db.Model):
     __tablename__ = "actors"
+    __table_args__ = (
+        db.Index("ix_actors_gender_id", "gender", "id"),
+        db.Index("ix_actors_age", "age"),
+        db.Index(
+            "ix_actors_name_trgm",
+            "name",
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        ),
+        db.Index("ix_actors_search_vector", "search_vector", postgresql_using="gin"),
+    )
     id = db.Column(db.Integer(), primary_key=True)
     name = db.Column(db.String(), nullable=False)
     age = db.Column(db.Integer(), nullable=False)
     gender = db.Column(db.String(), nullable=False)
+    version = db.Column(db.Integer(), nullable=False, default=1, server_default="1")
+    created_at = timestamp_column()
+    updated_at = timestamp_column(onupdate=datetime.datetime.utcnow)
+    search_vector = search_vector_column("name")
+    movies = db.relationship(
+        "Movie", secondary=castings, back_populates="actors", order_by="Movie.id"
+    )
 
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        invalidate(self.__tablename__)
 
     def update(self):
+        id = self.id
         db.session.commit()
+        invalidate(self.__tablename__, [id])
 
     def delete(self):
+        id = self.id
         db.session.delete(self)
         db.session.commit()
+        invalidate(self.__tablename__, [id])
 
     def get_formatted_json(self):
         return {
@@ -82,3 +259,226 @@ class Actor(db.Model):
 
     def __repr__(self):
         return f"Actor: {self.id}, {self.name}"
+
+
+# prefix lookups compare lower(name) LIKE 'abc%', which needs text_pattern_ops
+# outside the C locale
+db.Index(
+    "ix_actors_lower_name",
+    db.func.lower(Actor.name).label("lower_name"),
+    postgresql_ops={"lower_name": "text_pattern_ops"},
+)
+
+
+# row counts of movies by genre and release year and of actors by gender and
+# age, kept current by triggers so /stats reads a few hundred rows at most
+movie_counts = db.Table(
+    "movie_counts",
+    db.Column("genre", db.String(), primary_key=True),
+    db.Column("year", db.Integer(), primary_key=True),
+    db.Column("count", db.Integer(), nullable=False, default=0),
+)
+
+actor_counts = db.Table(
+    "actor_counts",
+    db.Column("gender", db.String(), primary_key=True),
+    db.Column("age", db.Integer(), primary_key=True),
+    db.Column("count", db.Integer(), nullable=False, default=0),
+)
+
+
+def count_triggers(dialect, source, summary, keys, watched):
+    """
+    DDL of the triggers adding every row inserted into source to its group
+    in summary, removing every deleted row from it, and moving updated rows
+    whose watched columns changed. keys maps the columns of summary to SQL
+    expressions of the row, written with {row}. Being triggers, they also
+    count rows written by Core and bulk statements.
+    """
+    columns = ", ".join(keys)
+    increment = (
+        "INSERT INTO {summary} ({columns}, count) VALUES ({values}, 1) "
+        "ON CONFLICT ({columns}) DO UPDATE SET count = {summary}.count + 1"
+    ).format(
+        summary=summary,
+        columns=columns,
+        values=", ".join(key.format(row="NEW") for key in keys.values()),
+    )
+    decrement = "UPDATE {} SET count = count - 1 WHERE {}".format(
+        summary,
+        " AND ".join(
+            "{} = {}".format(column, key.format(row="OLD"))
+            for column, key in keys.items()
+        ),
+    )
+    names = {"source": source, "watched": ", ".join(watched)}
+    if dialect == "postgresql":
+        return [
+            """
+            CREATE OR REPLACE FUNCTION {source}_count() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    {decrement};
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    {increment};
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """.format(decrement=decrement, increment=increment, **names),
+            "CREATE TRIGGER {source}_count "
+            "AFTER INSERT OR DELETE OR UPDATE OF {watched} ON {source} "
+            "FOR EACH ROW EXECUTE PROCEDURE {source}_count()".format(**names),
+        ]
+    return [
+        "CREATE TRIGGER {source}_count_insert AFTER INSERT ON {source} "
+        "BEGIN {increment}; END".format(increment=increment, **names),
+        "CREATE TRIGGER {source}_count_delete AFTER DELETE ON {source} "
+        "BEGIN {decrement}; END".format(decrement=decrement, **names),
+        "CREATE TRIGGER {source}_count_update AFTER UPDATE OF {watched} ON {source} "
+        "BEGIN {decrement}; {increment}; END".format(
+            decrement=decrement, increment=increment, **names
+        ),
+    ]
+
+
+RELEASE_YEAR = {
+    "postgresql": "CAST(extract(year FROM {row}.release_date) AS INTEGER)",
+    "sqlite": "CAST(substr({row}.release_date, 1, 4) AS INTEGER)",
+}
+
+for dialect, release_year in RELEASE_YEAR.items():
+    movie_triggers = count_triggers(
+        dialect,
+        "movies",
+        "movie_counts",
+        {"genre": "{row}.genre", "year": release_year},
+        ["genre", "release_date"],
+    )
+    actor_triggers = count_triggers(
+        dialect,
+        "actors",
+        "actor_counts",
+        {"gender": "{row}.gender", "age": "{row}.age"},
+        ["gender", "age"],
+    )
+    for table, statements in (
+        (Movie.__table__, movie_triggers),
+        (Actor.__table__, actor_triggers),
+    ):
+        for statement in statements:
+            event.listen(
+                table, "after_create", DDL(statement).execute_if(dialect=dialect)
+            )
+
+
+# the change feed of /changes: the last change of every actor and movie,
+# deleted ones included as tombstones. A row's entry is replaced on each
+# write, so its id only grows and a client syncing from a cursor reads every
+# row changed since at most once. tx, the writing transaction on Postgres (0
+# elsewhere), orders entries by commit (see flaskr.database.changes).
+changes = db.Table(
+    "changes",
+    db.Column("id", db.Integer(), primary_key=True),
+    db.Column("tx", db.BigInteger(), nullable=False, default=0),
+    db.Column("resource", db.String(), nullable=False),
+    db.Column("row_id", db.Integer(), nullable=False),
+    db.Column("deleted", db.Boolean(), nullable=False, default=False),
+    db.Column("changed_at", db.DateTime(), nullable=False),
+    db.Index("ix_changes_tx_id", "tx", "id"),
+    db.Index("ix_changes_resource_row_id", "resource", "row_id", unique=True),
+    # SQLite would otherwise reuse the id of a replaced last entry
+    sqlite_autoincrement=True,
+)
+
+
+def change_triggers(dialect, source):
+    """DDL of the triggers replacing the changes entry of every row written to source"""
+    replace = (
+        "DELETE FROM changes WHERE resource = '{source}' AND row_id = {row}.id; "
+        "INSERT INTO changes (tx, resource, row_id, deleted, changed_at) "
+        "VALUES ({tx}, '{source}', {row}.id, {deleted}, {now})"
+    )
+    if dialect == "postgresql":
+        names = {
+            "source": source,
+            "tx": "txid_current()",
+            "now": "timezone('utc', now())",
+        }
+        return [
+            """
+            CREATE OR REPLACE FUNCTION {source}_change() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    {delete};
+                ELSE
+                    {write};
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """.format(
+                delete=replace.format(row="OLD", deleted="true", **names),
+                write=replace.format(row="NEW", deleted="false", **names),
+                **names,
+            ),
+            "CREATE TRIGGER {source}_change AFTER INSERT OR UPDATE OR DELETE "
+            "ON {source} FOR EACH ROW EXECUTE PROCEDURE {source}_change()".format(
+                **names
+            ),
+        ]
+    names = {"source": source, "tx": "0", "now": "CURRENT_TIMESTAMP"}
+    return [
+        "CREATE TRIGGER {source}_change_{name} AFTER {operation} ON {source} "
+        "BEGIN {replace}; END".format(
+            name=operation.lower(),
+            operation=operation,
+            replace=replace.format(row=row, deleted=deleted, **names),
+            **names,
+        )
+        for operation, row, deleted in (
+            ("INSERT", "NEW", 0),
+            ("UPDATE", "NEW", 0),
+            ("DELETE", "OLD", 1),
+        )
+    ]
+
+
+for dialect in ("postgresql", "sqlite"):
+    for table in (Movie.__table__, Actor.__table__):
+        for statement in change_triggers(dialect, table.name):
+            event.listen(
+                table, "after_create", DDL(statement).execute_if(dialect=dialect)
+            )
+
+
+class ImportJob(db.Model):
+    """
+    An uploaded file of actors or movies waiting for, or being written by, an
+    import worker (see flaskr.imports). The table is the queue: workers claim
+    the oldest queued job, and running jobs whose worker stopped updating them
+    are claimed again and resumed after their last written chunk.
+    """
+
+    __tablename__ = "import_jobs"
+    __table_args__ = (db.Index("ix_import_jobs_status_id", "status", "id"),)
+    id = db.Column(db.Integer(), primary_key=True)
+    resource = db.Column(db.String(), nullable=False)
+    format = db.Column(db.String(), nullable=False)
+    # queued, running, done or failed
+    status = db.Column(db.String(), nullable=False, default="queued")
+    submitted_by = db.Column(db.String())
+    # the upload, cleared once the job is over
+    data = deferred(db.Column(db.LargeBinary()))
+    total_rows = db.Column(db.Integer())
+    processed_rows = db.Column(db.Integer(), nullable=False, default=0)
+    inserted_rows = db.Column(db.Integer(), nullable=False, default=0)
+    failed_rows = db.Column(db.Integer(), nullable=False, default=0)
+    # {"row", "errors"} of the first IMPORT_MAX_ERRORS failed rows
+    errors = db.Column(db.JSON(), nullable=False, default=list)
+    message = db.Column(db.String())
+    created_at = db.Column(db.DateTime(), nullable=False)
+    started_at = db.Column(db.DateTime())
+    updated_at = db.Column(db.DateTime())
+    finished_at = db.Column(db.DateTime())
@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, has_app_context
+from sqlalchemy import event, exc, text
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+READ_STATEMENT_TIMEOUT_MS = int(os.getenv("READ_STATEMENT_TIMEOUT_MS", 5000))
+
+
+class PoolStats:
+    """Counters shared by every pool of the process, they survive engine.dispose()"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.forked = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def as_dict(self):
+        return {
+            "connects": self.connects,
+            "checkouts": self.checkouts,
+            "checkins": self.checkins,
+            "timeouts": self.timeouts,
+            "forked_connections_discarded": self.forked,
+            "wait_seconds_total": round(self.wait_seconds, 6),
+            "wait_seconds_max": round(self.max_wait_seconds, 6),
+        }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool measuring how long callers wait for a connection"""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        finally:
+            pool_stats.record_wait(time.perf_counter() - start)
+
+
+@event.listens_for(InstrumentedQueuePool, "connect")
+def on_connect(dbapi_connection, connection_record):
+    pool_stats.connects += 1
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(InstrumentedQueuePool, "checkout")
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    """
+    A connection opened before gunicorn forked (e.g. with --preload) belongs
+    to the master; using it from a worker would interleave two processes on
+    one socket. Drop it without closing it, the pool then opens a new one.
+    """
+    pool_stats.checkouts += 1
+    if connection_record.info["pid"] != os.getpid():
+        pool_stats.forked += 1
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid %s, attempting to check out in pid %s"
+            % (connection_record.info["pid"], os.getpid())
+        )
+
+
+@event.listens_for(InstrumentedQueuePool, "checkin")
+def on_checkin(dbapi_connection, connection_record):
+    pool_stats.checkins += 1
+
+
+def engine_options(database_path):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS built from the DB_POOL_* environment variables.
+    SQLite keeps the pool Flask-SQLAlchemy picks for it.
+    """
+    if not database_path or database_path.startswith("sqlite"):
+        return {}
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS and database_path.startswith("postgres"):
+        options["connect_args"] = {
+            "options": "-c statement_timeout={}".format(DB_STATEMENT_TIMEOUT_MS)
+        }
+    return options
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = pool_stats.as_dict()
+    status["pool"] = type(pool).__name__
+    if isinstance(pool, QueuePool):
+        status.update(
+            {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            }
+        )
+    return status
+
+
+def statement_timeout(milliseconds):
+    """
+    Route decorator capping every statement of the request's transactions at
+    milliseconds on Postgres; 0 disables. The SET LOCAL is only sent once the
+    request opens a transaction (see apply_statement_timeout), so a response
+    served from the cache does not check out a connection for it.
+    """
+
+    def statement_timeout_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g.statement_timeout_ms = milliseconds
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return statement_timeout_decorator
+
+
+@event.listens_for(Session, "after_begin")
+def apply_statement_timeout(session, transaction, connection):
+    """SET LOCAL ends with the transaction, every transaction of the request gets it"""
+    if not has_app_context():
+        return
+    milliseconds = g.get("statement_timeout_ms")
+    if milliseconds and connection.dialect.name == "postgresql":
+        connection.execute(
+            text("SET LOCAL statement_timeout = {:d}".format(milliseconds))
+        )
@@ -0,0 +1,194 @@
+import datetime
+import os
+from flask import abort
+from .models import db, Actor, Movie, castings
+
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+
+LIST_FIELDS = {
+    Actor: ("id", "name", "age", "gender"),
+    Movie: ("id", "title", "release_date", "genre"),
+}
+
+
+def parse_int(args, name, default=None, minimum=0):
+    value = args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if value < minimum:
+        abort(400)
+    return value
+
+
+def parse_date(args, name):
+    value = args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+def parse_fields(model, args):
+    """Columns requested with ?fields=a,b; id is always selected since it is the cursor"""
+    allowed = LIST_FIELDS[model]
+    value = args.get("fields")
+    if not value:
+        return allowed
+    requested = [field.strip() for field in value.split(",") if field.strip()]
+    if any(field not in allowed for field in requested):
+        abort(400)
+    return tuple(field for field in allowed if field == "id" or field in requested)
+
+
+def like_prefix(value):
+    escaped = value.lower().replace("/", "//").replace("%", "/%").replace("_", "/_")
+    return escaped + "%"
+
+
+def actor_filters(args):
+    filters = []
+    if args.get("name"):
+        # served by the lower(name) text_pattern_ops index
+        filters.append(
+            db.func.lower(Actor.name).like(like_prefix(args["name"]), escape="/")
+        )
+    if args.get("gender"):
+        filters.append(Actor.gender == args["gender"])
+    min_age = parse_int(args, "min_age")
+    if min_age is not None:
+        filters.append(Actor.age >= min_age)
+    max_age = parse_int(args, "max_age")
+    if max_age is not None:
+        filters.append(Actor.age <= max_age)
+    return filters
+
+
+def movie_filters(args):
+    filters = []
+    if args.get("genre"):
+        filters.append(Movie.genre == args["genre"])
+    release_date_from = parse_date(args, "release_date_from")
+    if release_date_from is not None:
+        filters.append(Movie.release_date >= release_date_from)
+    release_date_to = parse_date(args, "release_date_to")
+    if release_date_to is not None:
+        filters.append(Movie.release_date <= release_date_to)
+    return filters
+
+
+LIST_FILTERS = {
+    Actor: actor_filters,
+    Movie: movie_filters,
+}
+
+
+def format_row(fields, row):
+    # dates are kept as date objects, serialization.dumps writes them as ISO 8601
+    return dict(zip(fields, row))
+
+
+def get_row(model, id):
+    """
+    The get_formatted_json fields of one row, read as a tuple, and its
+    version; None if missing.
+    """
+    fields = LIST_FIELDS[model]
+    row = (
+        db.session.query(*[getattr(model, field) for field in fields], model.version)
+        .filter(model.id == id)
+        .first()
+    )
+    return None if row is None else (format_row(fields, row[:-1]), row[-1])
+
+
+CAST = {
+    # model: (key added to each item, related model, own column, related column)
+    Movie: ("actors", Actor, castings.c.movie_id, castings.c.actor_id),
+    Actor: ("movies", Movie, castings.c.actor_id, castings.c.movie_id),
+}
+
+
+def parse_include(args):
+    value = args.get("include")
+    if not value:
+        return False
+    if value != "cast":
+        abort(400)
+    return True
+
+
+def related_rows(model, id):
+    """
+    Rows related to row id of model (the movies of an actor, the actors of a
+    movie) ordered by id, or None when that row does not exist.
+    """
+    key, related, own_id, related_id = CAST[model]
+    fields = LIST_FIELDS[related]
+    rows = (
+        db.session.query(*[getattr(related, field) for field in fields])
+        .join(castings, related.id == related_id)
+        .filter(own_id == id)
+        .order_by(related.id)
+        .all()
+    )
+    if not rows and db.session.query(model.id).filter(model.id == id).first() is None:
+        return None
+    return [format_row(fields, row) for row in rows]
+
+
+def attach_cast(model, items):
+    """
+    Adds the related rows to every item of a page with a single IN query over
+    the page ids, so the number of statements does not grow with the page size.
+    """
+    key, related, own_id, related_id = CAST[model]
+    fields = LIST_FIELDS[related]
+    by_id = {item["id"]: item for item in items}
+    for item in items:
+        item[key] = []
+    if not by_id:
+        return items
+    rows = (
+        db.session.query(own_id, *[getattr(related, field) for field in fields])
+        .join(related, related.id == related_id)
+        .filter(own_id.in_(by_id))
+        .order_by(own_id, related.id)
+        .all()
+    )
+    for row in rows:
+        by_id[row[0]][key].append(format_row(fields, row[1:]))
+    return items
+
+
+def paginate(model, args):
+    """
+    Keyset pagination on id: returns one page of formatted rows matching the
+    filters in args and the cursor to pass as ?after= for the next page
+    (None on the last page).
+    """
+    fields = parse_fields(model, args)
+    limit = min(parse_int(args, "limit", DEFAULT_PAGE_SIZE, minimum=1), MAX_PAGE_SIZE)
+    after = parse_int(args, "after")
+    include_cast = parse_include(args)
+
+    query = db.session.query(*[getattr(model, field) for field in fields])
+    query = query.filter(*LIST_FILTERS[model](args))
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    items = [format_row(fields, row) for row in rows]
+    if include_cast:
+        attach_cast(model, items)
+    return items, next_cursor
@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm, text
+
+# comma separated URIs of read replicas of DATABASE_URI; none means every
+# statement goes to the primary
+DATABASE_REPLICA_URIS = [
+    uri.strip()
+    for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",")
+    if uri.strip()
+]
+REPLICA_CHECK_INTERVAL = int(os.getenv("REPLICA_CHECK_INTERVAL", 10))
+# how long a client that wrote keeps reading from the primary, should exceed
+# the replication lag
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", 5))
+STICKY_COOKIE = "read_primary_until"
+
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def replica_binds(uris):
+    return {"replica_{}".format(i): uri for i, uri in enumerate(uris)}
+
+
+class ReplicaSet:
+    """
+    Round robin over the replica binds of the app. A replica is pinged at
+    most every check_interval seconds by the request picking it; one failing
+    the ping is skipped until its next check, and with none left reads go
+    to the primary.
+    """
+
+    def __init__(self, check_interval=REPLICA_CHECK_INTERVAL, clock=time.monotonic):
+        self.check_interval = check_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._next = 0
+        self._checked_at = {}
+        self._healthy = {}
+        self.reads = {}
+        self.fallbacks = 0
+
+    def reset(self):
+        with self._lock:
+            self._next = 0
+            self._checked_at.clear()
+            self._healthy.clear()
+            self.reads.clear()
+            self.fallbacks = 0
+
+    def is_healthy(self, key, engine):
+        now = self.clock()
+        checked_at = self._checked_at.get(key)
+        if checked_at is None or now - checked_at >= self.check_interval:
+            self._checked_at[key] = now
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+                self._healthy[key] = True
+            except Exception:
+                self._healthy[key] = False
+        return self._healthy[key]
+
+    def choose(self, db, app):
+        keys = sorted(
+            key
+            for key in app.config.get("SQLALCHEMY_BINDS") or {}
+            if key.startswith("replica_")
+        )
+        for _ in keys:
+            with self._lock:
+                key = keys[self._next % len(keys)]
+                self._next += 1
+            engine = db.get_engine(app, bind=key)
+            if self.is_healthy(key, engine):
+                self.reads[key] = self.reads.get(key, 0) + 1
+                return engine
+        if keys:
+            self.fallbacks += 1
+        return None
+
+    def status(self):
+        return {
+            "replicas": {
+                key: {"healthy": healthy, "reads": self.reads.get(key, 0)}
+                for key, healthy in sorted(self._healthy.items())
+            },
+            "fallbacks": self.fallbacks,
+        }
+
+
+replica_set = ReplicaSet()
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends the statements of requests routed to a replica (see
+    setup_replica_routing) to one replica picked per request. Flushes and
+    INSERT/UPDATE/DELETE statements always go to the primary, and switch
+    the rest of the request to it.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and g.get("db_target") == "replica":
+            if self._flushing or getattr(clause, "is_dml", False):
+                g.db_target = "primary"
+            else:
+                if "db_replica" not in g:
+                    db = self.app.extensions["sqlalchemy"].db
+                    g.db_replica = replica_set.choose(db, self.app)
+                if g.db_replica is not None:
+                    return g.db_replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def reads_from(target):
+    """
+    Route decorator choosing where the reads of the route go, "replica" or
+    "primary". Clients that wrote in the last REPLICA_STICKY_SECONDS read
+    from the primary either way.
+    """
+
+    def reads_from_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not g.get("db_sticky"):
+                g.db_target = target
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return reads_from_decorator
+
+
+def setup_replica_routing(app):
+    """
+    Routes the reads of GET requests to the replicas and everything else to
+    the primary. After a successful write the client gets a cookie keeping
+    its reads on the primary for REPLICA_STICKY_SECONDS, so it reads its
+    own writes whatever the replication lag.
+    """
+
+    @app.before_request
+    def route_request():
+        try:
+            sticky = float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        g.db_sticky = sticky
+        if request.method in SAFE_METHODS and not sticky:
+            g.db_target = "replica"
+        else:
+            g.db_target = "primary"
+
+    @app.after_request
+    def stick_to_primary(response):
+        if (
+            app.config.get("SQLALCHEMY_BINDS")
+            and request.method not in SAFE_METHODS
+            and response.status_code < 400
+        ):
+            response.set_cookie(
+                STICKY_COOKIE,
+                str(int(time.time()) + REPLICA_STICKY_SECONDS),
+                max_age=REPLICA_STICKY_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
@@ -0,0 +1,80 @@
+import os
+import re
+from flask import abort
+from .models import db, Actor, Movie
+from .queries import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    LIST_FILTERS,
+    format_row,
+    like_prefix,
+    parse_fields,
+    parse_int,
+)
+
+MAX_SEARCH_OFFSET = int(os.getenv("MAX_SEARCH_OFFSET", 10000))
+
+# column matched by trigram similarity for typos and partial words
+NAME_COLUMNS = {
+    Actor: Actor.name,
+    Movie: Movie.title,
+}
+
+
+def search_terms(args):
+    terms = re.findall(r"\w+", args.get("q", "").lower())
+    if not terms:
+        abort(400)
+    return terms
+
+
+def search_condition_and_rank(model, terms, q):
+    name = NAME_COLUMNS[model]
+    if db.engine.dialect.name == "postgresql":
+        # every term as a prefix, so "sky fal" finds "Skyfall"; \w+ terms
+        # carry no tsquery syntax
+        tsquery = db.func.to_tsquery("simple", " & ".join(t + ":*" for t in terms))
+        condition = db.or_(model.search_vector.op("@@")(tsquery), name.op("%")(q))
+        rank = db.func.ts_rank(model.search_vector, tsquery) + db.func.similarity(
+            name, q
+        )
+        return condition, rank
+    # fallback for SQLite: search_vector holds the lowercased text
+    condition = db.and_(
+        *[
+            model.search_vector.like("%" + like_prefix(term), escape="/")
+            for term in terms
+        ]
+    )
+    rank = db.case((db.func.lower(name).like(like_prefix(q), escape="/"), 1), else_=0)
+    return condition, rank
+
+
+def search(model, args):
+    """
+    One page of rows of model matching ?q=, best matches first. Ranking has
+    no stable key to page on, so pages are addressed with ?offset=; returns
+    the items and the offset of the next page (None on the last page).
+    """
+    terms = search_terms(args)
+    fields = parse_fields(model, args)
+    limit = min(parse_int(args, "limit", DEFAULT_PAGE_SIZE, minimum=1), MAX_PAGE_SIZE)
+    offset = parse_int(args, "offset", 0)
+    if offset > MAX_SEARCH_OFFSET:
+        abort(400)
+
+    condition, rank = search_condition_and_rank(model, terms, args["q"].lower())
+    rows = (
+        db.session.query(*[getattr(model, field) for field in fields])
+        .filter(condition)
+        .filter(*LIST_FILTERS[model](args))
+        .order_by(rank.desc(), model.id)
+        .offset(offset)
+        .limit(limit + 1)
+        .all()
+    )
+    next_offset = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_offset = offset + limit
+    return [format_row(fields, row) for row in rows], next_offset
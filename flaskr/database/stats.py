@@ -0,0 +1,48 @@
+from .models import db, movie_counts, actor_counts
+
+
+def grouped(summary, key, label):
+    """Counts of summary summed by key, groups left empty by deletes omitted"""
+    total = db.func.sum(summary.c.count)
+    rows = (
+        db.session.query(key.label(label), total)
+        .group_by(key)
+        .having(total > 0)
+        .order_by(key)
+        .all()
+    )
+    return [{label: value, "count": count} for value, count in rows]
+
+
+def movie_stats():
+    """
+    Movie counts by genre and by release year, summed from movie_counts:
+    one row per genre and year, whatever the number of movies.
+    """
+    by_genre = grouped(movie_counts, movie_counts.c.genre, "genre")
+    return {
+        "total": sum(group["count"] for group in by_genre),
+        "by_genre": by_genre,
+        "by_year": grouped(movie_counts, movie_counts.c.year, "year"),
+    }
+
+
+def actor_stats():
+    """Actor counts by gender and by age group (20-29, ...) plus the average age"""
+    total, age_sum = db.session.query(
+        db.func.sum(actor_counts.c.count),
+        db.func.sum(actor_counts.c.age * actor_counts.c.count),
+    ).one()
+    decade = actor_counts.c.age / 10 * 10
+    return {
+        "total": total or 0,
+        "average_age": round(age_sum / total, 1) if total else None,
+        "by_gender": grouped(actor_counts, actor_counts.c.gender, "gender"),
+        "by_age_group": [
+            {
+                "age_group": "{}-{}".format(group["decade"], group["decade"] + 9),
+                "count": group["count"],
+            }
+            for group in grouped(actor_counts, decade, "decade")
+        ],
+    }
@@ -0,0 +1,64 @@
+import datetime
+from .models import Actor, Movie
+
+
+def _string(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("must be a non empty string")
+    return value
+
+
+def _text(value):
+    if not isinstance(value, str):
+        raise ValueError("must be a string")
+    return value
+
+
+def _age(value):
+    if isinstance(value, bool):
+        raise ValueError("must be an integer")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("must be an integer")
+    if value < 0:
+        raise ValueError("must not be negative")
+    return value
+
+
+def _date(value):
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError("must be a date in YYYY-MM-DD format")
+
+
+SCHEMAS = {
+    Actor: {"name": _string, "age": _age, "gender": _string},
+    Movie: {"title": _string, "release_date": _date, "genre": _text},
+}
+
+
+def validate(model, data, partial=False):
+    """
+    Checks a request payload against the columns of model and converts the
+    values to their column types. Returns (values, errors): values holds the
+    converted known fields, errors maps field names to messages. With partial
+    set, missing fields are allowed, as for PATCH.
+    """
+    if not isinstance(data, dict):
+        return {}, {"_schema": "must be a JSON object"}
+    values = {}
+    errors = {}
+    for field, convert in SCHEMAS[model].items():
+        if field not in data:
+            if not partial:
+                errors[field] = "is required"
+            continue
+        try:
+            values[field] = convert(data[field])
+        except ValueError as e:
+            errors[field] = str(e)
+    return values, errors
@@ -0,0 +1,109 @@
+import re
+from flask import abort, jsonify, request
+from ..cache import invalidate
+from .models import db
+from .queries import LIST_FIELDS, format_row
+
+ETAG_VERSION = re.compile(r"^v(\d+)$")
+
+
+def version_etag(version):
+    return "v{}".format(version)
+
+
+def if_match_versions():
+    """
+    Versions listed in the If-Match header; None when the request is not
+    conditional (no header or *). ETags that are not versions match nothing.
+    The weak form of a version counts too: a version names the row, not the
+    bytes of a response, and compression weakens the ETag of a GET.
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    versions = set()
+    for etag in if_match.as_set(include_weak=True):
+        match = ETAG_VERSION.match(etag)
+        if match:
+            versions.add(int(match.group(1)))
+    return versions
+
+
+def invalid_payload_response(errors):
+    """400 listing the fields of a create or update payload which failed validation"""
+    return (
+        jsonify(
+            {"success": False, "error": 400, "message": "Bad request", "errors": errors}
+        ),
+        400,
+    )
+
+
+def insert_row(model, values):
+    """
+    Inserts a row of model with one INSERT and returns its id, without reading
+    the row back: Postgres returns the id through RETURNING, other databases
+    through the cursor's last row id.
+    """
+    result = db.session.execute(model.__table__.insert().values(**values))
+    db.session.commit()
+    invalidate(model.__tablename__)
+    return result.inserted_primary_key[0]
+
+
+def _missing_or_stale(model, id):
+    """Status for a conditional write which matched no row: 404 or 412"""
+    exists = db.session.query(model.id).filter(model.id == id).first()
+    abort(412 if exists else 404)
+
+
+def update_row(model, id, values, versions=None):
+    """
+    Sets values on row id of model and bumps its version in one UPDATE, only
+    if its version is in versions (unless None). Returns the formatted row
+    and its new version; aborts with 404 or 412 when nothing was updated.
+    On Postgres the row comes back through RETURNING, other databases read
+    it again in the same transaction.
+    """
+    table = model.__table__
+    fields = LIST_FIELDS[model]
+    statement = (
+        table.update()
+        .where(table.c.id == id)
+        .values(version=table.c.version + 1, **values)
+    )
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+    if db.engine.dialect.full_returning:
+        statement = statement.returning(
+            *[table.c[field] for field in fields], table.c.version
+        )
+        row = db.session.execute(statement).first()
+    else:
+        if db.session.execute(statement).rowcount:
+            row = (
+                db.session.query(*[table.c[field] for field in fields], table.c.version)
+                .filter(table.c.id == id)
+                .first()
+            )
+        else:
+            row = None
+    if row is None:
+        db.session.rollback()
+        _missing_or_stale(model, id)
+    db.session.commit()
+    invalidate(model.__tablename__, [id])
+    return format_row(fields, row[:-1]), row[-1]
+
+
+def delete_row(model, id, versions=None):
+    """Deletes row id of model with one DELETE, aborts with 404 or 412 like update_row"""
+    table = model.__table__
+    statement = table.delete().where(table.c.id == id)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+    if not db.session.execute(statement).rowcount:
+        db.session.rollback()
+        _missing_or_stale(model, id)
+    db.session.commit()
+    invalidate(model.__tablename__, [id])
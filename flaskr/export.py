@@ -0,0 +1,44 @@
+import json
+import os
+from flask import Response, request, stream_with_context
+from .database.models import db
+from .database.queries import LIST_FIELDS, format_row, parse_int
+from .serialization import JSONEncoder
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+
+def ndjson_chunks(model, after=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields the rows of model as newline delimited get_formatted_json objects,
+    one chunk per batch. Rows are read as plain tuples through a server side
+    cursor, so only batch_size rows are alive at any time.
+    """
+    fields = LIST_FIELDS[model]
+    query = db.session.query(*[getattr(model, field) for field in fields])
+    query = query.order_by(model.id)
+    if after is not None:
+        query = query.filter(model.id > after)
+    query = query.execution_options(stream_results=True).yield_per(batch_size)
+
+    lines = []
+    for row in query:
+        lines.append(json.dumps(format_row(fields, row), cls=JSONEncoder))
+        if len(lines) == batch_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def export_response(model):
+    """
+    Streams model as application/x-ndjson, compressed chunk by chunk when the
+    client accepts it (see compression.setup_compression). ?after=<id>
+    resumes an interrupted export after the last id received.
+    """
+    after = parse_int(request.args, "after")
+    return Response(
+        stream_with_context(ndjson_chunks(model, after)),
+        mimetype="application/x-ndjson",
+    )
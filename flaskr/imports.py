@@ -0,0 +1,374 @@
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import threading
+from flask import abort, jsonify, request, url_for
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import undefer
+from .cache import invalidate
+from .database.bulk import validate_batch
+from .database.models import db, Actor, Movie, ImportJob
+from .database.validation import SCHEMAS
+from .serialization import json_response
+
+# worker threads started in each web process by its first upload; 0 leaves the
+# jobs to scripts/import_worker.py, keeping the imports off the web tier
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 1))
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", 50 * 1024 * 1024))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", 100))
+# idle workers look for jobs queued by other processes this often
+IMPORT_POLL_SECONDS = float(os.getenv("IMPORT_POLL_SECONDS", 5))
+# a running job not updated for this long lost its worker and is claimed again
+IMPORT_STALE_SECONDS = int(os.getenv("IMPORT_STALE_SECONDS", 300))
+
+MODELS = {"actors": Actor, "movies": Movie}
+MIMETYPES = {"text/csv": "csv", "application/x-ndjson": "ndjson"}
+EXTENSIONS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def _json_line(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        # validated as a record which is not an object
+        return None
+
+
+def read_records(format, data):
+    """
+    Records of an upload, in order: a dict per CSV row under the header, or a
+    parsed value per non blank NDJSON line (None for lines that are not JSON).
+    """
+    text = data.decode("utf-8-sig")
+    if format == "csv":
+        return csv.DictReader(io.StringIO(text))
+    return (_json_line(line) for line in text.splitlines() if line.strip())
+
+
+def missing_columns(model, data):
+    """Fields of model missing from the header line of a CSV upload"""
+    header = data[: 64 * 1024].decode("utf-8-sig", errors="replace")
+    columns = next(csv.reader(io.StringIO(header)), [])
+    return [field for field in SCHEMAS[model] if field not in columns]
+
+
+def claim_job():
+    """
+    Marks the oldest queued (or stale running) job as running and returns its
+    id, None when there is nothing to do. Postgres workers skip the rows
+    locked by each other; elsewhere the conditional UPDATE settles races.
+    """
+    now = utcnow()
+    claimable = or_(
+        ImportJob.status == "queued",
+        and_(
+            ImportJob.status == "running",
+            ImportJob.updated_at
+            < now - datetime.timedelta(seconds=IMPORT_STALE_SECONDS),
+        ),
+    )
+    row = (
+        db.session.query(ImportJob.id)
+        .filter(claimable)
+        .order_by(ImportJob.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if row is None:
+        db.session.rollback()
+        return None
+    claimed = (
+        db.session.query(ImportJob)
+        .filter(ImportJob.id == row.id, claimable)
+        .update(
+            {
+                "status": "running",
+                "updated_at": now,
+                "started_at": db.func.coalesce(ImportJob.started_at, now),
+            },
+            synchronize_session=False,
+        )
+    )
+    db.session.commit()
+    return row.id if claimed else None
+
+
+def _update_job(job_id, values):
+    db.session.query(ImportJob).filter(ImportJob.id == job_id).update(
+        dict(values, updated_at=utcnow()), synchronize_session=False
+    )
+
+
+def finish_job(job_id, status, message=None):
+    """Ends the job and drops its upload"""
+    _update_job(
+        job_id,
+        {"status": status, "message": message, "finished_at": utcnow(), "data": None},
+    )
+    db.session.commit()
+
+
+def write_chunk(job_id, model, start, records, errors):
+    """
+    Validates records, the rows start + 1 to start + len(records) of the
+    upload, inserts the valid ones with one executemany and records the
+    progress in the same transaction, so a resumed job neither skips nor
+    repeats rows. A chunk the database rejects fails as a whole. Returns the
+    number of rows inserted and the errors of the job so far.
+    """
+    rows, failures = validate_batch(model, records)
+    failed = {failure["index"] for failure in failures}
+    valid = [row for index, row in enumerate(rows) if index not in failed]
+    try:
+        if valid:
+            db.session.execute(model.__table__.insert(), valid)
+        inserted = len(valid)
+    except Exception:
+        db.session.rollback()
+        failures += [
+            {"index": index, "errors": {"_schema": "Request cant be processed"}}
+            for index in range(len(records))
+            if index not in failed
+        ]
+        inserted = 0
+    failures.sort(key=lambda failure: failure["index"])
+    errors = errors + [
+        {"row": start + failure["index"] + 1, "errors": failure["errors"]}
+        for failure in failures[: max(0, IMPORT_MAX_ERRORS - len(errors))]
+    ]
+    _update_job(
+        job_id,
+        {
+            "processed_rows": start + len(records),
+            "inserted_rows": ImportJob.inserted_rows + inserted,
+            "failed_rows": ImportJob.failed_rows + len(failures),
+            "errors": errors,
+        },
+    )
+    db.session.commit()
+    if inserted:
+        invalidate(model.__tablename__)
+    return inserted, errors
+
+
+def process_job(job_id, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Writes a claimed job chunk by chunk, from its first unprocessed row.
+    Returns its final status and the number of rows this run inserted.
+    """
+    job = db.session.query(ImportJob).options(undefer(ImportJob.data)).get(job_id)
+    model = MODELS[job.resource]
+    format, data, start, errors = job.format, job.data, job.processed_rows, job.errors
+    total_rows = job.total_rows
+    inserted = 0
+    try:
+        if total_rows is None:
+            total_rows = sum(1 for _ in read_records(format, data))
+            _update_job(job_id, {"total_rows": total_rows})
+            db.session.commit()
+        records = itertools.islice(read_records(format, data), start, None)
+        for chunk in iter(lambda: list(itertools.islice(records, chunk_size)), []):
+            chunk_inserted, errors = write_chunk(job_id, model, start, chunk, errors)
+            inserted += chunk_inserted
+            start += len(chunk)
+    except (UnicodeDecodeError, csv.Error) as e:
+        db.session.rollback()
+        finish_job(job_id, "failed", "The file can not be read: {}".format(e))
+        return "failed", inserted
+    finish_job(job_id, "done")
+    return "done", inserted
+
+
+class ImportWorkers:
+    """
+    Threads running the queued import jobs of every process, polling the
+    import_jobs table; notify() wakes them up for a job queued by their own
+    process. Started lazily, so they only run in the processes serving
+    uploads (after the gunicorn fork) or in scripts/import_worker.py.
+    """
+
+    def __init__(self, threads=IMPORT_WORKERS, poll_interval=IMPORT_POLL_SECONDS):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.rows_inserted = 0
+        self._running = []
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, app):
+        with self._lock:
+            if self._running:
+                return
+            self._stopped.clear()
+            for number in range(self.threads):
+                thread = threading.Thread(
+                    target=self.run,
+                    args=(app,),
+                    name="import-worker-{}".format(number),
+                    daemon=True,
+                )
+                thread.start()
+                self._running.append(thread)
+
+    def notify(self):
+        self._wake.set()
+
+    def stop(self):
+        with self._lock:
+            self._stopped.set()
+            self._wake.set()
+            for thread in self._running:
+                thread.join()
+            self._running = []
+
+    def join(self):
+        for thread in list(self._running):
+            thread.join()
+
+    def run(self, app):
+        while not self._stopped.is_set():
+            if not self.run_once(app):
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def run_once(self, app):
+        """Claims and runs one job, returns whether there was one"""
+        with app.app_context():
+            job_id = None
+            try:
+                job_id = claim_job()
+                if job_id is None:
+                    return False
+                status, inserted = process_job(job_id)
+                self.rows_inserted += inserted
+            except Exception as e:
+                db.session.rollback()
+                if job_id is None:
+                    return False
+                status = "failed"
+                try:
+                    finish_job(job_id, status, "The import failed: {}".format(e))
+                except Exception:
+                    # the database is gone, the job is claimed again once stale
+                    db.session.rollback()
+                    return False
+            finally:
+                db.session.remove()
+        if status == "done":
+            self.jobs_done += 1
+        else:
+            self.jobs_failed += 1
+        return True
+
+    def stats(self):
+        return {
+            "jobs_done": self.jobs_done,
+            "jobs_failed": self.jobs_failed,
+            "rows_inserted": self.rows_inserted,
+        }
+
+
+import_workers = ImportWorkers()
+
+
+def configure_import_workers(**kwargs):
+    global import_workers
+    import_workers.stop()
+    import_workers = ImportWorkers(**kwargs)
+    return import_workers
+
+
+def upload_format(name, mimetype):
+    format = request.args.get("format")
+    if format is None:
+        format = MIMETYPES.get(mimetype) or EXTENSIONS.get(
+            os.path.splitext(name)[1].lower()
+        )
+    return format
+
+
+def create_import_response(app, resource, payload):
+    """
+    Queues the upload, a multipart "file" field or the request body, as an
+    import of resource and answers 202 with the job id right away. The format
+    is ?format=csv|ndjson, else read from the content type or the file name.
+    """
+    model = MODELS[resource]
+    if (request.content_length or 0) > IMPORT_MAX_BYTES:
+        abort(422)
+    upload = request.files.get("file")
+    if upload is not None:
+        data, format = upload.read(), upload_format(upload.filename, upload.mimetype)
+    else:
+        data, format = request.get_data(), upload_format("", request.mimetype)
+    if format not in ("csv", "ndjson") or not data:
+        abort(400)
+    if len(data) > IMPORT_MAX_BYTES:
+        abort(422)
+    if format == "csv":
+        missing = missing_columns(model, data)
+        if missing:
+            return (
+                jsonify(
+                    {
+                        "success": False,
+                        "error": 400,
+                        "message": "Bad request",
+                        "errors": {field: "column is required" for field in missing},
+                    }
+                ),
+                400,
+            )
+    job = ImportJob(
+        resource=resource,
+        format=format,
+        data=data,
+        submitted_by=payload.get("sub"),
+        created_at=utcnow(),
+    )
+    db.session.add(job)
+    db.session.commit()
+    import_workers.start(app)
+    import_workers.notify()
+    response = json_response({"success": True, "import_id": job.id}, 202)
+    response.headers["Location"] = url_for("get_import", import_id=job.id)
+    return response
+
+
+def format_job(job):
+    """Status of an import, with its progress and rows per second so far"""
+    elapsed = None
+    if job.started_at is not None:
+        elapsed = ((job.finished_at or utcnow()) - job.started_at).total_seconds()
+    return {
+        "id": job.id,
+        "resource": job.resource,
+        "format": job.format,
+        "status": job.status,
+        "total_rows": job.total_rows,
+        "processed_rows": job.processed_rows,
+        "inserted_rows": job.inserted_rows,
+        "failed_rows": job.failed_rows,
+        "progress": (
+            round(job.processed_rows / job.total_rows, 4) if job.total_rows else None
+        ),
+        "rows_per_second": (
+            round(job.processed_rows / elapsed, 1) if elapsed else None
+        ),
+        "errors": job.errors,
+        "message": job.message,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
@@ -0,0 +1,391 @@
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# directory shared by the gunicorn workers, each one writes its counters there
+# and /metrics sums them; unset means a single process reporting from memory
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SQL_STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE", "SET", "EXPLAIN"}
+
+# name: (type, help, buckets)
+METRICS = {
+    "http_requests_total": ("counter", "Requests handled", None),
+    "http_request_duration_seconds": (
+        "histogram",
+        "Time from the first before_request hook to the last after_request hook",
+        LATENCY_BUCKETS,
+    ),
+    "http_request_phase_seconds": (
+        "histogram",
+        "Time spent per request in auth (which includes auth_header, jwks and "
+        "jwt_decode), db and serialize",
+        LATENCY_BUCKETS,
+    ),
+    "http_request_sql_queries": (
+        "histogram",
+        "SQL statements executed per request",
+        QUERY_COUNT_BUCKETS,
+    ),
+    "http_response_size_bytes": (
+        "histogram",
+        "Size of the response bodies, streamed responses are not counted",
+        SIZE_BUCKETS,
+    ),
+    "sql_query_duration_seconds": (
+        "histogram",
+        "Execution time of the SQL statements, by statement type",
+        LATENCY_BUCKETS,
+    ),
+}
+
+
+class Registry:
+    """
+    Counters and histograms of one process. Histogram buckets are stored
+    non cumulative, so snapshots of several workers merge by plain addition.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flushed_at = None
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.counters = defaultdict(float)
+            self.histograms = {}
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            index = next(
+                (i for i, bound in enumerate(buckets) if value <= bound), len(buckets)
+            )
+            histogram[0][index] += 1
+            histogram[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [
+                    [name, labels, value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    [name, labels, list(counts), total]
+                    for (name, labels), (counts, total) in self.histograms.items()
+                ],
+                "stats": process_stats(),
+            }
+
+    def flush(self, force=False):
+        """Writes the snapshot to METRICS_DIR, at most every METRICS_FLUSH_INTERVAL"""
+        if not METRICS_DIR:
+            return
+        now = time.monotonic()
+        if (
+            not force
+            and self._flushed_at is not None
+            and now - self._flushed_at < METRICS_FLUSH_INTERVAL
+        ):
+            return
+        self._flushed_at = now
+        path = os.path.join(METRICS_DIR, "metrics-{}.json".format(os.getpid()))
+        with open(path + ".tmp", "w") as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(path + ".tmp", path)
+
+
+registry = Registry()
+
+
+def process_stats():
+    """(name, type, help, value) of the counters kept by the caches and the pool"""
+    from .auth import auth
+    from . import cache, imports
+    from .database.pool import pool_stats
+
+    stats = []
+    for name, value in pool_stats.as_dict().items():
+        if name == "wait_seconds_total":
+            stats.append(
+                ("db_pool_wait_seconds_total", "counter", "Time spent waiting", value)
+            )
+        elif name != "wait_seconds_max":
+            stats.append(
+                ("db_pool_{}_total".format(name), "counter", "Pool " + name, value)
+            )
+    for prefix, source in (
+        ("jwks", auth.jwks_store.stats()),
+        ("token_cache", auth.token_cache.stats()),
+        ("rate_limit", auth.rate_limiter.stats()),
+        ("policy", auth.policy.stats()),
+        ("response_cache", cache.response_cache.stats()),
+        ("imports", imports.import_workers.stats()),
+    ):
+        for name, value in source.items():
+            if name in ("keys", "size", "maxsize", "permissions"):
+                kind, metric = "gauge", "{}_{}".format(prefix, name)
+            else:
+                kind, metric = "counter", "{}_{}_total".format(prefix, name)
+            stats.append((metric, kind, "{} {}".format(prefix, name), value))
+    return stats
+
+
+def retire_worker(pid):
+    """
+    Folds the snapshot of the exited worker pid into metrics-retired.json, the
+    one of all exited workers. Their counters and histograms keep adding to
+    /metrics, but their gauges (cache and pool sizes) describe nothing alive
+    and are dropped. Called by the gunicorn master, see gunicorn.conf.py.
+    """
+    if not METRICS_DIR:
+        return
+    path = os.path.join(METRICS_DIR, "metrics-{}.json".format(pid))
+    retired_path = os.path.join(METRICS_DIR, "metrics-retired.json")
+    snapshots = []
+    for snapshot_path in (retired_path, path):
+        try:
+            with open(snapshot_path) as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except (OSError, ValueError):
+            continue
+    if not snapshots:
+        return
+    counters, histograms, stats = _summed(snapshots)
+    retired = {
+        "counters": [
+            [name, labels, value] for (name, labels), value in counters.items()
+        ],
+        "histograms": [
+            [name, labels, counts, total]
+            for (name, labels), (counts, total) in histograms.items()
+        ],
+        "stats": [
+            [name, kind, help_text, value]
+            for name, (kind, help_text, value) in stats.items()
+            if kind != "gauge"
+        ],
+    }
+    with open(retired_path + ".tmp", "w") as snapshot_file:
+        json.dump(retired, snapshot_file)
+    os.replace(retired_path + ".tmp", retired_path)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def collect():
+    """Snapshots of every worker, this process' own one taken from memory"""
+    snapshots = [registry.snapshot()]
+    if METRICS_DIR:
+        own = os.path.join(METRICS_DIR, "metrics-{}.json".format(os.getpid()))
+        for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+            if path == own:
+                continue
+            try:
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError):
+                continue
+    return snapshots
+
+
+def _labels(labels, **extra):
+    pairs = [tuple(pair) for pair in labels] + sorted(extra.items())
+    if not pairs:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in pairs
+        )
+    )
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _summed(snapshots):
+    """counters, histograms and stats of snapshots, added up by name and labels"""
+    counters = defaultdict(float)
+    histograms = {}
+    stats = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            counters[(name, tuple(map(tuple, labels)))] += value
+        for name, labels, counts, total in snapshot["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            if key not in histograms:
+                histograms[key] = [[0] * len(counts), 0.0]
+            histograms[key][0] = [a + b for a, b in zip(histograms[key][0], counts)]
+            histograms[key][1] += total
+        for name, kind, help_text, value in snapshot["stats"]:
+            if name in stats:
+                stats[name][2] += value
+            else:
+                stats[name] = [kind, help_text, value]
+    return counters, histograms, stats
+
+
+def render(snapshots):
+    """Prometheus text exposition format of the summed snapshots"""
+    counters, histograms, stats = _summed(snapshots)
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [
+            "# HELP {} {}".format(name, help_text),
+            "# TYPE {} {}".format(name, kind),
+        ]
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append("{}{} {}".format(name, _labels(labels), _number(value)))
+        for (metric, labels), (counts, total) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(name, _labels(labels, le=bound), cumulative)
+                )
+            lines.append("{}_sum{} {}".format(name, _labels(labels), _number(total)))
+            lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+    for name, (kind, help_text, value) in stats.items():
+        lines += [
+            "# HELP {} {}".format(name, help_text),
+            "# TYPE {} {}".format(name, kind),
+            "{} {}".format(name, _number(value)),
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def metrics_response():
+    return Response(
+        render(collect()), mimetype="text/plain", headers={"Cache-Control": "no-store"}
+    )
+
+
+@contextmanager
+def timed(phase):
+    """Adds the time spent inside the block to phase of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and "metric_timings" in g:
+            g.metric_timings[phase] += time.perf_counter() - start
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    words = statement.split(None, 1)
+    kind = words[0].upper() if words else ""
+    if kind not in SQL_STATEMENTS:
+        kind = "OTHER"
+    registry.observe("sql_query_duration_seconds", {"statement": kind}, elapsed)
+    if has_request_context() and "metric_timings" in g:
+        g.metric_timings["db"] += elapsed
+        g.metric_queries += 1
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(context):
+    # after_cursor_execute is not called for a failed statement
+    stack = context.connection.info.get("query_start") if context.connection else None
+    if stack:
+        stack.pop()
+
+
+def server_timing(timings, total):
+    entries = [
+        "{};dur={:.2f}".format(phase, seconds * 1000)
+        for phase, seconds in sorted(timings.items())
+    ]
+    entries.append(
+        '{};dur={:.2f};desc="{} queries"'.format("app", total * 1000, g.metric_queries)
+    )
+    return ", ".join(entries)
+
+
+def setup_metrics(app):
+    """
+    Times every request of app, its auth, db and serialize phases, and counts
+    its SQL statements. Each worker flushes its numbers to METRICS_DIR after
+    requests, so /metrics reports all of them whichever worker answers.
+    """
+
+    class TimedJSONEncoder(app.json_encoder):
+        def encode(self, o):
+            with timed("serialize"):
+                return super().encode(o)
+
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_timer():
+        g.metric_started = time.perf_counter()
+        g.metric_timings = defaultdict(float)
+        g.metric_queries = 0
+
+    @app.after_request
+    def record_request(response):
+        if "metric_started" not in g:
+            return response
+        total = time.perf_counter() - g.metric_started
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        labels = {"method": request.method, "route": route}
+        registry.inc(
+            "http_requests_total", dict(labels, status=str(response.status_code))
+        )
+        registry.observe("http_request_duration_seconds", labels, total)
+        registry.observe("http_request_sql_queries", labels, g.metric_queries)
+        for phase, seconds in g.metric_timings.items():
+            registry.observe(
+                "http_request_phase_seconds", dict(labels, phase=phase), seconds
+            )
+        if not response.is_streamed and response.content_length is not None:
+            registry.observe(
+                "http_response_size_bytes", labels, response.content_length
+            )
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = server_timing(g.metric_timings, total)
+        registry.flush()
+        return response
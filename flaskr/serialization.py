@@ -0,0 +1,95 @@
+import datetime
+import json
+import os
+from flask import current_app
+from .metrics import timed
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson")
+
+# bytes jsonify writes as they are, everything else is escaped as \uXXXX
+PRINTABLE_ASCII = bytes(range(0x7F))
+
+
+class JSONEncoder(json.JSONEncoder):
+    """Stdlib encoder writing dates as ISO 8601, like the orjson backend"""
+
+    def default(self, o):
+        if isinstance(o, datetime.date):
+            return o.isoformat()
+        return super().default(o)
+
+
+def _escape(char):
+    code = ord(char)
+    if code > 0xFFFF:
+        code -= 0x10000
+        return "\\u{:04x}\\u{:04x}".format(0xD800 | code >> 10, 0xDC00 | code & 0x3FF)
+    return "\\u{:04x}".format(code)
+
+
+def stdlib_dumps(payload):
+    return json.dumps(
+        payload, cls=JSONEncoder, sort_keys=True, separators=(",", ":")
+    ).encode()
+
+
+def orjson_dumps(payload):
+    """
+    orjson writes UTF-8 where the stdlib (and so jsonify) escapes everything
+    above "~"; those characters only occur inside strings, so replacing each
+    distinct one with its escape gives the stdlib bytes. Floats may be
+    formatted differently (1e16 against 1e+16), the API does not return any.
+    """
+    body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    for char in set(body.translate(None, PRINTABLE_ASCII).decode()):
+        body = body.replace(char.encode(), _escape(char).encode())
+    return body
+
+
+BACKENDS = {
+    "json": stdlib_dumps,
+    "orjson": orjson_dumps,
+}
+
+backend = BACKENDS[JSON_BACKEND if orjson is not None else "json"]
+
+
+def configure_json_backend(name):
+    global backend
+    if name == "orjson" and orjson is None:
+        raise ValueError("orjson is not installed")
+    backend = BACKENDS[name]
+    return backend
+
+
+def dumps(payload):
+    """
+    The body jsonify returns for payload, as bytes, with dates written as
+    ISO 8601. Pretty printing (debug mode) and non default JSON_AS_ASCII /
+    JSON_SORT_KEYS settings are encoded by the stdlib as jsonify would.
+    """
+    config = current_app.config
+    pretty = current_app.debug or config["JSONIFY_PRETTYPRINT_REGULAR"]
+    with timed("serialize"):
+        if pretty or not config["JSON_AS_ASCII"] or not config["JSON_SORT_KEYS"]:
+            body = json.dumps(
+                payload,
+                cls=JSONEncoder,
+                sort_keys=config["JSON_SORT_KEYS"],
+                ensure_ascii=config["JSON_AS_ASCII"],
+                indent=2 if pretty else None,
+                separators=(", ", ": ") if pretty else (",", ":"),
+            )
+            return (body + "\n").encode()
+        return backend(payload) + b"\n"
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(
+        dumps(payload), status=status, mimetype=current_app.config["JSONIFY_MIMETYPE"]
+    )
@@ -0,0 +1,18 @@
+# gunicorn reads this file from the working directory, for "gunicorn flaskr:app"
+# and "gunicorn -k uvicorn.workers.UvicornWorker flaskr.asgi:app" alike
+
+# imported here, once, not in child_exit: gunicorn calls that from its SIGCHLD
+# handler, and a second worker exiting mid-import breaks it
+from flaskr.metrics import registry, retire_worker
+
+
+def worker_exit(server, worker):
+    # in the worker: a worker recycled by max_requests or stopped on deploy
+    # flushes the numbers of its last requests
+    registry.flush(force=True)
+
+
+def child_exit(server, worker):
+    # in the master, for crashed and killed workers too: their gauges are
+    # dropped from /metrics, their counters kept
+    retire_worker(worker.pid)
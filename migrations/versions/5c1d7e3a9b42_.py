@@ -0,0 +1,32 @@
+"""add castings between movies and actors
+
+Revision ID: 5c1d7e3a9b42
+Revises: 2fa3b79ce10a
+Create Date: 2026-10-18 10:12:31.402817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1d7e3a9b42'
+down_revision = '2fa3b79ce10a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('castings',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_castings_actor_id', 'castings', ['actor_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_castings_actor_id', table_name='castings')
+    op.drop_table('castings')
@@ -0,0 +1,37 @@
+"""add indexes for the list filters and name lookups
+
+Revision ID: 8e2b4f6d1c07
+Revises: 5c1d7e3a9b42
+Create Date: 2026-10-18 11:40:05.118230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2b4f6d1c07'
+down_revision = '5c1d7e3a9b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_movies_genre_id', 'movies', ['genre', 'id'], unique=False)
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'], unique=False)
+    op.create_index('ix_actors_gender_id', 'actors', ['gender', 'id'], unique=False)
+    op.create_index('ix_actors_age', 'actors', ['age'], unique=False)
+    op.create_index('ix_actors_name_trgm', 'actors', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_actors_lower_name', 'actors',
+                    [sa.text('lower(name) text_pattern_ops')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_lower_name', table_name='actors')
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_actors_gender_id', table_name='actors')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_movies_genre_id', table_name='movies')
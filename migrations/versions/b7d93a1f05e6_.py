@@ -0,0 +1,39 @@
+"""add full-text search columns and indexes
+
+Revision ID: b7d93a1f05e6
+Revises: 8e2b4f6d1c07
+Create Date: 2026-10-18 13:02:47.530194
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d93a1f05e6'
+down_revision = '8e2b4f6d1c07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # generated columns, Postgres keeps them current on every insert and update
+    op.add_column('movies', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed(
+        "to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(genre, ''))", persisted=True)))
+    op.add_column('actors', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed(
+        "to_tsvector('simple', coalesce(name, ''))", persisted=True)))
+    op.create_index('ix_movies_search_vector', 'movies', ['search_vector'], unique=False,
+                    postgresql_using='gin')
+    op.create_index('ix_actors_search_vector', 'actors', ['search_vector'], unique=False,
+                    postgresql_using='gin')
+    op.create_index('ix_movies_title_trgm', 'movies', ['title'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_actors_search_vector', table_name='actors')
+    op.drop_index('ix_movies_search_vector', table_name='movies')
+    op.drop_column('actors', 'search_vector')
+    op.drop_column('movies', 'search_vector')
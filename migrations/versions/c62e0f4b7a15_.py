@@ -0,0 +1,71 @@
+"""add timestamps and the changes feed of /changes
+
+Revision ID: c62e0f4b7a15
+Revises: a9c4e7b2d813
+Create Date: 2026-10-18 18:26:40.517362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c62e0f4b7a15'
+down_revision = 'a9c4e7b2d813'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the existing rows get the default; UTC, like the datetime.utcnow of the models
+    for table in ('movies', 'actors'):
+        op.add_column(table, sa.Column('created_at', sa.DateTime(), server_default=sa.text("timezone('utc', now())"), nullable=False))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), server_default=sa.text("timezone('utc', now())"), nullable=False))
+    op.create_table('changes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('tx', sa.BigInteger(), nullable=False),
+    sa.Column('resource', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('deleted', sa.Boolean(), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_changes_tx_id', 'changes', ['tx', 'id'], unique=False)
+    op.create_index('ix_changes_resource_row_id', 'changes', ['resource', 'row_id'], unique=True)
+    # as for the count summaries, lock out writes between the backfill and the triggers
+    op.execute('LOCK TABLE movies, actors IN SHARE ROW EXCLUSIVE MODE')
+    for table in ('movies', 'actors'):
+        op.execute('''
+            CREATE OR REPLACE FUNCTION {table}_change() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    DELETE FROM changes WHERE resource = '{table}' AND row_id = OLD.id;
+                    INSERT INTO changes (tx, resource, row_id, deleted, changed_at)
+                    VALUES (txid_current(), '{table}', OLD.id, true, timezone('utc', now()));
+                ELSE
+                    DELETE FROM changes WHERE resource = '{table}' AND row_id = NEW.id;
+                    INSERT INTO changes (tx, resource, row_id, deleted, changed_at)
+                    VALUES (txid_current(), '{table}', NEW.id, false, timezone('utc', now()));
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        '''.format(table=table))
+        op.execute('CREATE TRIGGER {table}_change AFTER INSERT OR UPDATE OR DELETE '
+                   'ON {table} FOR EACH ROW EXECUTE PROCEDURE {table}_change()'.format(table=table))
+        # every existing row is a change for a client syncing from the start
+        op.execute("INSERT INTO changes (tx, resource, row_id, deleted, changed_at) "
+                   "SELECT txid_current(), '{table}', id, false, timezone('utc', now()) "
+                   "FROM {table} ORDER BY id".format(table=table))
+
+
+def downgrade():
+    for table in ('actors', 'movies'):
+        op.execute('DROP TRIGGER {table}_change ON {table}'.format(table=table))
+        op.execute('DROP FUNCTION {table}_change()'.format(table=table))
+    op.drop_index('ix_changes_resource_row_id', table_name='changes')
+    op.drop_index('ix_changes_tx_id', table_name='changes')
+    op.drop_table('changes')
+    for table in ('actors', 'movies'):
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'created_at')
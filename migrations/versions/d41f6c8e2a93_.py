@@ -0,0 +1,26 @@
+"""add version columns for optimistic concurrency
+
+Revision ID: d41f6c8e2a93
+Revises: b7d93a1f05e6
+Create Date: 2026-10-18 14:21:09.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f6c8e2a93'
+down_revision = 'b7d93a1f05e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('movies', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('actors', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('actors', 'version')
+    op.drop_column('movies', 'version')
@@ -0,0 +1,85 @@
+"""add movie and actor count summaries for /stats
+
+Revision ID: f3a82c5d7b19
+Revises: d41f6c8e2a93
+Create Date: 2026-10-18 15:02:33.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a82c5d7b19'
+down_revision = 'd41f6c8e2a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movie_counts',
+    sa.Column('genre', sa.String(), nullable=False),
+    sa.Column('year', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('genre', 'year')
+    )
+    op.create_table('actor_counts',
+    sa.Column('gender', sa.String(), nullable=False),
+    sa.Column('age', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('gender', 'age')
+    )
+    # the triggers keep the counts current from here on, existing rows are
+    # counted once; lock the tables so no write slips in between
+    op.execute('LOCK TABLE movies, actors IN SHARE ROW EXCLUSIVE MODE')
+    op.execute('''
+        CREATE OR REPLACE FUNCTION movies_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                UPDATE movie_counts SET count = count - 1
+                WHERE genre = OLD.genre
+                AND year = CAST(extract(year FROM OLD.release_date) AS INTEGER);
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO movie_counts (genre, year, count)
+                VALUES (NEW.genre, CAST(extract(year FROM NEW.release_date) AS INTEGER), 1)
+                ON CONFLICT (genre, year) DO UPDATE SET count = movie_counts.count + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE OR REPLACE FUNCTION actors_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                UPDATE actor_counts SET count = count - 1
+                WHERE gender = OLD.gender AND age = OLD.age;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO actor_counts (gender, age, count)
+                VALUES (NEW.gender, NEW.age, 1)
+                ON CONFLICT (gender, age) DO UPDATE SET count = actor_counts.count + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('CREATE TRIGGER movies_count AFTER INSERT OR DELETE OR UPDATE OF genre, release_date '
+               'ON movies FOR EACH ROW EXECUTE PROCEDURE movies_count()')
+    op.execute('CREATE TRIGGER actors_count AFTER INSERT OR DELETE OR UPDATE OF gender, age '
+               'ON actors FOR EACH ROW EXECUTE PROCEDURE actors_count()')
+    op.execute('INSERT INTO movie_counts (genre, year, count) '
+               'SELECT genre, CAST(extract(year FROM release_date) AS INTEGER), count(*) '
+               'FROM movies GROUP BY 1, 2')
+    op.execute('INSERT INTO actor_counts (gender, age, count) '
+               'SELECT gender, age, count(*) FROM actors GROUP BY 1, 2')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER actors_count ON actors')
+    op.execute('DROP TRIGGER movies_count ON movies')
+    op.execute('DROP FUNCTION actors_count()')
+    op.execute('DROP FUNCTION movies_count()')
+    op.drop_table('actor_counts')
+    op.drop_table('movie_counts')
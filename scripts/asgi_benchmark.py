@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Compares how many concurrent connections one worker serves through the WSGI
+app run like a sync gunicorn worker (one request at a time) and through the
+ASGI entry point, with the identity provider and every SQL statement slowed
+down artificially:
+
+    python scripts/asgi_benchmark.py --db-latency 0.02 --idp-latency 0.3
+
+Requests are sent straight to the ASGI callable, no server or network is
+involved, so the numbers show the concurrency of the worker only.
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# in memory, so no real database gets the synthetic rows; its latency is
+# simulated with --db-latency anyway
+os.environ["DATABASE_URI"] = "sqlite://"
+
+from sqlalchemy import event
+from flaskr import create_app
+from flaskr.asgi import ASGIApp
+from flaskr.auth import auth
+from flaskr.cache import LRUBackend, configure_response_cache
+from flaskr.database.models import db, Actor, Movie, create_and_drop_all
+from scripts.fake_idp import FakeIdP
+
+
+def seed(rows):
+    db.session.add_all(
+        [
+            Actor(name="Actor {}".format(i), age=20 + i % 50, gender="male")
+            for i in range(rows)
+        ]
+    )
+    db.session.add_all(
+        [
+            Movie(
+                title="Movie {}".format(i),
+                release_date=datetime.date(2000 + i % 20, 1, 1),
+                genre="Drama",
+            )
+            for i in range(rows)
+        ]
+    )
+    db.session.commit()
+
+
+async def request(app, path, token):
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "path": path.split("?")[0],
+        "query_string": path.partition("?")[2].encode(),
+        "headers": [(b"authorization", "Bearer {}".format(token).encode())],
+    }
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+async def run(app, tokens, requests, concurrency):
+    """Sends requests over concurrency connections, returns the latencies"""
+    paths = ["/actors?limit=20", "/actors/{}/movies", "/movies/{}"]
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with slots:
+            started = time.perf_counter()
+            path = paths[i % len(paths)].format(1 + i % 50)
+            status = await request(app, path, tokens[i % len(tokens)])
+            if status != 200:
+                raise RuntimeError("{} answered {}".format(path, status))
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument(
+        "--concurrency",
+        default="1,8,32,64",
+        help="comma separated numbers of open connections",
+    )
+    parser.add_argument("--threads", type=int, default=32, help="ASGI_THREADS")
+    parser.add_argument("--db-latency", type=float, default=0.01, help="per statement")
+    parser.add_argument("--idp-latency", type=float, default=0.3, help="per JWKS fetch")
+    options = parser.parse_args()
+
+    idp = FakeIdP(latency=options.idp_latency, key_size=1024)
+    app = create_app()
+    # every request has to reach the database
+    configure_response_cache(LRUBackend(maxsize=0))
+    with app.app_context():
+        create_and_drop_all()
+        seed(50)
+        engine = db.get_engine()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def slow_statement(conn, cursor, statement, parameters, context, executemany):
+        time.sleep(options.db_latency)
+
+    tokens = [idp.token("assistant", "benchmark|{}".format(i)) for i in range(50)]
+    print(
+        "{:>11} {:>8} {:>9} {:>9} {:>9}".format(
+            "connections", "server", "req/s", "p50 ms", "p99 ms"
+        )
+    )
+    for concurrency in map(int, options.concurrency.split(",")):
+        for name, threads in (("sync", 1), ("asgi", options.threads)):
+            # cold caches, so every run pays for the slow identity provider once
+            auth.configure_jwks(idp.fetch)
+            auth.token_cache.clear()
+            started = time.perf_counter()
+            latencies = asyncio.run(
+                run(ASGIApp(app, threads), tokens, options.requests, concurrency)
+            )
+            elapsed = time.perf_counter() - started
+            print(
+                "{:>11} {:>8} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                    concurrency,
+                    name,
+                    options.requests / elapsed,
+                    latencies[len(latencies) // 2] * 1000,
+                    latencies[int(len(latencies) * 0.99) - 1] * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Times inserting actors through bulk_insert, as POST /actors/bulk does,
+against one Actor.insert commit per row, the way POST /actors used to:
+
+    python scripts/bulk_benchmark.py --rows 2000,20000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# in memory, so no real database gets the synthetic rows
+os.environ["DATABASE_URI"] = "sqlite://"
+
+from flaskr import create_app
+from flaskr.database.bulk import bulk_insert
+from flaskr.database.models import db, Actor, create_and_drop_all
+
+
+def actors(count):
+    return [
+        {"name": "Actor {}".format(i), "age": 20 + i % 50, "gender": "male"}
+        for i in range(count)
+    ]
+
+
+def per_row(rows):
+    for row in rows:
+        Actor(**row).insert()
+
+
+def bulk(rows):
+    results = bulk_insert(Actor, rows)
+    if not all(result["success"] for result in results):
+        sys.exit("bulk_insert failed")
+
+
+def timed(f, rows):
+    db.session.execute(Actor.__table__.delete())
+    db.session.commit()
+    started = time.perf_counter()
+    f(rows)
+    elapsed = time.perf_counter() - started
+    if Actor.query.count() != len(rows):
+        sys.exit("{} did not insert every row".format(f.__name__))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", default="2000,20000", help="comma separated")
+    options = parser.parse_args()
+
+    app = create_app()
+    with app.test_request_context():
+        create_and_drop_all()
+        print(
+            "{:>8} {:>16} {:>16} {:>8}".format(
+                "rows", "per row rows/s", "bulk rows/s", "speedup"
+            )
+        )
+        for count in map(int, options.rows.split(",")):
+            rows = actors(count)
+            baseline = timed(per_row, rows)
+            elapsed = timed(bulk, rows)
+            print(
+                "{:>8} {:>16.0f} {:>16.0f} {:>7.1f}x".format(
+                    count, count / baseline, count / elapsed, baseline / elapsed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
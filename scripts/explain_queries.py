@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Runs EXPLAIN ANALYZE on every query the read endpoints, search, /stats,
+/changes and the import workers generate and exits with 1 when the planner
+falls back to a sequential scan on actors, movies, castings, changes or
+import_jobs, or walks an index discarding more than --max-filtered rows
+(e.g. the primary key scanned in id order to find a handful of matches).
+Plans on small tables are meaningless, so seed first:
+
+    DATABASE_URI=postgresql://.../casting_agency_explain \\
+        python scripts/explain_queries.py --seed 200000
+
+--seed creates the tables and inserts synthetic rows, only point it at a
+scratch database. Without it the audit leaves the database as it was: the
+captured paths (claim_job takes a queued import job) and the EXPLAIN ANALYZE
+runs, which execute every statement again, share one transaction that is
+rolled back at the end.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import selectinload
+from werkzeug.datastructures import MultiDict
+from flaskr import create_app
+from flaskr.database.models import (
+    db,
+    Actor,
+    Movie,
+    ImportJob,
+    changes,
+    create_and_drop_all,
+)
+from flaskr.database.changes import change_feed, format_cursor
+from flaskr.database.queries import paginate
+from flaskr.database.search import search
+from flaskr.database.stats import movie_stats, actor_stats
+from flaskr.imports import claim_job
+
+# the count summaries of /stats are small by design, a scan of them is fine
+CHECKED_TABLES = {"actors", "movies", "castings", "changes", "import_jobs"}
+GENRES = ["Drama", "Action", "Comedy", "Fantasy", "Horror", "Documentary"]
+
+LIST_QUERIES = [
+    (Actor, {}),
+    (Actor, {"after": "5000", "limit": "50"}),
+    (Actor, {"fields": "name"}),
+    (Actor, {"gender": "female"}),
+    (Actor, {"min_age": "30", "max_age": "32"}),
+    (Actor, {"name": "actor 12"}),
+    (Actor, {"include": "cast"}),
+    (Movie, {}),
+    (Movie, {"genre": "Horror"}),
+    (Movie, {"release_date_from": "2001-01-01", "release_date_to": "2001-02-01"}),
+    (Movie, {"include": "cast"}),
+]
+
+SEARCH_QUERIES = [
+    (Actor, {"q": "actor 1234"}),
+    (Actor, {"q": "act", "limit": "50", "offset": "50"}),
+    (Movie, {"q": "movie 1234"}),
+    (Movie, {"q": "mov"}),
+]
+
+
+def seed(count, chunk_size=10000):
+    actors = Actor.__table__.insert()
+    movies = Movie.__table__.insert()
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        db.session.execute(
+            actors,
+            [
+                {
+                    "name": "Actor {}".format(start + i),
+                    "age": random.randint(18, 90),
+                    "gender": random.choice(["male", "female"]),
+                }
+                for i in range(size)
+            ],
+        )
+        db.session.execute(
+            movies,
+            [
+                {
+                    "title": "Movie {}".format(start + i),
+                    "release_date": datetime.date(1950, 1, 1)
+                    + datetime.timedelta(days=random.randint(0, 27000)),
+                    "genre": random.choice(GENRES),
+                }
+                for i in range(size)
+            ],
+        )
+    db.session.commit()
+    db.session.execute(
+        text(
+            "INSERT INTO castings (movie_id, actor_id) "
+            "SELECT movies.id, actors.id FROM movies JOIN actors "
+            "ON actors.id BETWEEN movies.id AND movies.id + 2 "
+            "ON CONFLICT DO NOTHING"
+        )
+    )
+    db.session.commit()
+    # mostly finished imports, as in a long running deployment, a few queued
+    now = datetime.datetime.utcnow()
+    db.session.execute(
+        ImportJob.__table__.insert(),
+        [
+            {
+                "resource": "actors",
+                "format": "csv",
+                "status": "done" if i < count // 10 else "queued",
+                "created_at": now,
+            }
+            for i in range(count // 10 + 5)
+        ],
+    )
+    db.session.commit()
+
+
+@contextmanager
+def rolled_back():
+    """
+    Binds db.session to one connection whose transaction is rolled back on
+    exit. The commits inside only release a savepoint, started again right
+    away, so the code run sees its own writes.
+    """
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    connection.begin_nested()
+
+    def restart_savepoint(session, ended):
+        if not connection.in_nested_transaction():
+            connection.begin_nested()
+
+    session = db.session
+    db.session = db.create_scoped_session({"bind": connection, "binds": {}})
+    event.listen(db.session, "after_transaction_end", restart_savepoint)
+    try:
+        yield
+    finally:
+        db.session.remove()
+        event.remove(db.session, "after_transaction_end", restart_savepoint)
+        db.session = session
+        transaction.rollback()
+        connection.close()
+
+
+def capture_statements(app):
+    """Runs the read paths of the API and returns the SQL they sent"""
+    statements = []
+    middle_change = (
+        db.session.query(changes.c.tx, changes.c.id)
+        .order_by(changes.c.tx, changes.c.id)
+        .offset(db.session.query(changes).count() // 2)
+        .first()
+    )
+    since = format_cursor(*middle_change) if middle_change else ""
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        # the savepoints come from rolled_back, not from the app
+        if "SAVEPOINT" not in statement:
+            statements.append((statement, parameters))
+
+    engine = db.get_engine()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        for model, args in LIST_QUERIES:
+            with app.test_request_context():
+                paginate(model, MultiDict(args))
+        for model, args in SEARCH_QUERIES:
+            with app.test_request_context():
+                search(model, MultiDict(args))
+        movie_stats()
+        actor_stats()
+        for args in ({}, {"since": since}, {"since": since, "resource": "movies"}):
+            change_feed(MultiDict(args), ["actors", "movies"])
+        claim_job()
+        middle = db.session.query(db.func.max(Actor.id)).scalar() // 2
+        Actor.query.get(middle)
+        Movie.query.get(middle)
+        Actor.query.options(selectinload(Actor.movies)).filter(Actor.id == middle).all()
+        Movie.query.options(selectinload(Movie.actors)).filter(Movie.id == middle).all()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+
+def full_scans(plan, max_filtered):
+    found = []
+    if plan.get("Relation Name") in CHECKED_TABLES:
+        if plan["Node Type"] == "Seq Scan":
+            found.append("seq scan on " + plan["Relation Name"])
+        elif plan.get("Rows Removed by Filter", 0) > max_filtered:
+            found.append(
+                "{} rows filtered out of {} on {}".format(
+                    plan["Rows Removed by Filter"],
+                    plan.get("Index Name", plan["Node Type"]),
+                    plan["Relation Name"],
+                )
+            )
+    for child in plan.get("Plans", []):
+        found += full_scans(child, max_filtered)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seed", type=int, default=0, help="rows to insert first")
+    parser.add_argument(
+        "--max-filtered",
+        type=int,
+        default=10000,
+        help="rows a scan may discard before it counts as a full scan",
+    )
+    parser.add_argument("--verbose", action="store_true", help="print every plan")
+    options = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if db.engine.dialect.name != "postgresql":
+            sys.exit("EXPLAIN audit needs a PostgreSQL DATABASE_URI")
+        if options.seed:
+            create_and_drop_all()
+            seed(options.seed)
+        db.session.execute(text("ANALYZE"))
+        db.session.commit()
+        db.session.remove()
+
+        failures = 0
+        with rolled_back():
+            for statement, parameters in capture_statements(app):
+                plan = (
+                    db.session.connection()
+                    .exec_driver_sql(
+                        "EXPLAIN (ANALYZE, FORMAT JSON) " + statement, parameters
+                    )
+                    .scalar()
+                )
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                scans = full_scans(plan[0]["Plan"], options.max_filtered)
+                if scans or options.verbose:
+                    print(
+                        "{}: {}".format(
+                            "FAIL " + ", ".join(scans) if scans else "ok",
+                            " ".join(statement.split()),
+                        )
+                    )
+                if options.verbose:
+                    print(json.dumps(plan[0]["Plan"], indent=2))
+                failures += bool(scans)
+
+    print("{} queries fell back to a full scan".format(failures))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Local stand-in for the Auth0 tenant, for benchmarks and load tests: a JWKS
+document, served over HTTP or fetched in process, and RS256 tokens for the
+roles of the casting agency (DEFAULT_ROLES) signed with the matching key.
+"""
+
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwt
+from flaskr.auth import auth
+from flaskr.auth.policy import DEFAULT_ROLES
+
+
+def _b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+class FakeIdP:
+    """
+    Signs tokens accepted by requires_auth (issuer and audience come from
+    AUTH0_DOMAIN and API_AUDIENCE). latency delays every JWKS fetch, to play
+    a slow identity provider.
+    """
+
+    def __init__(self, latency=0, kid="fake-idp", key_size=2048):
+        self.latency = latency
+        self.kid = kid
+        public_key, private_key = rsa.newkeys(key_size)
+        self.private_key = private_key.save_pkcs1().decode()
+        self.jwks = {
+            "keys": [
+                {
+                    "kty": "RSA",
+                    "kid": kid,
+                    "use": "sig",
+                    "alg": "RS256",
+                    "n": _b64_uint(public_key.n),
+                    "e": _b64_uint(public_key.e),
+                }
+            ]
+        }
+        self.fetches = 0
+        self._server = None
+
+    def fetch(self):
+        """JWKS fetcher for auth.configure_jwks, without the HTTP round trip"""
+        self.fetches += 1
+        time.sleep(self.latency)
+        return self.jwks
+
+    def token(self, role, sub=None, expires_in=3600):
+        """token listing the permissions of role in its permissions claim"""
+        return self.sign(
+            list(DEFAULT_ROLES[role]),
+            sub=sub or "fake-idp|{}".format(role),
+            expires_in=expires_in,
+        )
+
+    def sign(
+        self, permissions, sub="fake-idp|user", expires_in=3600, roles=None, kid=None
+    ):
+        """
+        token granting permissions, and roles through the policy's roles claim
+        when given; kid replaces the key id of the header, e.g. with an unknown one
+        """
+        now = int(time.time())
+        claims = {
+            "iss": "https://{}/".format(auth.AUTH0_DOMAIN),
+            "sub": sub,
+            "iat": now,
+            "exp": now + expires_in,
+            "permissions": permissions,
+        }
+        if roles is not None:
+            claims[auth.policy.roles_claim] = roles
+        if auth.API_AUDIENCE:
+            claims["aud"] = auth.API_AUDIENCE
+        return jwt.encode(
+            claims,
+            self.private_key,
+            algorithm="RS256",
+            headers={"kid": kid or self.kid},
+        )
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Serves /.well-known/jwks.json from a background thread, returns its URL"""
+        idp = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/.well-known/jwks.json":
+                    self.send_error(404)
+                    return
+                body = json.dumps(idp.fetch()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return "http://{}:{}/.well-known/jwks.json".format(
+            host, self._server.server_address[1]
+        )
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
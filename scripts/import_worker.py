@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Runs the import jobs queued by POST /imports/actors and /imports/movies in
+a process of its own, so the web processes only store the uploads. Start
+the web tier with IMPORT_WORKERS=0 and as many of these as needed:
+
+    DATABASE_URI=postgresql://.../casting_agency \\
+        python scripts/import_worker.py --threads 2
+
+Several workers, on one host or more, share the queue in import_jobs.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app
+from flaskr.imports import ImportWorkers, IMPORT_POLL_SECONDS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=1, help="jobs run at once")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=IMPORT_POLL_SECONDS,
+        help="seconds between looks at the queue when it is empty",
+    )
+    options = parser.parse_args()
+
+    workers = ImportWorkers(options.threads, options.poll_interval)
+    workers.start(create_app())
+    try:
+        workers.join()
+    except KeyboardInterrupt:
+        workers.stop()
+
+
+if __name__ == "__main__":
+    main()
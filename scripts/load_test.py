@@ -0,0 +1,365 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Runs a scripted mix of list, search, create, patch and delete requests
+against the app, served over HTTP on a local port, with tokens for the
+assistant, director and producer roles signed by a fake identity provider
+(scripts/fake_idp.py). Reports requests per second and p50/p95/p99
+latency per endpoint, and saves them as JSON to compare runs:
+
+    python scripts/load_test.py --mix mixed --duration 30 --output before.json
+    python scripts/load_test.py --mix mixed --duration 30 --compare before.json
+
+The database is LOAD_TEST_DATABASE_URI, an in memory SQLite database by
+default; --seed inserts synthetic rows, only point it at a scratch database.
+SQLite is served one request at a time, other databases by a threaded server.
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["DATABASE_URI"] = os.getenv("LOAD_TEST_DATABASE_URI", "sqlite://")
+
+from werkzeug.serving import make_server
+from flaskr import create_app
+from flaskr.auth import auth
+from flaskr.auth.jwks import url_fetcher
+from flaskr.auth.rate_limit import MemoryBuckets
+from flaskr.database.models import db, Actor, Movie, create_and_drop_all
+from scripts.fake_idp import FakeIdP
+
+GENDERS = ["female", "male"]
+GENRES = ["Drama", "Action", "Comedy", "Fantasy", "Horror", "Documentary"]
+
+
+def seed(count):
+    db.session.execute(
+        Actor.__table__.insert(),
+        [
+            {
+                "name": "Actor {}".format(i),
+                "age": 18 + i % 70,
+                "gender": GENDERS[i % len(GENDERS)],
+            }
+            for i in range(count)
+        ],
+    )
+    db.session.execute(
+        Movie.__table__.insert(),
+        [
+            {
+                "title": "Movie {}".format(i),
+                "release_date": datetime.date(1950, 1, 1)
+                + datetime.timedelta(days=i % 27000),
+                "genre": GENRES[i % len(GENRES)],
+            }
+            for i in range(count)
+        ],
+    )
+    db.session.commit()
+
+
+class Worker:
+    """
+    One client connection sending requests back to back. Every operation
+    returns (endpoint, role, method, path, body), or None when it does not
+    apply yet (nothing created to delete).
+    """
+
+    def __init__(self, port, tokens, ids, mix, rng):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        self.tokens = tokens
+        self.ids = ids
+        self.created = {"actors": [], "movies": []}
+        self.operations, self.weights = zip(*mix)
+        self.rng = rng
+        self.latencies = {}
+        self.errors = {}
+
+    def list_actors(self):
+        return "GET /actors", "assistant", "GET", "/actors?limit=20", None
+
+    def list_movies(self):
+        return "GET /movies", "assistant", "GET", "/movies?limit=20", None
+
+    def get_actor(self):
+        path = "/actors/{}".format(self.rng.choice(self.ids["actors"]))
+        return "GET /actors/<id>", "assistant", "GET", path, None
+
+    def get_movie(self):
+        path = "/movies/{}".format(self.rng.choice(self.ids["movies"]))
+        return "GET /movies/<id>", "assistant", "GET", path, None
+
+    def search(self):
+        path = "/search?q=actor+{}".format(self.rng.randrange(100))
+        return "GET /search", "assistant", "GET", path, None
+
+    def create_actor(self):
+        body = {
+            "name": "Load actor {}".format(self.rng.randrange(10 ** 6)),
+            "age": self.rng.randint(18, 90),
+            "gender": self.rng.choice(GENDERS),
+        }
+        return "POST /actors", "director", "POST", "/actors", body
+
+    def create_movie(self):
+        body = {
+            "title": "Load movie {}".format(self.rng.randrange(10 ** 6)),
+            "release_date": "20{:02d}-01-01".format(self.rng.randrange(30)),
+            "genre": self.rng.choice(GENRES),
+        }
+        return "POST /movies", "producer", "POST", "/movies", body
+
+    def patch_actor(self):
+        path = "/actors/{}".format(self.rng.choice(self.ids["actors"]))
+        body = {"age": self.rng.randint(18, 90)}
+        return "PATCH /actors/<id>", "director", "PATCH", path, body
+
+    def patch_movie(self):
+        path = "/movies/{}".format(self.rng.choice(self.ids["movies"]))
+        body = {"genre": self.rng.choice(GENRES)}
+        return "PATCH /movies/<id>", "producer", "PATCH", path, body
+
+    def delete_actor(self):
+        if not self.created["actors"]:
+            return None
+        path = "/actors/{}".format(self.created["actors"].pop())
+        return "DELETE /actors/<id>", "director", "DELETE", path, None
+
+    def delete_movie(self):
+        if not self.created["movies"]:
+            return None
+        path = "/movies/{}".format(self.created["movies"].pop())
+        return "DELETE /movies/<id>", "producer", "DELETE", path, None
+
+    def send(self, method, path, body, role):
+        headers = {"Authorization": "Bearer {}".format(self.tokens[role])}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return None, b""
+
+    def run(self, deadline):
+        while time.perf_counter() < deadline:
+            operation = None
+            while operation is None:
+                name = self.rng.choices(self.operations, self.weights)[0]
+                operation = getattr(self, name)()
+            endpoint, role, method, path, body = operation
+            started = time.perf_counter()
+            status, data = self.send(method, path, body, role)
+            self.latencies.setdefault(endpoint, []).append(
+                time.perf_counter() - started
+            )
+            if status != 200:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            elif method == "POST":
+                created = json.loads(data)
+                for table in ("actors", "movies"):
+                    key = table[:-1] + "_id"
+                    if key in created:
+                        self.created[table].append(created[key])
+
+
+READS = [
+    ("list_actors", 35),
+    ("list_movies", 30),
+    ("get_actor", 15),
+    ("get_movie", 15),
+    ("search", 5),
+]
+WRITES = [
+    ("create_actor", 20),
+    ("create_movie", 15),
+    ("patch_actor", 25),
+    ("patch_movie", 20),
+    ("delete_actor", 12),
+    ("delete_movie", 8),
+]
+MIXES = {
+    "read": READS,
+    "write": WRITES,
+    "mixed": [(name, weight * 8) for name, weight in READS]
+    + [(name, weight * 2) for name, weight in WRITES],
+}
+
+
+def percentile(latencies, p):
+    """Nearest rank percentile of sorted latencies, in milliseconds"""
+    index = max(0, math.ceil(p / 100 * len(latencies)) - 1)
+    return round(latencies[index] * 1000, 2)
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def report(workers, elapsed):
+    latencies = {}
+    errors = {}
+    for worker in workers:
+        for endpoint, timings in worker.latencies.items():
+            latencies.setdefault(endpoint, []).extend(timings)
+        for endpoint, count in worker.errors.items():
+            errors[endpoint] = errors.get(endpoint, 0) + count
+    endpoints = {
+        endpoint: summarize(timings, errors.get(endpoint, 0), elapsed)
+        for endpoint, timings in sorted(latencies.items())
+    }
+    total = summarize(
+        [timing for timings in latencies.values() for timing in timings],
+        sum(errors.values()),
+        elapsed,
+    )
+    return endpoints, total
+
+
+def print_results(results, baseline=None):
+    rows = dict(results["endpoints"], total=results["total"])
+    previous = {}
+    if baseline is not None:
+        previous = dict(baseline["endpoints"], total=baseline["total"])
+    print(
+        "{:<20} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"
+        )
+    )
+    for endpoint, row in rows.items():
+        print(
+            "{:<20} {:>8} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                endpoint,
+                row["requests"],
+                row["errors"],
+                row["rps"],
+                row["p50_ms"],
+                row["p95_ms"],
+                row["p99_ms"],
+            )
+        )
+        if endpoint in previous:
+            before = previous[endpoint]
+            print(
+                "{:<20} {:>8} {:>7} {:>+8.0%} {:>+8.0%} {:>+8.0%} {:>+8.0%}".format(
+                    "  vs baseline",
+                    "",
+                    "",
+                    *[
+                        row[key] / before[key] - 1 if before[key] else 0
+                        for key in ("rps", "p50_ms", "p95_ms", "p99_ms")
+                    ]
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=8, help="connections")
+    parser.add_argument("--seed", type=int, default=1000, help="rows per table")
+    parser.add_argument("--idp-latency", type=float, default=0, help="per JWKS fetch")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--output", help="file the results are saved to as JSON")
+    parser.add_argument("--compare", help="results of a previous run, as JSON")
+    options = parser.parse_args()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    idp = FakeIdP(latency=options.idp_latency)
+    auth.configure_jwks(url_fetcher(idp.serve()))
+    auth.token_cache.clear()
+    # every client shares one address and one subject per role
+    auth.configure_rate_limiter(MemoryBuckets(), ip_limit=None, limits={})
+    tokens = {role: idp.token(role) for role in ("assistant", "director", "producer")}
+
+    app = create_app()
+    with app.app_context():
+        create_and_drop_all()
+        if options.seed:
+            seed(options.seed)
+        ids = {
+            "actors": [row.id for row in db.session.query(Actor.id)],
+            "movies": [row.id for row in db.session.query(Movie.id)],
+        }
+        database = db.engine.dialect.name
+    if not ids["actors"] or not ids["movies"]:
+        sys.exit("the database has no actors or movies, use --seed")
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=database != "sqlite")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    started_at = datetime.datetime.utcnow().isoformat() + "Z"
+    rng = random.Random(options.random_seed)
+    workers = [
+        Worker(
+            server.server_port,
+            tokens,
+            ids,
+            MIXES[options.mix],
+            random.Random(rng.random()),
+        )
+        for _ in range(options.concurrency)
+    ]
+    started = time.perf_counter()
+    deadline = started + options.duration
+    threads = [
+        threading.Thread(target=worker.run, args=(deadline,)) for worker in workers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    idp.shutdown()
+
+    endpoints, total = report(workers, elapsed)
+    results = {
+        "started_at": started_at,
+        "mix": options.mix,
+        "duration": round(elapsed, 2),
+        "concurrency": options.concurrency,
+        "seed": options.seed,
+        "database": database,
+        "endpoints": endpoints,
+        "total": total,
+    }
+    print_results(results, baseline)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if total["errors"]:
+        sys.exit("{} requests failed".format(total["errors"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Times one permission check made the old way (a scan of the permissions claim)
+against the bitset compiled by the policy, for tokens holding more and more
+permissions, and checks that both agree:
+
+    python scripts/permission_benchmark.py --permissions 8,64,512
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr.auth.policy import PermissionPolicy
+from flaskr.auth.token_cache import VerifiedToken
+
+RESOURCES = ["actors", "movies"]
+
+
+def claims(count):
+    """count fine grained permissions, the ones the routes require last"""
+    permissions = [
+        "view:movies:genre{}".format(i) for i in range(count - 2 * len(RESOURCES))
+    ]
+    return (
+        permissions
+        + ["view:" + resource for resource in RESOURCES]
+        + ["add:" + resource for resource in RESOURCES]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--permissions", default="8,64,512", help="comma separated")
+    parser.add_argument("--checks", type=int, default=1000000)
+    options = parser.parse_args()
+
+    print(
+        "{:>12} {:>14} {:>14} {:>8} {:>12}".format(
+            "permissions", "scan ns", "bitset ns", "speedup", "compile us"
+        )
+    )
+    for count in map(int, options.permissions.split(",")):
+        payload = {"permissions": claims(count)}
+        policy = PermissionPolicy()
+        required = "add:movies"
+        bit = policy.require(required)
+        for permission in payload["permissions"]:
+            policy.require(permission)
+        entry = VerifiedToken(payload, None)
+        if entry.has_permission(bit, policy) != (required in payload["permissions"]):
+            sys.exit("bitset and scan disagree with {} permissions".format(count))
+
+        scan = min(
+            timeit.repeat(
+                lambda: required in payload["permissions"],
+                number=options.checks,
+                repeat=3,
+            )
+        )
+        bitset = min(
+            timeit.repeat(
+                lambda: entry.has_permission(bit, policy),
+                number=options.checks,
+                repeat=3,
+            )
+        )
+        compile_time = min(
+            timeit.repeat(
+                lambda: (policy._compiled.clear(), policy.compile(payload)),
+                number=100,
+                repeat=3,
+            )
+        )
+        print(
+            "{:>12} {:>14.1f} {:>14.1f} {:>7.1f}x {:>12.1f}".format(
+                count,
+                scan / options.checks * 1e9,
+                bitset / options.checks * 1e9,
+                scan / bitset,
+                compile_time / 100 * 1e6,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
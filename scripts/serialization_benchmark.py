@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Times a page of movies built the old way (ORM entities, get_formatted_json,
+jsonify) against column tuples encoded by serialization.dumps with each JSON
+backend, and checks that all of them produce the same bytes:
+
+    python scripts/serialization_benchmark.py --rows 10000,100000
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# in memory, so no real database gets the synthetic rows
+os.environ["DATABASE_URI"] = "sqlite://"
+
+from flask import jsonify
+from flaskr import create_app, serialization
+from flaskr.database.models import db, Movie, create_and_drop_all
+from flaskr.database.queries import LIST_FIELDS, format_row
+
+GENRES = ["Drama", "Action", "Comédie", "Fantasy"]
+
+
+def seed(count):
+    db.session.execute(Movie.__table__.delete())
+    db.session.execute(
+        Movie.__table__.insert(),
+        [
+            {
+                "title": "Movie {}".format(i),
+                "release_date": datetime.date(1950, 1, 1)
+                + datetime.timedelta(days=i % 27000),
+                "genre": GENRES[i % len(GENRES)],
+            }
+            for i in range(count)
+        ],
+    )
+    db.session.commit()
+
+
+def orm_page():
+    movies = Movie.query.order_by(Movie.id).all()
+    return jsonify(
+        {"success": True, "movies": [movie.get_formatted_json() for movie in movies]}
+    ).get_data()
+
+
+def tuple_page():
+    fields = LIST_FIELDS[Movie]
+    rows = (
+        db.session.query(*[getattr(Movie, field) for field in fields])
+        .order_by(Movie.id)
+        .all()
+    )
+    return serialization.dumps(
+        {"success": True, "movies": [format_row(fields, row) for row in rows]}
+    )
+
+
+def best_of(repeat, f):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        body = f()
+        timings.append(time.perf_counter() - started)
+    return min(timings), body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", default="10000,100000", help="comma separated")
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    app = create_app()
+    app.debug = False
+    with app.test_request_context():
+        create_and_drop_all()
+        print("{:>8} {:>22} {:>10} {:>8}".format("rows", "path", "ms", "speedup"))
+        for count in map(int, options.rows.split(",")):
+            seed(count)
+            baseline, expected = best_of(options.repeat, orm_page)
+            print(
+                "{:>8} {:>22} {:>10.1f}".format(count, "orm + jsonify", baseline * 1000)
+            )
+            for backend in ("json", "orjson"):
+                serialization.configure_json_backend(backend)
+                elapsed, body = best_of(options.repeat, tuple_page)
+                if body != expected:
+                    sys.exit("{} backend output differs from jsonify".format(backend))
+                print(
+                    "{:>8} {:>22} {:>10.1f} {:>7.1f}x".format(
+                        count,
+                        "tuples + " + backend,
+                        elapsed * 1000,
+                        baseline / elapsed,
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
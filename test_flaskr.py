@@ -1,47 +1,209 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import os
+import gzip
+import io
 import json
+import datetime
+import time
+import inspect
+import tempfile
+import asyncio
+import subprocess
+import sys
+import threading
 import unittest
-from flaskr.database.models import setup_db, Movie, Actor, \
-    create_and_drop_all
+import zlib
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from flaskr.database.models import setup_db, Movie, Actor, ImportJob, \
+    create_and_drop_all, db
+import flaskr
 from flaskr import create_app
-from flask_sqlalchemy import SQLAlchemy
+from flaskr.auth import auth
+from flaskr.auth.jwks import JWKSKeyStore, file_fetcher
+from flaskr.auth.token_cache import TokenCache
+from flaskr.auth.policy import PermissionPolicy, parse_roles, DEFAULT_ROLES
+from flaskr.auth.rate_limit import MemoryBuckets, parse_limits
+from flaskr import cache
+from flaskr.cache import LRUBackend, SharedBackend, configure_response_cache
+from flaskr.database.pool import InstrumentedQueuePool, engine_options, pool_stats
+from flaskr import metrics
+from flaskr.asgi import ASGIApp
+from scripts.fake_idp import FakeIdP
+from uvicorn.middleware.wsgi import WSGIResponder
+from flaskr import imports
+from flaskr import serialization
+from flaskr import compression
+from flaskr.database.replicas import replica_set, reads_from, STICKY_COOKIE
+from sqlalchemy import exc
+from flask import jsonify
 
 DIRECTOR_TOKEN = os.getenv('DIRECTOR_TOKEN')
 ASSISTANT_TOKEN = os.getenv('ASSISTANT_TOKEN')
 PRODUCER_TOKEN = os.getenv('PRODUCER_TOKEN')
 
 TEST_DATABASE_URI = os.getenv('TEST_DATABASE_URI')
+# the local test cases drop and recreate their schema, so they never share TEST_DATABASE_URI
+LOCAL_DATABASE_URI = os.getenv('LOCAL_TEST_DATABASE_URI', 'sqlite://')
 
+LOCAL_KID = 'local-test-key'
+ASSISTANT_PERMISSIONS = list(DEFAULT_ROLES['assistant'])
+DIRECTOR_PERMISSIONS = list(DEFAULT_ROLES['director'])
+PRODUCER_PERMISSIONS = list(DEFAULT_ROLES['producer'])
 
-class CastingAgencyTestCase(unittest.TestCase):
+_local_idp = []
 
-    """This class represultents the casting agency test case"""
 
-    def setUp(self):
-        self.app = create_app()
-        self.client = self.app.test_client
-        setup_db(self.app, TEST_DATABASE_URI)
+def local_idp():
+    """FakeIdP whose key signs the tokens of every test that needs locally signed ones"""
+    if not _local_idp:
+        _local_idp.append(FakeIdP(kid=LOCAL_KID, key_size=1024))
+    return _local_idp[0]
 
-        self.executive_producer_token = PRODUCER_TOKEN
-        self.casting_assistant_token = ASSISTANT_TOKEN
-        self.casting_director_token = DIRECTOR_TOKEN
 
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
+def write_local_jwks():
+    jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(local_idp().jwks, jwks_file)
+    jwks_file.close()
+    return jwks_file.name
+
+
+def make_local_token(permissions, expires_in=3600, kid=LOCAL_KID, sub='auth0|local', roles=None):
+    return local_idp().sign(permissions, sub=sub, expires_in=expires_in, roles=roles, kid=kid)
+
+
+_shared_apps = {}
 
-            # create all tables
 
+def worker_database_uri(uri):
+    """
+    uri for this test process. Under pytest-xdist every worker (gw0, gw1, ...)
+    gets a database of its own, named after the worker and created on first
+    use; in memory SQLite databases belong to one process anyway.
+    """
+    worker = os.getenv('PYTEST_XDIST_WORKER')
+    url = make_url(uri) if uri else None
+    if not worker or url is None or not url.database or url.database == ':memory:':
+        return uri
+    if url.get_backend_name() == 'sqlite':
+        root, extension = os.path.splitext(url.database)
+        return str(url.set(database='{}_{}{}'.format(root, worker, extension)))
+    worker_url = url.set(database='{}_{}'.format(url.database, worker))
+    engine = create_engine(url, isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        exists = connection.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                                    {'name': worker_url.database}).scalar()
+        if not exists:
+            connection.execute(text('CREATE DATABASE "{}"'.format(worker_url.database)))
+    engine.dispose()
+    return str(worker_url)
+
+
+def shared_app(database_uri, reset_schema=False):
+    """
+    App on database_uri built once per process, with its schema created
+    (after dropping the old one if reset_schema) the first time, so the test
+    cases sharing it only pay for a transaction each (see TransactionalTestCase)
+    """
+    key = (database_uri, reset_schema)
+    if key not in _shared_apps:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri})
+        with app.app_context():
+            engine = db.get_engine()
+            if engine.dialect.name == 'sqlite':
+                # pysqlite defers BEGIN to the first write and so breaks savepoints, let
+                # SQLAlchemy emit it (see the SQLAlchemy pysqlite dialect notes)
+                @event.listens_for(engine, 'connect')
+                def autocommit_driver(dbapi_connection, connection_record):
+                    dbapi_connection.isolation_level = None
+
+                @event.listens_for(engine, 'begin')
+                def begin(connection):
+                    connection.exec_driver_sql('BEGIN')
+
+            if reset_schema:
+                db.drop_all()
             create_and_drop_all()
+        _shared_apps[key] = app
+    return _shared_apps[key]
+
+
+class TransactionalTestCase(unittest.TestCase):
+
+    """
+    Runs every test inside a transaction rolled back afterwards, on an app and
+    a schema shared by the whole run. The app's commits only release a
+    savepoint, which is started again right away, so a test sees its own
+    writes and the next test starts from the same rows. Sequences are
+    transactional on SQLite only: with reset_schema the Postgres ones are
+    restarted for each test, so ids start at 1 there too.
+
+    Cases whose tests use several connections (threads, replicas) or change
+    the app set transactional = False and get an app and a schema of their own.
+    """
+
+    database_uri = None
+    reset_schema = False
+    transactional = True
+
+    def setUp(self):
+        if not self.transactional:
+            self.app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_uri})
+            with self.app.app_context():
+                if self.reset_schema:
+                    db.drop_all()
+                create_and_drop_all()
+            return
+        self.app = shared_app(self.database_uri, self.reset_schema)
+        with self.app.app_context():
+            engine = db.get_engine()
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+        if self.reset_schema and engine.dialect.name == 'postgresql':
+            for table in ('actors', 'movies'):
+                self.connection.execute(
+                    text("SELECT setval(pg_get_serial_sequence(:table, 'id'), 1, false)"),
+                    {'table': table})
+        self.connection.begin_nested()
+        self.session = db.session
+        db.session = db.create_scoped_session({'bind': self.connection, 'binds': {}})
+        event.listen(db.session, 'after_transaction_end', self.restart_savepoint)
 
-            # self.db.create_all()
+    def restart_savepoint(self, session, transaction):
+        if not self.connection.in_nested_transaction():
+            self.connection.begin_nested()
 
     def tearDown(self):
-        """Executed after reach test"""
+        if not self.transactional:
+            with self.app.app_context():
+                db.session.remove()
+                # leave the tables empty for the cases sharing the database
+                with db.get_engine().begin() as connection:
+                    for table in reversed(db.metadata.sorted_tables):
+                        connection.execute(table.delete())
+            return
+        db.session.remove()
+        event.remove(db.session, 'after_transaction_end', self.restart_savepoint)
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+
+
+class CastingAgencyTestCase(TransactionalTestCase):
+
+    """This class represultents the casting agency test case"""
 
-        pass
+    database_uri = TEST_DATABASE_URI
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client
+
+        self.executive_producer_token = PRODUCER_TOKEN
+        self.casting_assistant_token = ASSISTANT_TOKEN
+        self.casting_director_token = DIRECTOR_TOKEN
 
     def test_get_movies(self):
         result = self.client().get('/movies',
@@ -245,5 +407,1470 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(result.status_code, 401)
 
 
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    """JWKS keys are loaded once per process and refetched on ttl or unknown kid"""
+
+    def setUp(self):
+        self.now = 0
+        self.fetches = 0
+        self.jwks = {'keys': [{'kty': 'RSA', 'kid': 'a', 'use': 'sig', 'n': 'n', 'e': 'e'}]}
+
+        def fetcher():
+            self.fetches += 1
+            return self.jwks
+
+        self.store = JWKSKeyStore(fetcher, ttl=100, min_refresh_interval=10,
+                                  clock=lambda: self.now)
+
+    def test_keys_are_fetched_once(self):
+        for _ in range(5):
+            self.assertEqual(self.store.get_key('a')['kid'], 'a')
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.store.stats()['hits'], 4)
+        self.assertEqual(self.store.stats()['misses'], 1)
+
+    def test_keys_are_refetched_after_ttl(self):
+        self.store.get_key('a')
+        self.now = 101
+        self.store.get_key('a')
+        self.assertEqual(self.fetches, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.get_key('a')
+        self.now = 5
+        self.assertIsNone(self.store.get_key('b'))
+        self.assertEqual(self.fetches, 1)
+        self.now = 11
+        self.jwks['keys'].append({'kty': 'RSA', 'kid': 'b', 'use': 'sig', 'n': 'n', 'e': 'e'})
+        self.assertEqual(self.store.get_key('b')['kid'], 'b')
+        self.assertEqual(self.fetches, 2)
+
+    def test_stale_keys_are_kept_when_fetch_fails(self):
+        self.store.get_key('a')
+
+        def failing_fetcher():
+            raise OSError('identity provider unavailable')
+
+        self.store.fetcher = failing_fetcher
+        self.now = 200
+        self.assertEqual(self.store.get_key('a')['kid'], 'a')
+        self.assertEqual(self.store.stats()['fetch_errors'], 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    """Verified tokens are reused until shortly before exp and evicted in LRU order"""
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = TokenCache(maxsize=2, margin=10, clock=lambda: self.now)
+
+    def test_hit_until_exp_minus_margin(self):
+        self.cache.put('token', {'exp': 1100, 'permissions': []})
+        self.assertIsNotNone(self.cache.get('token'))
+        self.now = 1090
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_lru_eviction(self):
+        for token in ('a', 'b'):
+            self.cache.put(token, {'exp': 2000})
+        self.cache.get('a')
+        self.cache.put('c', {'exp': 2000})
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_token_without_exp_is_not_cached(self):
+        self.cache.put('token', {'permissions': []})
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_permissions_are_compiled_once(self):
+        policy = PermissionPolicy()
+        view, delete = policy.require('view:actors'), policy.require('delete:actors')
+        entry = self.cache.put('token', {'exp': 2000, 'permissions': ['view:actors']})
+        for _ in range(3):
+            self.assertTrue(entry.has_permission(view, policy))
+            self.assertFalse(entry.has_permission(delete, policy))
+        self.assertEqual(policy.stats()['compilations'], 1)
+        # a permission required later is checked against a new bitset
+        add = policy.require('add:actors')
+        self.assertFalse(entry.has_permission(add, policy))
+        self.assertEqual(policy.stats()['compilations'], 2)
+
+
+class PermissionPolicyTestCase(unittest.TestCase):
+
+    """Permissions compile to bitsets, with roles, wildcards and parent permissions"""
+
+    def setUp(self):
+        self.policy = PermissionPolicy()
+
+    def allowed(self, payload):
+        required = ['view:actors', 'view:movies:drama', 'add:movies', 'delete:actors']
+        return [permission for permission in required if self.policy.allows(payload, permission)]
+
+    def test_wildcards_and_parents(self):
+        self.assertEqual(self.allowed({'permissions': ['view:*']}),
+                         ['view:actors', 'view:movies:drama'])
+        self.assertEqual(self.allowed({'permissions': ['view:movies', 'delete:actors']}),
+                         ['view:movies:drama', 'delete:actors'])
+        self.assertEqual(self.allowed({'permissions': ['*']}),
+                         ['view:actors', 'view:movies:drama', 'add:movies', 'delete:actors'])
+        self.assertEqual(self.allowed({'permissions': ['view:act', 'add', 'view:movies:drama:x']}),
+                         ['add:movies'])
+
+    def test_roles(self):
+        claim = self.policy.roles_claim
+        self.assertEqual(self.allowed({'permissions': [], claim: ['director']}),
+                         ['view:actors', 'view:movies:drama', 'delete:actors'])
+        self.assertEqual(self.allowed({'permissions': ['add:movies'], claim: ['assistant', 'unknown']}),
+                         ['view:actors', 'view:movies:drama', 'add:movies'])
+        # roles grant what they list, nothing registered later
+        self.assertEqual(self.allowed({'permissions': [], claim: ['producer']}),
+                         ['view:actors', 'view:movies:drama', 'add:movies', 'delete:actors'])
+        self.assertFalse(self.policy.allows({'permissions': [], claim: ['producer']}, 'drop:catalog'))
+
+    def test_roles_from_config(self):
+        roles = parse_roles('{"auditor": ["view:*"]}')
+        policy = PermissionPolicy(roles=roles, roles_claim='https://example.com/roles')
+        payload = {'permissions': [], 'https://example.com/roles': ['auditor', 'producer']}
+        self.assertTrue(policy.allows(payload, 'view:movies'))
+        self.assertFalse(policy.allows(payload, 'add:movies'))
+        self.assertEqual(parse_roles(''), DEFAULT_ROLES)
+
+    def test_tokens_with_the_same_claims_share_a_bitset(self):
+        for sub in ('a', 'b', 'c'):
+            self.policy.allows({'sub': sub, 'permissions': ['view:actors']}, 'view:actors')
+        self.assertEqual(self.policy.stats()['compilations'], 1)
+        self.assertEqual(self.policy.stats()['size'], 1)
+
+
+class LocalAppTestCase(TransactionalTestCase):
+
+    """Base for tests running the API against a local JWKS file and locally signed tokens"""
+
+    database_uri = worker_database_uri(LOCAL_DATABASE_URI)
+    reset_schema = True
+
+    def setUp(self):
+        self.jwks_path = write_local_jwks()
+        self.jwks_store = auth.configure_jwks(file_fetcher(self.jwks_path))
+        auth.token_cache.clear()
+        configure_response_cache(LRUBackend())
+        super().setUp()
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        super().tearDown()
+        os.remove(self.jwks_path)
+
+    def headers(self, permissions=PRODUCER_PERMISSIONS):
+        return {'Authorization': 'Bearer {}'.format(make_local_token(permissions))}
+
+    def seed(self, actors=0, movies=0):
+        """Inserts actors and movies with one executemany per table, ids start at 1"""
+        with self.app.app_context():
+            if actors:
+                db.session.execute(Actor.__table__.insert(), [
+                    {'name': 'Actor {}'.format(i), 'age': 20 + i % 50,
+                     'gender': ('male', 'female')[i % 2]}
+                    for i in range(actors)])
+            if movies:
+                db.session.execute(Movie.__table__.insert(), [
+                    {'title': 'Movie {}'.format(i),
+                     'release_date': datetime.date(2000 + i % 20, 1, 1),
+                     'genre': ('Drama', 'Action')[i % 2]}
+                    for i in range(movies)])
+            db.session.commit()
+
+
+    @contextmanager
+    def count_queries(self):
+        """Collects every SQL statement sent to the database inside the block"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            # savepoints come from the test transaction, not from the app
+            if 'SAVEPOINT' not in statement:
+                statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class LocalAuthTestCase(LocalAppTestCase):
+
+    """Authentication against the local JWKS file"""
+
+    def test_jwks_fetched_once_for_many_requests(self):
+        headers = self.headers(ASSISTANT_PERMISSIONS)
+        for _ in range(3):
+            result = self.client().get('/actors', headers=headers)
+            self.assertEqual(result.status_code, 404)
+        self.assertEqual(self.jwks_store.stats()['fetches'], 1)
+
+    def test_repeated_token_skips_verification(self):
+        headers = self.headers(ASSISTANT_PERMISSIONS)
+        for _ in range(3):
+            self.client().get('/movies', headers=headers)
+        self.assertEqual(self.jwks_store.stats()['misses'], 1)
+        self.assertEqual(self.jwks_store.stats()['hits'], 0)
+        self.assertGreaterEqual(auth.token_cache.stats()['hits'], 2)
+
+    def test_cached_token_still_checks_permission(self):
+        headers = self.headers(ASSISTANT_PERMISSIONS)
+        self.client().get('/actors', headers=headers)
+        result = self.client().delete('/actors/1', headers=headers)
+        self.assertEqual(result.status_code, 401)
+
+    def test_wildcard_and_role_tokens(self):
+        self.seed(actors=1)
+        wildcard = make_local_token(['view:*'])
+        result = self.client().get('/movies/1', headers={'Authorization': 'Bearer ' + wildcard})
+        self.assertEqual(result.status_code, 404)
+        director = make_local_token([], roles=['director'])
+        headers = {'Authorization': 'Bearer ' + director}
+        self.assertEqual(self.client().delete('/actors/1', headers=headers).status_code, 200)
+        self.assertEqual(self.client().delete('/movies/1', headers=headers).status_code, 401)
+
+    def test_header_checks(self):
+        for header, status in (('Bearer', 401), ('Bearer a b', 401), ('Basic abc', 401)):
+            result = self.client().get('/actors', headers={'Authorization': header})
+            self.assertEqual(result.status_code, status)
+        result = self.client().get('/actors', headers={'Authorization': 'Basic abc'})
+        self.assertEqual(json.loads(result.data)['message']['description'],
+                         'Authorization header doesnt start with bearer!')
+
+    def test_unknown_kid_401(self):
+        token = make_local_token(ASSISTANT_PERMISSIONS, kid='unknown')
+        result = self.client().get('/actors',
+                                   headers={'Authorization': 'Bearer {}'.format(token)})
+        self.assertEqual(result.status_code, 401)
+
+
+class PaginationTestCase(LocalAppTestCase):
+
+    """Keyset pagination, field selection and filters on the list endpoints"""
+
+    def test_walk_actors_with_cursor(self):
+        self.seed(actors=25)
+        seen = []
+        after = ''
+        while True:
+            result = self.client().get('/actors?limit=10&after={}'.format(after),
+                                       headers=self.headers())
+            data = json.loads(result.data)
+            seen += [actor['id'] for actor in data['actors']]
+            if data['next_cursor'] is None:
+                break
+            after = data['next_cursor']
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_actor_fields_and_filters(self):
+        self.seed(actors=20)
+        result = self.client().get('/actors?fields=name&gender=female&min_age=25&max_age=30',
+                                   headers=self.headers())
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        for actor in data['actors']:
+            self.assertEqual(set(actor), {'id', 'name'})
+        self.assertEqual(len(data['actors']), 3)
+
+    def test_movie_filters(self):
+        self.seed(movies=20)
+        result = self.client().get('/movies?genre=Action&release_date_from=2005-01-01'
+                                   '&release_date_to=2010-12-31',
+                                   headers=self.headers())
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(data['movies']), 3)
+        self.assertEqual(set(data['movies'][0]), {'id', 'title', 'release_date', 'genre'})
+
+    def test_invalid_params_400(self):
+        for query in ('limit=abc', 'limit=0', 'fields=salary', 'release_date_from=yesterday'):
+            result = self.client().get('/movies?' + query, headers=self.headers())
+            self.assertEqual(result.status_code, 400)
+
+
+class ExportTestCase(LocalAppTestCase):
+
+    """NDJSON exports stream every row in get_formatted_json shape"""
+
+    def test_export_actors(self):
+        self.seed(actors=30)
+        result = self.client().get('/actors/export', headers=self.headers())
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        actors = [json.loads(line) for line in result.data.decode().splitlines()]
+        self.assertEqual(len(actors), 30)
+        with self.app.app_context():
+            self.assertEqual(actors[0], Actor.query.get(actors[0]['id']).get_formatted_json())
+
+    def test_export_movies_gzip_and_resume(self):
+        self.seed(movies=30)
+        headers = self.headers()
+        headers['Accept-Encoding'] = 'gzip'
+        result = self.client().get('/movies/export?after=10', headers=headers)
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        movies = [json.loads(line) for line in gzip.decompress(result.data).decode().splitlines()]
+        self.assertEqual([movie['id'] for movie in movies], list(range(11, 31)))
+
+
+class BulkTestCase(LocalAppTestCase):
+
+    """Bulk create, update and delete validate up front and report per item"""
+
+    def test_bulk_create_update_delete_actors(self):
+        actors = [{'name': 'Actor {}'.format(i), 'age': 30, 'gender': 'male'} for i in range(5)]
+        result = self.client().post('/actors/bulk', headers=self.headers(),
+                                    json={'actors': actors})
+        data = json.loads(result.data)
+        self.assertTrue(data['success'])
+        ids = [item['id'] for item in data['results']]
+        self.assertEqual(len(set(ids)), 5)
+
+        result = self.client().patch('/actors/bulk', headers=self.headers(),
+                                     json={'actors': [{'id': ids[0], 'age': 41},
+                                                      {'id': 99999, 'age': 41}]})
+        data = json.loads(result.data)
+        self.assertFalse(data['success'])
+        self.assertEqual([item['success'] for item in data['results']], [True, False])
+        with self.app.app_context():
+            self.assertEqual(Actor.query.get(ids[0]).age, 41)
+
+        result = self.client().delete('/actors/bulk', headers=self.headers(),
+                                      json={'ids': ids[:3]})
+        self.assertTrue(json.loads(result.data)['success'])
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 2)
+
+    def test_invalid_batch_writes_nothing(self):
+        movies = [{'title': 'Skyfall', 'release_date': '2015-03-02', 'genre': 'Action'},
+                  {'title': 'Skyfall', 'release_date': 'not a date', 'genre': 'Action'}]
+        result = self.client().post('/movies/bulk', headers=self.headers(),
+                                    json={'movies': movies})
+        data = json.loads(result.data)
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(data['errors'][0]['index'], 1)
+        self.assertIn('release_date', data['errors'][0]['errors'])
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 0)
+
+    def test_bulk_create_is_one_insert(self):
+        actors = [{'name': 'Actor {}'.format(i), 'age': 30, 'gender': 'male'} for i in range(50)]
+        with self.count_queries() as statements:
+            result = self.client().post('/actors/bulk', headers=self.headers(),
+                                        json={'actors': actors})
+        data = json.loads(result.data)
+        self.assertTrue(data['success'])
+        self.assertEqual([item['id'] for item in data['results']], list(range(1, 51)))
+        inserts = [statement for statement in statements if statement.startswith('INSERT')]
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 50)
+            executemany_returning = db.engine.dialect.insert_executemany_returning
+        # SQLite can not return the ids of an executemany, each row is inserted alone
+        self.assertEqual(len(inserts), 1 if executemany_returning else 50)
+
+    def test_bulk_requires_permission(self):
+        result = self.client().delete('/movies/bulk', headers=self.headers(DIRECTOR_PERMISSIONS),
+                                      json={'ids': [1]})
+        self.assertEqual(result.status_code, 401)
+
+
+class FakeSharedClient:
+
+    """Stands in for a redis client shared by several workers"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+
+class ResponseCacheTestCase(LocalAppTestCase):
+
+    """Read responses are cached, revalidated with ETags and invalidated by writes"""
+
+    def test_list_is_cached_until_write(self):
+        self.seed(actors=3)
+        headers = self.headers()
+        first = self.client().get('/actors', headers=headers)
+        second = self.client().get('/actors', headers=headers)
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+
+        self.client().patch('/actors/1', headers=headers, json={'age': 99})
+        third = self.client().get('/actors', headers=headers)
+        self.assertEqual(third.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(third.data)['actors'][0]['age'], 99)
+
+    def test_cache_hit_runs_no_statement(self):
+        self.seed(actors=3)
+        headers = self.headers()
+        self.client().get('/actors', headers=headers)
+        # nor the SET LOCAL statement_timeout of the read endpoints on Postgres
+        with self.count_queries() as statements:
+            result = self.client().get('/actors', headers=headers)
+        self.assertEqual(result.headers['X-Cache'], 'HIT')
+        self.assertEqual(statements, [])
+
+    def test_detail_if_none_match_304(self):
+        self.seed(movies=2)
+        headers = self.headers()
+        result = self.client().get('/movies/1', headers=headers)
+        self.assertEqual(json.loads(result.data)['movie']['id'], 1)
+        headers['If-None-Match'] = result.headers['ETag']
+        result = self.client().get('/movies/1', headers=headers)
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, b'')
+
+    def test_write_only_invalidates_its_entities(self):
+        self.seed(actors=2, movies=2)
+        headers = self.headers()
+        for path in ('/actors/1', '/actors/2', '/movies'):
+            self.client().get(path, headers=headers)
+        self.client().delete('/actors/1', headers=headers)
+        self.assertEqual(self.client().get('/actors/1', headers=headers).status_code, 404)
+        self.assertEqual(self.client().get('/actors/2', headers=headers).headers['X-Cache'], 'HIT')
+        self.assertEqual(self.client().get('/movies', headers=headers).headers['X-Cache'], 'HIT')
+
+    def test_shared_backend_invalidation_across_workers(self):
+        client = FakeSharedClient()
+        worker_a = cache.ResponseCache(SharedBackend(client))
+        worker_b = cache.ResponseCache(SharedBackend(client))
+        with self.app.test_request_context('/movies'):
+            key = worker_a.list_key('movies')
+            worker_a.respond(key, lambda: {'movies': []})
+            self.assertEqual(worker_b.respond(key, lambda: {}).headers['X-Cache'], 'HIT')
+            worker_b.invalidate('movies')
+            self.assertNotEqual(worker_a.list_key('movies'), key)
+
+    def test_if_modified_since_304_before_building(self):
+        self.seed(actors=3)
+        headers = self.headers()
+        cache.response_cache.backend.set('modified:actors', int(time.time()) - 60)
+        result = self.client().get('/actors', headers=headers)
+        self.assertEqual(result.headers['Cache-Control'], 'no-cache, private')
+        headers['If-Modified-Since'] = result.headers['Last-Modified']
+        with self.count_queries() as statements:
+            result = self.client().get('/actors', headers=headers)
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(statements, [])
+        self.assertEqual(cache.response_cache.stats()['not_modified'], 1)
+
+        # an If-None-Match which does not match wins
+        result = self.client().get('/actors', headers=dict(headers, **{'If-None-Match': '"x"'}))
+        self.assertEqual(result.status_code, 200)
+        self.client().patch('/actors/1', headers=self.headers(), json={'age': 99})
+        result = self.client().get('/actors', headers=headers)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(json.loads(result.data)['actors'][0]['age'], 99)
+
+    def test_no_last_modified_in_second_of_write(self):
+        self.seed(actors=1)
+        self.client().patch('/actors/1', headers=self.headers(), json={'age': 99})
+        result = self.client().get('/actors/1', headers=self.headers())
+        self.assertNotIn('Last-Modified', result.headers)
+
+
+class CompressionTestCase(LocalAppTestCase):
+
+    """JSON responses compressed as the client accepts, ETags weakened accordingly"""
+
+    def get(self, path, encoding):
+        return self.client().get(path, headers=dict(self.headers(),
+                                                    **{'Accept-Encoding': encoding}))
+
+    def test_gzip_list(self):
+        self.seed(actors=100)
+        plain = self.get('/actors', 'identity')
+        result = self.get('/actors', 'gzip, deflate')
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', result.headers['Vary'])
+        self.assertEqual(gzip.decompress(result.data), plain.data)
+        self.assertLess(len(result.data), len(plain.data) / 3)
+        self.assertEqual(result.headers['ETag'], 'W/' + plain.headers['ETag'])
+        headers = dict(self.headers(), **{'Accept-Encoding': 'gzip',
+                                          'If-None-Match': result.headers['ETag']})
+        self.assertEqual(self.client().get('/actors', headers=headers).status_code, 304)
+
+    def test_small_or_refused_not_compressed(self):
+        self.seed(actors=100)
+        result = self.get('/actors/1', 'gzip')
+        self.assertNotIn('Content-Encoding', result.headers)
+        self.assertIn('Accept-Encoding', result.headers['Vary'])
+        self.assertNotIn('Content-Encoding', self.get('/actors', 'gzip;q=0, identity').headers)
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli_preferred(self):
+        self.seed(actors=100)
+        result = self.get('/actors', 'gzip, br')
+        self.assertEqual(result.headers['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(result.data),
+                         self.get('/actors', 'identity').data)
+        self.assertEqual(self.get('/actors', 'gzip, br;q=0.5').headers['Content-Encoding'],
+                         'gzip')
+
+    def test_compressed_etag_accepted_by_if_match(self):
+        self.seed(actors=1)
+        min_size = compression.COMPRESS_MIN_SIZE
+        compression.COMPRESS_MIN_SIZE = 0
+        try:
+            result = self.get('/actors/1', 'gzip')
+        finally:
+            compression.COMPRESS_MIN_SIZE = min_size
+        self.assertEqual(result.headers['ETag'], 'W/"v1"')
+        headers = dict(self.headers(), **{'If-Match': result.headers['ETag']})
+        result = self.client().patch('/actors/1', headers=headers, json={'age': 50})
+        self.assertEqual(result.status_code, 200)
+        result = self.client().patch('/actors/1', headers=headers, json={'age': 51})
+        self.assertEqual(result.status_code, 412)
+
+    def test_streamed_chunks_flushed(self):
+        chunks = compression.compress_chunks(iter(['{"id":1}\n', '{"id":2}\n']), 'gzip')
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(next(chunks)), b'{"id":1}\n')
+        self.assertEqual(decompressor.decompress(b''.join(chunks)), b'{"id":2}\n')
+
+
+class CastingTestCase(LocalAppTestCase):
+
+    """Movie and actor castings are loaded in batches, never one query per row"""
+
+    def cast_all(self, movies, actors_per_movie):
+        with self.app.app_context():
+            actors = Actor.query.order_by(Actor.id).limit(actors_per_movie).all()
+            for movie in Movie.query.order_by(Movie.id).limit(movies).all():
+                movie.actors.extend(actors)
+            db.session.commit()
+
+    def test_cast_and_uncast(self):
+        self.seed(actors=3, movies=1)
+        headers = self.headers()
+        result = self.client().post('/movies/1/actors', headers=headers,
+                                    json={'actor_ids': [1, 3]})
+        self.assertTrue(json.loads(result.data)['success'])
+        actors = json.loads(self.client().get('/movies/1/actors', headers=headers).data)['actors']
+        self.assertEqual([actor['id'] for actor in actors], [1, 3])
+
+        self.client().delete('/movies/1/actors/1', headers=headers)
+        movies = json.loads(self.client().get('/actors/1/movies', headers=headers).data)['movies']
+        self.assertEqual(movies, [])
+        movies = json.loads(self.client().get('/actors/3/movies', headers=headers).data)['movies']
+        self.assertEqual([movie['id'] for movie in movies], [1])
+
+    def test_cast_unknown_actor_404(self):
+        self.seed(actors=1, movies=1)
+        result = self.client().post('/movies/1/actors', headers=self.headers(),
+                                    json={'actor_ids': [1, 42]})
+        self.assertEqual(result.status_code, 404)
+
+    def test_include_cast_query_count_is_constant(self):
+        self.seed(actors=5, movies=100)
+        self.cast_all(movies=100, actors_per_movie=3)
+        headers = self.headers()
+        counts = {}
+        for limit in (10, 100):
+            with self.count_queries() as statements:
+                result = self.client().get('/movies?include=cast&limit={}'.format(limit),
+                                           headers=headers)
+            movies = json.loads(result.data)['movies']
+            self.assertEqual(len(movies), limit)
+            self.assertEqual(len(movies[-1]['actors']), 3)
+            counts[limit] = len(statements)
+        self.assertEqual(counts[10], counts[100])
+        self.assertLessEqual(counts[100], 2)
+
+    def test_include_cast_needs_view_of_the_cast(self):
+        self.seed(actors=1, movies=1)
+        self.cast_all(movies=1, actors_per_movie=1)
+        for path, permissions in (('/actors?include=cast', ['view:actors']),
+                                  ('/movies?include=cast', ['view:movies'])):
+            result = self.client().get(path, headers=self.headers(permissions))
+            self.assertEqual(result.status_code, 403)
+            self.assertEqual(self.client().get(path.split('?')[0], headers=self.headers(permissions)).status_code, 200)
+        result = self.client().get('/actors?include=cast', headers=self.headers(['view:actors', 'view:movies']))
+        self.assertEqual(json.loads(result.data)['actors'][0]['movies'][0]['id'], 1)
+
+    def test_actor_movies_query_count(self):
+        self.seed(actors=3, movies=50)
+        self.cast_all(movies=50, actors_per_movie=1)
+        with self.count_queries() as statements:
+            result = self.client().get('/actors/1/movies', headers=self.headers())
+        self.assertEqual(len(json.loads(result.data)['movies']), 50)
+        self.assertLessEqual(len(statements), 2)
+
+
+class PoolTestCase(LocalAppTestCase):
+
+    """Pool options come from the environment and forked connections are never reused"""
+
+    def test_engine_options(self):
+        self.assertEqual(engine_options('sqlite://'), {})
+        options = engine_options('postgresql://localhost/casting_agency')
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+        for key in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle'):
+            self.assertIn(key, options)
+
+    def test_connection_from_other_process_is_replaced(self):
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool)
+        with engine.connect() as connection:
+            connection.execute(text('select 1'))
+        record = engine.pool._pool.queue[0]
+        record.info['pid'] = -1
+        discarded = pool_stats.forked
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text('select 1')).scalar(), 1)
+        self.assertEqual(pool_stats.forked, discarded + 1)
+        self.assertGreater(pool_stats.wait_seconds, 0)
+
+    def test_health_db(self):
+        result = self.client().get('/health/db')
+        data = json.loads(result.data)
+        self.assertTrue(data['success'])
+        self.assertIn('checkouts', data['pool'])
+
+
+class SearchTestCase(LocalAppTestCase):
+
+    """Search over names and titles, on the SQLite fallback when run locally"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add_all([Actor(name='Meryl Streep', age=70, gender='female'),
+                                Actor(name='Jason Statham', age=53, gender='male'),
+                                Actor(name='Streep Double', age=30, gender='female'),
+                                Movie(title='Skyfall', release_date=datetime.date(2012, 10, 26),
+                                      genre='Action'),
+                                Movie(title='Sky Captain', release_date=datetime.date(2004, 9, 17),
+                                      genre='Adventure')])
+            db.session.commit()
+
+    def test_resource_search_ranks_prefix_first(self):
+        result = self.client().get('/actors?q=streep', headers=self.headers())
+        data = json.loads(result.data)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['Streep Double', 'Meryl Streep'])
+        self.assertIsNone(data['next_offset'])
+
+    def test_search_pagination(self):
+        result = self.client().get('/movies?q=sky&limit=1', headers=self.headers())
+        data = json.loads(result.data)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertEqual(data['next_offset'], 1)
+        result = self.client().get('/movies?q=sky&limit=1&offset=1', headers=self.headers())
+        self.assertIsNone(json.loads(result.data)['next_offset'])
+
+    def test_search_all(self):
+        result = self.client().get('/search?q=sky', headers=self.headers())
+        data = json.loads(result.data)
+        self.assertEqual(data['actors'], [])
+        self.assertEqual(len(data['movies']), 2)
+
+    def test_cached_search_follows_permissions(self):
+        actors_only = self.headers(['view:actors'])
+        for first, second in ((actors_only, self.headers()), (self.headers(), actors_only)):
+            cache.response_cache.backend.clear()
+            self.client().get('/search?q=sky', headers=first)
+            result = self.client().get('/search?q=sky', headers=second)
+            self.assertEqual(result.headers['X-Cache'], 'MISS')
+            data = json.loads(result.data)
+            self.assertEqual('movies' in data, second is not actors_only)
+        result = self.client().get('/search?q=sky', headers=actors_only)
+        self.assertEqual(result.headers['X-Cache'], 'HIT')
+        self.assertNotIn('movies', json.loads(result.data))
+
+    def test_search_sees_updates(self):
+        headers = self.headers()
+        self.client().get('/search?q=statham', headers=headers)
+        self.client().patch('/actors/2', headers=headers, json={'name': 'Jason Bourne'})
+        data = json.loads(self.client().get('/search?q=statham', headers=headers).data)
+        self.assertEqual(data['actors'], [])
+        data = json.loads(self.client().get('/search?q=bourne', headers=headers).data)
+        self.assertEqual(data['actors'][0]['id'], 2)
+
+    def test_empty_query_400(self):
+        result = self.client().get('/search?q=%20%21', headers=self.headers())
+        self.assertEqual(result.status_code, 400)
+
+
+class MetricsTestCase(LocalAppTestCase):
+
+    """Request, phase and SQL instrumentation exposed on /metrics"""
+
+    def setUp(self):
+        super().setUp()
+        metrics.registry.clear()
+        # the first request of each test flushes, whatever the previous test did
+        metrics.registry._flushed_at = None
+
+    def tearDown(self):
+        metrics.SERVER_TIMING = False
+        metrics.METRICS_DIR = None
+        super().tearDown()
+
+    def test_request_and_sql_metrics(self):
+        self.seed(actors=3)
+        misses = auth.token_cache.misses
+        self.client().get('/actors', headers=self.headers())
+        body = self.client().get('/metrics').data.decode()
+        self.assertIn('http_requests_total{method="GET",route="/actors",status="200"} 1.0',
+                      body)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/actors"} 1',
+                      body)
+        for phase in ('auth', 'auth_header', 'jwks', 'jwt_decode', 'db', 'serialize'):
+            self.assertIn('phase="{}",route="/actors"'.format(phase), body)
+        self.assertIn('sql_query_duration_seconds_count{statement="SELECT"}', body)
+        self.assertIn('http_response_size_bytes_count{method="GET",route="/actors"} 1', body)
+        self.assertIn('token_cache_misses_total {}'.format(misses + 1), body)
+
+    def test_server_timing_header(self):
+        self.seed(actors=1)
+        result = self.client().get('/actors', headers=self.headers())
+        self.assertNotIn('Server-Timing', result.headers)
+        metrics.SERVER_TIMING = True
+        result = self.client().get('/actors/1', headers=self.headers())
+        timing = result.headers['Server-Timing']
+        self.assertIn('auth;dur=', timing)
+        self.assertIn('desc="1 queries"', timing)
+
+    def test_workers_are_summed(self):
+        metrics.METRICS_DIR = tempfile.mkdtemp()
+        other = {'counters': [['http_requests_total',
+                               [['method', 'GET'], ['route', '/'], ['status', '200']], 2]],
+                 'histograms': [],
+                 'stats': [['token_cache_hits_total', 'counter', 'token_cache', 5]]}
+        with open(os.path.join(metrics.METRICS_DIR, 'metrics-1.json'), 'w') as other_file:
+            json.dump(other, other_file)
+        hits = auth.token_cache.hits
+        self.client().get('/')
+        body = self.client().get('/metrics').data.decode()
+        self.assertIn('http_requests_total{method="GET",route="/",status="200"} 3.0', body)
+        self.assertIn('token_cache_hits_total {}'.format(hits + 5), body)
+        self.assertTrue(os.path.exists(os.path.join(
+            metrics.METRICS_DIR, 'metrics-{}.json'.format(os.getpid()))))
+
+    def test_exited_workers_keep_counters_only(self):
+        metrics.METRICS_DIR = tempfile.mkdtemp()
+        for pid in (1, 2):
+            worker = {'counters': [['http_requests_total',
+                                    [['method', 'GET'], ['route', '/'], ['status', '200']], 2]],
+                      'histograms': [],
+                      'stats': [['token_cache_hits_total', 'counter', 'token_cache', 5],
+                                ['token_cache_size', 'gauge', 'token_cache', 1000]]}
+            with open(os.path.join(metrics.METRICS_DIR, 'metrics-{}.json'.format(pid)), 'w') as worker_file:
+                json.dump(worker, worker_file)
+            metrics.retire_worker(pid)
+        self.assertEqual(sorted(os.listdir(metrics.METRICS_DIR)), ['metrics-retired.json'])
+        hits = auth.token_cache.hits
+        size = auth.token_cache.stats()['size']
+        self.client().get('/')
+        body = self.client().get('/metrics').data.decode()
+        self.assertIn('http_requests_total{method="GET",route="/",status="200"} 5.0', body)
+        self.assertIn('token_cache_hits_total {}'.format(hits + 10), body)
+        self.assertIn('token_cache_size {}\n'.format(size), body)
+
+
+def asgi_request(app, method, path, headers=None, body=b''):
+    """Sends one request to an ASGI app, returns the status, headers and body"""
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'path': path,
+             'query_string': query.encode(),
+             'headers': [(name.lower().encode(), value.encode())
+                         for name, value in (headers or {}).items()]}
+    messages = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        await app(scope, receive, send)
+        return sent
+
+    return run()
+
+
+def asgi_result(sent):
+    headers = {name.decode().lower(): value.decode() for name, value in sent[0]['headers']}
+    return sent[0]['status'], headers, b''.join(message['body'] for message in sent[1:])
+
+
+class ASGITestCase(LocalAppTestCase):
+
+    """The ASGI entry point serves the same handlers as the WSGI app"""
+
+    transactional = False
+
+    def test_same_responses_as_wsgi(self):
+        self.seed(actors=3)
+        asgi_app = ASGIApp(self.app)
+        headers = self.headers()
+        for method, path, body in (('GET', '/actors?limit=2', b''),
+                                   ('GET', '/actors/99', b''),
+                                   ('POST', '/actors', b'{"name": "New", "age": 30, "gender": "male"}')):
+            wsgi = self.client().open(path, method=method, headers=headers, data=body,
+                                      content_type='application/json')
+            status, _, data = asgi_result(asyncio.run(asgi_request(
+                asgi_app, method, path, dict(headers, **{'Content-Type': 'application/json'}),
+                body)))
+            self.assertEqual(status, wsgi.status_code)
+            if method == 'GET':
+                self.assertEqual(json.loads(data), json.loads(wsgi.data))
+        self.assertEqual(json.loads(data)['actor_id'], 5)
+
+    def test_uvicorn_responder_internals(self):
+        """StreamingResponder relies on these, see its docstring"""
+        responder = WSGIResponder(None, None, {})
+        self.assertEqual(responder.send_queue, [])
+        self.assertIsInstance(responder.send_event, asyncio.Event)
+        self.assertIsNone(responder.loop)
+        call = inspect.getsource(WSGIResponder.__call__)
+        self.assertIn('self.loop.run_in_executor(\n            self.executor, self.wsgi, environ, self.start_response', call)
+        self.assertIn('self.sender(send)', call)
+        self.assertIn('self.send_queue.append(None)', call)
+        self.assertEqual(list(inspect.signature(WSGIResponder.sender).parameters), ['self', 'send'])
+        self.assertEqual(list(inspect.signature(WSGIResponder.wsgi).parameters),
+                         ['self', 'environ', 'start_response'])
+
+    def test_streamed_export(self):
+        self.seed(movies=30)
+        sent = asyncio.run(asgi_request(ASGIApp(self.app), 'GET', '/movies/export',
+                                        self.headers()))
+        status, headers, data = asgi_result(sent)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'application/x-ndjson')
+        self.assertEqual(len(data.splitlines()), 30)
+
+    def test_requests_run_concurrently(self):
+        self.seed(actors=1)
+        with self.app.app_context():
+            engine = db.get_engine()
+        # each request waits in its query for the other one, which only
+        # returns if both run at the same time
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wait_for_other(conn, cursor, statement, parameters, context, executemany):
+            barrier.wait()
+
+        async def pair(asgi_app):
+            headers = self.headers()
+            return await asyncio.gather(*[asgi_request(asgi_app, 'GET', '/actors/1/movies',
+                                                       headers) for _ in range(2)])
+
+        self.client().get('/actors/1/movies', headers=self.headers())
+        event.listen(engine, 'before_cursor_execute', wait_for_other)
+        try:
+            results = asyncio.run(pair(ASGIApp(self.app, max_workers=2)))
+        finally:
+            event.remove(engine, 'before_cursor_execute', wait_for_other)
+        self.assertEqual([asgi_result(sent)[0] for sent in results], [200, 200])
+        self.assertFalse(barrier.broken)
+
+
+class SerializationTestCase(LocalAppTestCase):
+
+    """Every JSON backend writes the bytes jsonify would"""
+
+    transactional = False
+
+    PAYLOADS = [
+        {'success': True, 'actors': [{'id': 1, 'name': 'Zoë "Z" \\ Saldaña', 'age': None}]},
+        {'b': [1, -2, 2 ** 40, False], 'a': {'10': 'x', '2': 'y'}, 'c': ''},
+        {'control': ''.join(chr(i) for i in range(32)) + '\x7f', 'emoji': 'café 😀'},
+        [],
+    ]
+
+    def tearDown(self):
+        serialization.configure_json_backend('orjson')
+        super().tearDown()
+
+    def test_backends_match_jsonify(self):
+        with self.app.test_request_context():
+            for backend in serialization.BACKENDS:
+                serialization.configure_json_backend(backend)
+                for payload in self.PAYLOADS:
+                    self.assertEqual(serialization.dumps(payload), jsonify(payload).get_data())
+
+    def test_pretty_print_in_debug(self):
+        self.app.debug = True
+        with self.app.test_request_context():
+            self.assertEqual(serialization.dumps(self.PAYLOADS[0]),
+                             jsonify(self.PAYLOADS[0]).get_data())
+
+    def test_dates_as_iso_8601(self):
+        with self.app.test_request_context():
+            for backend in serialization.BACKENDS:
+                serialization.configure_json_backend(backend)
+                self.assertEqual(serialization.dumps({'d': datetime.date(2012, 10, 26)}),
+                                 b'{"d":"2012-10-26"}\n')
+
+    def test_read_endpoints_same_bytes_per_backend(self):
+        self.seed(actors=3, movies=3)
+        with self.app.app_context():
+            db.session.add(Actor(name='Penélope Cruz', age=47, gender='female'))
+            db.session.commit()
+        self.client().post('/movies/1/actors', headers=self.headers(), json={'actor_ids': [1, 4]})
+        bodies = {}
+        for backend in serialization.BACKENDS:
+            serialization.configure_json_backend(backend)
+            configure_response_cache(LRUBackend())
+            bodies[backend] = [self.client().get(path, headers=self.headers()).data
+                               for path in ('/actors', '/movies?include=cast', '/movies/1',
+                                            '/movies/1/actors', '/actors/4/movies')]
+        self.assertEqual(bodies['json'], bodies['orjson'])
+        self.assertIn(b'"release_date":"2000-01-01"', bodies['json'][2])
+        self.assertIn(b'Pen\\u00e9lope', bodies['json'][0])
+        self.assertEqual(json.loads(bodies['json'][3])['actors'][1]['id'], 4)
+
+
+class ReplicaTestCase(LocalAppTestCase):
+
+    """GET reads go round robin to healthy replicas, writes and read-after-write to the primary"""
+
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+        replica_set.reset()
+        configure_response_cache(LRUBackend(maxsize=0))
+
+        @self.app.route('/primary-actor')
+        @reads_from('primary')
+        def primary_actor():
+            return jsonify({'name': Actor.query.get(1).name})
+
+        setup_db(self.app, LOCAL_DATABASE_URI, ['sqlite://', 'sqlite://'])
+        with self.app.app_context():
+            db.create_all()
+            db.session.add(Actor(name='Primary', age=40, gender='female'))
+            db.session.commit()
+            for key, name in (('replica_0', 'Replica 0'), ('replica_1', 'Replica 1')):
+                engine = db.get_engine(bind=key)
+                db.metadata.create_all(engine)
+                with engine.begin() as connection:
+                    connection.execute(Actor.__table__.insert(),
+                                       {'name': name, 'age': 40, 'gender': 'female'})
+
+    def tearDown(self):
+        replica_set.reset()
+        super().tearDown()
+
+    def actor_name(self, client, path='/actors/1'):
+        return json.loads(client.get(path, headers=self.headers()).data)['actor']['name']
+
+    def test_reads_round_robin(self):
+        client = self.client()
+        names = [self.actor_name(client) for _ in range(4)]
+        self.assertEqual(names, ['Replica 0', 'Replica 1', 'Replica 0', 'Replica 1'])
+        self.assertEqual(replica_set.status()['replicas']['replica_1']['reads'], 2)
+
+    def test_write_then_read_your_writes(self):
+        client = self.client()
+        result = client.patch('/actors/1', headers=self.headers(), json={'age': 41})
+        self.assertEqual(json.loads(result.data)['actor']['name'], 'Primary')
+        self.assertIn(STICKY_COOKIE, result.headers['Set-Cookie'])
+        self.assertEqual(self.actor_name(client), 'Primary')
+        self.assertEqual(self.actor_name(self.client()), 'Replica 0')
+
+    def test_unhealthy_replica_is_skipped(self):
+        def replica_down(conn, cursor, statement, parameters, context, executemany):
+            raise exc.OperationalError(statement, parameters, Exception('replica down'))
+
+        with self.app.app_context():
+            engine = db.get_engine(bind='replica_0')
+        event.listen(engine, 'before_cursor_execute', replica_down)
+        try:
+            client = self.client()
+            names = {self.actor_name(client) for _ in range(3)}
+        finally:
+            event.remove(engine, 'before_cursor_execute', replica_down)
+        self.assertEqual(names, {'Replica 1'})
+        self.assertFalse(replica_set.status()['replicas']['replica_0']['healthy'])
+
+    def test_route_reads_from_primary(self):
+        result = self.client().get('/primary-actor')
+        self.assertEqual(json.loads(result.data)['name'], 'Primary')
+
+
+class OptimisticConcurrencyTestCase(LocalAppTestCase):
+
+    """PATCH and DELETE honour If-Match against the row version"""
+
+    def test_lost_update_is_rejected(self):
+        self.seed(actors=1)
+        headers = self.headers()
+        result = self.client().get('/actors/1', headers=headers)
+        etag = result.headers['ETag']
+        self.assertEqual(etag, '"v1"')
+        first = self.client().patch('/actors/1', json={'age': 30},
+                                    headers=dict(headers, **{'If-Match': etag}))
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.headers['ETag'], '"v2"')
+        second = self.client().patch('/actors/1', json={'age': 31},
+                                     headers=dict(headers, **{'If-Match': etag}))
+        self.assertEqual(second.status_code, 412)
+        data = json.loads(self.client().get('/actors/1', headers=headers).data)
+        self.assertEqual(data['actor']['age'], 30)
+
+    def test_conditional_delete(self):
+        self.seed(movies=1)
+        headers = self.headers()
+        stale = self.client().delete('/movies/1', headers=dict(headers, **{'If-Match': '"v7"'}))
+        self.assertEqual(stale.status_code, 412)
+        result = self.client().delete('/movies/1', headers=dict(headers, **{'If-Match': '"v1"'}))
+        self.assertEqual(json.loads(result.data)['deleted'], 1)
+        result = self.client().delete('/movies/1', headers=dict(headers, **{'If-Match': '"v1"'}))
+        self.assertEqual(result.status_code, 404)
+
+    def test_patch_is_one_update(self):
+        self.seed(movies=1)
+        headers = self.headers()
+        with self.count_queries() as statements:
+            result = self.client().patch('/movies/1', json={'release_date': '1999-12-31'},
+                                         headers=headers)
+        self.assertEqual(json.loads(result.data)['movie']['release_date'], '1999-12-31')
+        self.assertTrue(statements[0].startswith('UPDATE movies SET'))
+        self.assertIn('version', statements[0])
+        with self.app.app_context():
+            returning = db.engine.dialect.full_returning
+        self.assertEqual(len(statements), 1 if returning else 2)
+        result = self.client().patch('/movies/1', json={'release_date': 'soon'}, headers=headers)
+        self.assertEqual(result.status_code, 400)
+
+    def test_bulk_update_bumps_version(self):
+        self.seed(actors=2)
+        headers = self.headers()
+        self.client().patch('/actors/bulk', headers=headers,
+                            json={'actors': [{'id': 1, 'age': 60}, {'id': 2, 'name': 'B'}]})
+        for actor_id in (1, 2):
+            result = self.client().get('/actors/{}'.format(actor_id), headers=headers)
+            self.assertEqual(result.headers['ETag'], '"v2"')
+
+
+class WriteStatementsTestCase(LocalAppTestCase):
+
+    """Each single row write is one statement, its payload is validated before it"""
+
+    def test_create_is_one_insert(self):
+        headers = self.headers()
+        with self.count_queries() as statements:
+            result = self.client().post('/actors', headers=headers,
+                                        json={'name': 'A', 'age': 30, 'gender': 'female'})
+            self.client().post('/movies', headers=headers,
+                               json={'title': 'M', 'release_date': '2001-02-03', 'genre': 'Drama'})
+        self.assertEqual(json.loads(result.data)['actor_id'], 1)
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith('INSERT INTO actors'))
+        self.assertTrue(statements[1].startswith('INSERT INTO movies'))
+        result = self.client().get('/movies/1', headers=headers)
+        self.assertEqual(json.loads(result.data)['movie']['release_date'], '2001-02-03')
+        self.assertEqual(result.headers['ETag'], '"v1"')
+
+    def test_delete_is_one_statement(self):
+        self.seed(actors=1)
+        with self.count_queries() as statements:
+            result = self.client().delete('/actors/1', headers=self.headers())
+        self.assertEqual(json.loads(result.data)['deleted'], 1)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('DELETE FROM actors'))
+
+    def test_invalid_payload_touches_no_row(self):
+        headers = self.headers()
+        with self.count_queries() as statements:
+            result = self.client().post('/movies', headers=headers,
+                                        json={'title': 'M', 'release_date': 'soon', 'genre': 'Drama'})
+            missing = self.client().post('/actors', headers=headers, json={'name': 'A'})
+            patched = self.client().patch('/actors/1', headers=headers, json={'age': -1})
+        self.assertEqual(statements, [])
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(json.loads(result.data)['errors'],
+                         {'release_date': 'must be a date in YYYY-MM-DD format'})
+        self.assertEqual(json.loads(missing.data)['errors'],
+                         {'age': 'is required', 'gender': 'is required'})
+        self.assertEqual(json.loads(patched.data)['errors'], {'age': 'must not be negative'})
+
+
+class StatsTestCase(LocalAppTestCase):
+
+    """/stats endpoints read the summary tables the triggers keep current"""
+
+    def test_movie_stats(self):
+        self.seed(movies=4)
+        headers = self.headers(ASSISTANT_PERMISSIONS)
+        data = json.loads(self.client().get('/stats/movies', headers=headers).data)
+        self.assertEqual(data['total'], 4)
+        self.assertEqual(data['by_genre'], [{'genre': 'Action', 'count': 2},
+                                            {'genre': 'Drama', 'count': 2}])
+        self.assertEqual([group['year'] for group in data['by_year']],
+                         [2000, 2001, 2002, 2003])
+
+    def test_stats_follow_writes(self):
+        self.seed(actors=3, movies=2)
+        headers = self.headers()
+        self.client().patch('/movies/1', json={'genre': 'Action'}, headers=headers)
+        self.client().delete('/actors/2', headers=headers)
+        self.client().post('/actors/bulk', headers=headers,
+                           json={'actors': [{'name': 'A', 'age': 64, 'gender': 'female'}]})
+        movies = json.loads(self.client().get('/stats/movies', headers=headers).data)
+        self.assertEqual(movies['by_genre'], [{'genre': 'Action', 'count': 2}])
+        actors = json.loads(self.client().get('/stats/actors', headers=headers).data)
+        self.assertEqual(actors['total'], 3)
+        self.assertEqual(actors['average_age'], round((20 + 22 + 64) / 3, 1))
+        self.assertEqual(actors['by_gender'], [{'gender': 'female', 'count': 1},
+                                               {'gender': 'male', 'count': 2}])
+        self.assertEqual(actors['by_age_group'], [{'age_group': '20-29', 'count': 2},
+                                                  {'age_group': '60-69', 'count': 1}])
+
+    def test_stats_do_not_scan_catalog(self):
+        self.seed(actors=10)
+        with self.count_queries() as statements:
+            self.client().get('/stats/actors', headers=self.headers())
+        self.assertTrue(statements)
+        self.assertTrue(all('FROM actor_counts' in statement for statement in statements))
+
+
+class RateLimitTestCase(LocalAppTestCase):
+
+    """Token buckets per client address and per subject, checked around token verification"""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        self.buckets = MemoryBuckets(clock=lambda: self.now)
+
+    def tearDown(self):
+        auth.configure_rate_limiter(MemoryBuckets())
+        super().tearDown()
+
+    def test_address_limit_429_with_retry_after(self):
+        auth.configure_rate_limiter(self.buckets, ip_limit=(0.5, 2), limits={})
+        headers = self.headers(ASSISTANT_PERMISSIONS)
+        for _ in range(2):
+            self.assertEqual(self.client().get('/movies', headers=headers).status_code, 404)
+        result = self.client().get('/movies', headers=headers)
+        self.assertEqual(result.status_code, 429)
+        self.assertEqual(result.headers['Retry-After'], '2')
+        self.assertEqual(json.loads(result.data)['error'], 429)
+        self.now += 2
+        self.assertEqual(self.client().get('/movies', headers=headers).status_code, 404)
+
+    def test_address_limit_checked_before_verification(self):
+        auth.configure_rate_limiter(self.buckets, ip_limit=(1, 1), limits={})
+        self.client().get('/movies', headers=self.headers(ASSISTANT_PERMISSIONS))
+        misses = auth.token_cache.stats()['misses']
+        result = self.client().get('/movies', headers=self.headers(ASSISTANT_PERMISSIONS + ['x']))
+        self.assertEqual(result.status_code, 429)
+        self.assertEqual(auth.token_cache.stats()['misses'], misses)
+
+    def test_forwarded_address_behind_proxy(self):
+        auth.configure_rate_limiter(self.buckets, ip_limit=(1, 1), limits={}, proxies=1)
+        headers = self.headers(ASSISTANT_PERMISSIONS)
+        for address in ('10.0.0.1', '10.0.0.2'):
+            result = self.client().get('/movies', headers=dict(
+                headers, **{'X-Forwarded-For': 'spoofed, ' + address}))
+            self.assertEqual(result.status_code, 404)
+        result = self.client().get('/movies', headers=dict(
+            headers, **{'X-Forwarded-For': '10.0.0.1'}))
+        self.assertEqual(result.status_code, 429)
+
+    def test_subject_limits_per_action(self):
+        limits = parse_limits('delete=1:1,*=100:100')
+        self.assertEqual(limits['delete'], (1.0, 1.0))
+        auth.configure_rate_limiter(self.buckets, ip_limit=None, limits=limits)
+        self.seed(actors=2)
+        headers = self.headers()
+        self.assertEqual(self.client().delete('/actors/1', headers=headers).status_code, 200)
+        self.assertEqual(self.client().delete('/actors/2', headers=headers).status_code, 429)
+        other = {'Authorization': 'Bearer {}'.format(
+            make_local_token(PRODUCER_PERMISSIONS, sub='auth0|other'))}
+        self.assertEqual(self.client().delete('/actors/2', headers=other).status_code, 200)
+        self.assertEqual(self.client().get('/actors', headers=headers).status_code, 404)
+
+    def test_buckets_are_bounded(self):
+        buckets = MemoryBuckets(maxsize=2, clock=lambda: self.now)
+        for key in ('a', 'b', 'c'):
+            self.assertEqual(buckets.take(key, 1, 1), 0)
+        self.assertEqual(len(buckets._buckets), 2)
+        self.assertEqual(buckets.take('c', 1, 1), 1)
+
+    def test_expired_token_rejected_without_jwks(self):
+        token = make_local_token(ASSISTANT_PERMISSIONS, expires_in=-60)
+        result = self.client().get('/movies', headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(result.status_code, 401)
+        result = self.client().get('/movies', headers={'Authorization': 'Bearer not.a.jwt'})
+        self.assertEqual(result.status_code, 401)
+        self.assertEqual(self.jwks_store.stats()['fetches'], 0)
+
+
+class ImportTestCase(LocalAppTestCase):
+
+    """Uploads queued by /imports and written in chunks by the import workers"""
+
+    CSV = (b'name,age,gender\n'
+           b'Ana,31,female\n'
+           b'"Smith, John",45,male\n'
+           b'Bad Age,x,male\n'
+           b'Lee,28,female\n')
+
+    def setUp(self):
+        super().setUp()
+        # no threads: the tests run the queued jobs themselves
+        imports.configure_import_workers(threads=0)
+
+    def status(self, import_id, permissions=PRODUCER_PERMISSIONS):
+        result = self.client().get('/imports/{}'.format(import_id),
+                                   headers=self.headers(permissions))
+        return result.status_code, json.loads(result.data)
+
+    def test_csv_upload(self):
+        result = self.client().post('/imports/actors', headers=self.headers(),
+                                    data={'file': (io.BytesIO(self.CSV), 'actors.csv')})
+        self.assertEqual(result.status_code, 202)
+        import_id = json.loads(result.data)['import_id']
+        self.assertTrue(result.headers['Location'].endswith('/imports/{}'.format(import_id)))
+        self.assertEqual(self.status(import_id)[1]['import']['status'], 'queued')
+
+        self.assertTrue(imports.import_workers.run_once(self.app))
+        self.assertFalse(imports.import_workers.run_once(self.app))
+        job = self.status(import_id)[1]['import']
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual((job['total_rows'], job['processed_rows'], job['inserted_rows'],
+                          job['failed_rows']), (4, 4, 3, 1))
+        self.assertEqual(job['progress'], 1.0)
+        self.assertEqual(job['errors'], [{'row': 3, 'errors': {'age': 'must be an integer'}}])
+        self.assertIsNotNone(job['rows_per_second'])
+        data = json.loads(self.client().get('/actors', headers=self.headers()).data)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['Ana', 'Smith, John', 'Lee'])
+        with self.app.app_context():
+            self.assertIsNone(db.session.query(ImportJob.data).scalar())
+
+    def test_ndjson_resumes_after_last_chunk(self):
+        lines = [{'title': 'Movie {}'.format(i), 'release_date': '2001-01-0{}'.format(i),
+                  'genre': 'Drama'} for i in range(1, 6)]
+        body = '\n'.join(json.dumps(line) for line in lines) + '\nnot json\n'
+        result = self.client().post('/imports/movies', headers=self.headers(), data=body,
+                                    content_type='application/x-ndjson')
+        import_id = json.loads(result.data)['import_id']
+        with self.app.app_context():
+            self.assertEqual(imports.claim_job(), import_id)
+            # the worker wrote the first chunk of 2 rows and died
+            imports.write_chunk(import_id, Movie, 0, lines[:2], [])
+            self.assertIsNone(imports.claim_job())
+            db.session.query(ImportJob).update(
+                {'updated_at': datetime.datetime(2000, 1, 1)})
+            db.session.commit()
+        self.assertTrue(imports.import_workers.run_once(self.app))
+        job = self.status(import_id)[1]['import']
+        self.assertEqual((job['status'], job['inserted_rows'], job['failed_rows']),
+                         ('done', 5, 1))
+        self.assertEqual(job['errors'], [{'row': 6,
+                                          'errors': {'_schema': 'must be a JSON object'}}])
+        with self.app.app_context():
+            self.assertEqual(sorted(movie.title for movie in Movie.query.all()),
+                             ['Movie {}'.format(i) for i in range(1, 6)])
+        self.assertEqual(imports.import_workers.stats()['rows_inserted'], 3)
+
+    def test_chunks_and_error_cap(self):
+        rows = [{'name': 'Actor {}'.format(i), 'age': i if i % 2 else -1, 'gender': 'male'}
+                for i in range(10)]
+        body = '\n'.join(json.dumps(row) for row in rows)
+        result = self.client().post('/imports/actors?format=ndjson', headers=self.headers(),
+                                    data=body)
+        import_id = json.loads(result.data)['import_id']
+        statements = []
+        imports.IMPORT_MAX_ERRORS, max_errors = 2, imports.IMPORT_MAX_ERRORS
+        try:
+            with self.app.app_context():
+                imports.claim_job()
+                with self.count_queries() as statements:
+                    imports.process_job(import_id, chunk_size=4)
+        finally:
+            imports.IMPORT_MAX_ERRORS = max_errors
+        inserts = [statement for statement in statements
+                   if statement.startswith('INSERT INTO actors')]
+        self.assertEqual(len(inserts), 3)
+        job = self.status(import_id)[1]['import']
+        self.assertEqual((job['inserted_rows'], job['failed_rows']), (5, 5))
+        self.assertEqual([error['row'] for error in job['errors']], [1, 3])
+
+    def test_bad_uploads_400(self):
+        headers = self.headers()
+        result = self.client().post('/imports/actors', headers=headers,
+                                    data=b'name,age\nAna,31\n', content_type='text/csv')
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(json.loads(result.data)['errors'], {'gender': 'column is required'})
+        result = self.client().post('/imports/actors', headers=headers, data=b'x',
+                                    content_type='application/pdf')
+        self.assertEqual(result.status_code, 400)
+        result = self.client().post('/imports/actors', headers=headers, data=b'',
+                                    content_type='text/csv')
+        self.assertEqual(result.status_code, 400)
+        with self.app.app_context():
+            self.assertEqual(ImportJob.query.count(), 0)
+
+    def test_unreadable_file_fails_job(self):
+        result = self.client().post('/imports/actors', headers=self.headers(),
+                                    data=b'name,age,gender\n\xff\xfe,1,x\n',
+                                    content_type='text/csv')
+        import_id = json.loads(result.data)['import_id']
+        imports.import_workers.run_once(self.app)
+        job = self.status(import_id)[1]['import']
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('can not be read', job['message'])
+        self.assertEqual(imports.import_workers.stats()['jobs_failed'], 1)
+
+    def test_permissions(self):
+        result = self.client().post('/imports/movies', headers=self.headers(DIRECTOR_PERMISSIONS),
+                                    data=b'title,release_date,genre\n', content_type='text/csv')
+        self.assertEqual(result.status_code, 401)
+        result = self.client().post('/imports/movies', headers=self.headers(),
+                                    data=b'title,release_date,genre\n', content_type='text/csv')
+        import_id = json.loads(result.data)['import_id']
+        self.assertEqual(self.status(import_id, DIRECTOR_PERMISSIONS)[0], 403)
+        self.assertEqual(self.status(import_id)[0], 200)
+        # the job's add permission is enough to poll it
+        self.assertEqual(self.status(import_id, ['add:movies'])[0], 200)
+        self.assertEqual(self.status(import_id + 1)[0], 404)
+
+
+class ChangesTestCase(LocalAppTestCase):
+
+    """/changes lists the actors and movies written since a cursor, deletes as tombstones"""
+
+    def changes(self, query='', permissions=PRODUCER_PERMISSIONS):
+        result = self.client().get('/changes' + query, headers=self.headers(permissions))
+        return result.status_code, json.loads(result.data)
+
+    def test_incremental_sync(self):
+        self.seed(actors=3, movies=2)
+        data = self.changes()[1]
+        self.assertEqual([(change['resource'], change['id']) for change in data['changes']],
+                         [('actors', 1), ('actors', 2), ('actors', 3),
+                          ('movies', 1), ('movies', 2)])
+        self.assertEqual(data['changes'][0]['data'],
+                         {'id': 1, 'name': 'Actor 0', 'age': 20, 'gender': 'male'})
+        self.assertFalse(data['has_more'])
+        cursor = data['next_cursor']
+        self.assertEqual(self.changes('?since=' + cursor)[1]['changes'], [])
+
+        headers = self.headers()
+        self.client().patch('/actors/2', headers=headers, json={'name': 'Renamed'})
+        self.client().delete('/movies/1', headers=headers)
+        self.client().post('/actors/bulk', headers=headers,
+                           json={'actors': [{'name': 'New', 'age': 30, 'gender': 'male'}]})
+        self.client().patch('/actors/2', headers=headers, json={'age': 50})
+        data = self.changes('?since=' + cursor)[1]
+        self.assertEqual([(change['resource'], change['id'], change['deleted'])
+                          for change in data['changes']],
+                         [('movies', 1, True), ('actors', 4, False), ('actors', 2, False)])
+        self.assertIsNone(data['changes'][0]['data'])
+        self.assertEqual(data['changes'][2]['data']['age'], 50)
+        self.assertEqual(self.changes('?since=' + data['next_cursor'])[1]['changes'], [])
+
+    def test_pages(self):
+        self.seed(actors=5)
+        seen = []
+        cursor = ''
+        while True:
+            data = self.changes('?limit=2&since=' + cursor)[1]
+            seen += [change['id'] for change in data['changes']]
+            cursor = data['next_cursor']
+            if not data['has_more']:
+                break
+        self.assertEqual(seen, [1, 2, 3, 4, 5])
+
+    def test_queries_do_not_grow_with_page(self):
+        self.seed(actors=30, movies=30)
+        with self.count_queries() as statements:
+            data = self.changes('?limit=100')[1]
+        self.assertEqual(len(data['changes']), 60)
+        self.assertEqual(len(statements), 3)
+
+    def test_timestamps(self):
+        with self.app.app_context():
+            Actor(name='A', age=30, gender='male').insert()
+            actor = Actor.query.get(1)
+            created_at, updated_at = actor.created_at, actor.updated_at
+        time.sleep(0.01)
+        self.client().patch('/actors/1', headers=self.headers(), json={'age': 31})
+        with self.app.app_context():
+            actor = Actor.query.get(1)
+            self.assertEqual(actor.created_at, created_at)
+            self.assertGreater(actor.updated_at, updated_at)
+
+    def test_resources_and_bad_cursor(self):
+        self.seed(actors=1, movies=1)
+        status, data = self.changes('?resource=movies')
+        self.assertEqual([change['resource'] for change in data['changes']], ['movies'])
+        status, data = self.changes(permissions=['view:actors'])
+        self.assertEqual([change['resource'] for change in data['changes']], ['actors'])
+        self.assertEqual(self.changes('?resource=movies', ['view:actors'])[0], 403)
+        self.assertEqual(self.changes('?resource=castings')[0], 400)
+        self.assertEqual(self.changes('?since=abc')[0], 400)
+
+
+class StartupTestCase(unittest.TestCase):
+
+    """Importing the package stays cheap: no app, no alembic, no jose until they are needed"""
+
+    def import_flaskr(self, statement=''):
+        """Imports flaskr in a fresh interpreter, runs statement and returns its stdout"""
+        result = subprocess.run([sys.executable, '-c', 'import sys, flaskr; ' + statement],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout
+
+    def test_import_defers_app_and_heavy_modules(self):
+        output = self.import_flaskr(
+            "print(sorted({'alembic', 'flask_migrate', 'jose'} & set(sys.modules)), "
+            "'app' in vars(flaskr))")
+        self.assertEqual(output.strip(), '[] False')
+
+    def test_app_built_on_first_access(self):
+        output = self.import_flaskr(
+            "print(flaskr.app.name, 'migrate' in flaskr.app.extensions, 'jose' in sys.modules)")
+        self.assertEqual(output.strip(), 'flaskr False False')
+
+    def test_warm_up_loads_keys_and_jose(self):
+        jwks_path = write_local_jwks()
+        try:
+            store = auth.configure_jwks(file_fetcher(jwks_path))
+            app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+            flaskr.warm_up(app)
+            self.assertEqual(store.stats()['keys'], 1)
+            self.assertIn('jose.jwt', sys.modules)
+        finally:
+            os.remove(jwks_path)
+
+
 if __name__ == '__main__':
     unittest.main()